@@ -1,42 +1,238 @@
+"""The application factory.
+
+    waitress-serve --call app:create_app
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+`create_app` only reads the configuration and wires up the extensions. Nothing talks to
+postgres, redis or the SMTP server until it's needed, so an app created in a parent
+process can be forked safely: the children drop anything inherited (see
+`_reset_after_fork`) and open their own connections. `warm_up` does the first time
+work ahead of the first request instead.
+"""
+import logging
 import os
+import time
 import uuid
+import weakref
 
-from flask import Flask, render_template, flash
+import click
+from flask import Flask
 from flask_login import LoginManager
-from flask_migrate import Migrate
 
-from models import db, User
+import bulk
+from assets import static_assets
+from models import db
+from auth import connections, events, security
+from auth.cache import cache_collector
+from auth.credential_usage import credential_usage
+from auth.events import auth_events, exit_on_sigterm
+from auth.mailer import mailer
+from auth.metrics import metrics
+from auth.offload import cpu_offload
+from auth.page_cache import page_cache
+from auth.rate_limit import rate_limits
+from auth.replicas import replicas
+from auth.user_cache import user_cache
 from auth.views import auth
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+logger = logging.getLogger(__name__)
 
-app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+login_manager = LoginManager()
+login_manager.login_view = "auth.login"
 
-app.config["MAIL_USERNAME"] = os.getenv("MAIL_USERNAME")
-app.config["MAIL_PASSWORD"] = os.getenv("MAIL_PASSWORD")
-app.config["MAIL_SERVER"] = os.getenv("MAIL_SERVER")
-app.config["MAIL_PORT"] = int(os.getenv("MAIL_PORT"))
-app.config["MAIL_FROM"] = os.getenv("MAIL_FROM")
+# The app `create_app` made last, which is the one a forked worker serves. Only a
+# weak reference, apps made by tests and scripts shouldn't be kept alive by it.
+_current_app = None
+_fork_hook_registered = False
 
-login_manager = LoginManager()
-login_manager.init_app(app)
 
-login_manager.login_view = "auth.login"
+def _env_flag(name, default="false"):
+    return os.getenv(name, default).lower() == "true"
+
+
+def _pool_options(prefix):
+    options = {}
+    for option in ("pool_size", "max_overflow"):
+        if value := os.getenv(f"{prefix}_{option.upper()}"):
+            options[option] = int(value)
+    return options
+
+
+def load_config(app):
+    """Read the configuration from the environment."""
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URL")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = _pool_options("DATABASE")
+
+    # Read only replicas for the queries in `replica_reads` blocks, see
+    # auth/replicas.py
+    app.config["DATABASE_REPLICA_URLS"] = [
+        url.strip()
+        for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",")
+        if url.strip()
+    ]
+    app.config["REPLICA_ENGINE_OPTIONS"] = _pool_options("DATABASE_REPLICA")
+    app.config["REPLICA_STICKY_SECONDS"] = float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+
+    app.config["SECRET_KEY"] = os.getenv("SECRET_KEY")
+    # "hmac" (the default) or "argon2", see auth/secret_hashing.py
+    app.config["MAGIC_LINK_HASHER"] = os.getenv("MAGIC_LINK_HASHER", "hmac")
+    app.config["MAGIC_LINK_HMAC_KEY"] = os.getenv("MAGIC_LINK_HMAC_KEY")
+
+    app.config["MAIL_USERNAME"] = os.getenv("MAIL_USERNAME")
+    app.config["MAIL_PASSWORD"] = os.getenv("MAIL_PASSWORD")
+    app.config["MAIL_SERVER"] = os.getenv("MAIL_SERVER")
+    app.config["MAIL_PORT"] = int(os.getenv("MAIL_PORT") or 587)
+    app.config["MAIL_FROM"] = os.getenv("MAIL_FROM")
+    app.config["MAIL_USE_TLS"] = _env_flag("MAIL_USE_TLS", "true")
+    app.config["MAIL_WORKERS"] = int(os.getenv("MAIL_WORKERS", 2))
+
+    # Processes for signature checks and argon2, 0 runs them in the request thread.
+    app.config["CPU_OFFLOAD_WORKERS"] = int(os.getenv("CPU_OFFLOAD_WORKERS", 0))
+    app.config["CPU_OFFLOAD_MAX_PENDING"] = int(
+        os.getenv("CPU_OFFLOAD_MAX_PENDING", 16)
+    )
+    app.config["CPU_OFFLOAD_TIMEOUT"] = float(os.getenv("CPU_OFFLOAD_TIMEOUT", 5))
+
+    app.config["USER_CACHE_TTL"] = int(os.getenv("USER_CACHE_TTL", 60))
+    app.config["USER_CACHE_REDIS"] = _env_flag("USER_CACHE_REDIS")
+
+    # Buffer credential sign count and last used updates and write them in batches
+    # instead of committing during each login, see auth/credential_usage.py
+    app.config["CREDENTIAL_WRITE_BEHIND"] = _env_flag("CREDENTIAL_WRITE_BEHIND")
+    app.config["CREDENTIAL_FLUSH_INTERVAL"] = float(
+        os.getenv("CREDENTIAL_FLUSH_INTERVAL", 1)
+    )
+
+    # Registrations, logins and failures are logged to the auth_event table in
+    # batches from a background thread, see auth/events.py
+    app.config["AUTH_EVENTS"] = _env_flag("AUTH_EVENTS", "true")
+    app.config["AUTH_EVENTS_FLUSH_INTERVAL"] = float(
+        os.getenv("AUTH_EVENTS_FLUSH_INTERVAL", 1)
+    )
+    app.config["AUTH_EVENTS_FLUSH_BATCH"] = int(
+        os.getenv("AUTH_EVENTS_FLUSH_BATCH", 500)
+    )
+    app.config["AUTH_EVENTS_MAX_PENDING"] = int(
+        os.getenv("AUTH_EVENTS_MAX_PENDING", 10000)
+    )
+    app.config["AUTH_EVENTS_MAX_ATTEMPTS"] = int(
+        os.getenv("AUTH_EVENTS_MAX_ATTEMPTS", 3)
+    )
+
+    # Compiled templates on disk and rendered anonymous pages in memory, see
+    # auth/page_cache.py
+    app.config["JINJA_BYTECODE_CACHE_DIR"] = os.getenv("JINJA_BYTECODE_CACHE_DIR")
+    app.config["PAGE_CACHE"] = _env_flag("PAGE_CACHE", "true")
+
+    # Per phase timings in a Server-Timing header and Prometheus metrics at /metrics,
+    # see auth/metrics.py
+    app.config["SERVER_TIMING"] = _env_flag("SERVER_TIMING", "true")
+    app.config["METRICS_ENDPOINT"] = _env_flag("METRICS_ENDPOINT", "true")
+
+    # Per endpoint limits for the auth endpoints, see auth/rate_limit.py
+    app.config["RATE_LIMIT"] = _env_flag("RATE_LIMIT", "true")
+    # "redis" or "memory". Memory by default when the challenges don't need redis.
+    app.config["RATE_LIMIT_STORE"] = os.getenv(
+        "RATE_LIMIT_STORE",
+        "memory" if os.getenv("CHALLENGE_STORE") in ("memory", "signed") else "redis",
+    )
+    app.config["RATE_LIMIT_REDIS_COOLDOWN"] = float(
+        os.getenv("RATE_LIMIT_REDIS_COOLDOWN", 5)
+    )
+
+    # Connections to open to postgres and redis in `warm_up`.
+    app.config["WARM_UP_CONNECTIONS"] = int(os.getenv("WARM_UP_CONNECTIONS", 1))
+
+
+class _LazyMigrate:
+    """Stands in for Flask-Migrate's state in `app.extensions` until a command uses
+    it, whether that's one from `_MigrateCommands` or Flask-Migrate's own `flask db`
+    plugin."""
+
+    def __init__(self, app):
+        self.app = app
 
-db.init_app(app)
-Migrate(app, db)
+    def __getattr__(self, name):
+        from flask_migrate import Migrate
 
-app.register_blueprint(auth, url_prefix="/auth")
+        # Replaces this in `app.extensions`.
+        Migrate(self.app, db)
+        return getattr(self.app.extensions["migrate"], name)
+
+
+class _MigrateCommands(click.Group):
+    """Flask-Migrate's `db` commands, imported when they're looked up."""
+
+    def _commands(self):
+        from flask_migrate.cli import db as commands
+
+        return commands
+
+    def list_commands(self, ctx):
+        return self._commands().list_commands(ctx)
+
+    def get_command(self, ctx, name):
+        return self._commands().get_command(ctx, name)
+
+
+def create_app(config=None):
+    """Create the app. `config` overrides settings from the environment."""
+    app = Flask(__name__)
+    load_config(app)
+    if config:
+        app.config.update(config)
+
+    login_manager.init_app(app)
+    db.init_app(app)
+    replicas.init_app(app)
+    # Flask-Migrate pulls in alembic, a third of the import time, and is only used by
+    # the `flask db` commands, so it's set up when one of them runs.
+    app.extensions["migrate"] = _LazyMigrate(app)
+    metrics.init_app(app)
+    metrics.add_collector(connections.pool_collector)
+    metrics.add_collector(cache_collector)
+    rate_limits.init_app(app)
+    static_assets.init_app(app)
+    page_cache.init_app(app)
+    mailer.init_app(app)
+    user_cache.init_app(app)
+    cpu_offload.init_app(app)
+    credential_usage.init_app(app)
+    auth_events.init_app(app)
+
+    app.register_blueprint(auth, url_prefix="/auth")
+    app.add_url_rule("/", "index", index)
+    app.context_processor(utility_processor)
+    app.cli.add_command(_MigrateCommands("db", help="Database migrations."))
+    app.cli.add_command(bulk.cli)
+    app.cli.add_command(events.cli)
+
+    global _current_app, _fork_hook_registered
+    _current_app = weakref.ref(app)
+    # Fork hooks can't be removed, so there's one for all the apps.
+    if not _fork_hook_registered:
+        os.register_at_fork(after_in_child=_reset_after_fork)
+        _fork_hook_registered = True
+    return app
+
+
+def create_warm_app():
+    """`create_app` followed by `warm_up`, for single process servers:
+
+    waitress-serve --call app:create_warm_app
+    """
+    app = create_app()
+    warm_up(app)
+    exit_on_sigterm()
+    return app
 
 
 @login_manager.user_loader
 def load_user(user_uid):
-    return User.query.filter_by(uid=user_uid).first()
+    return user_cache.load_user(user_uid)
 
 
-@app.context_processor
 def utility_processor():
     def random_id():
         return uuid.uuid4().hex
@@ -44,7 +240,65 @@ def utility_processor():
     return dict(random_id=random_id)
 
 
-@app.route("/")
 def index():
     """The main homepage. This is a stub since it's a demo project."""
-    return render_template("index.html")
+    return page_cache.render_template("index.html")
+
+
+def _reset_after_fork():
+    """Drop connections inherited from a parent process so that a forked worker
+    opens its own."""
+    connections.reset()
+    cpu_offload.reset()
+    replicas.reset()
+    app = _current_app and _current_app()
+    if app is not None:
+        # close=False leaves the parent's sockets alone, they're still in use there.
+        db.get_engine(app).dispose(close=False)
+
+
+def _open_connections(connect, release, count):
+    # All at once, otherwise the pool would hand back the same one each time.
+    opened = []
+    try:
+        for _ in range(count):
+            opened.append(connect())
+    finally:
+        for connection in opened:
+            release(connection)
+
+
+def warm_up(app):
+    """Do the work that would otherwise slow down the first requests a process
+    handles: compile the templates, open database and redis connections and start the
+    offload processes. Run it in each worker before it takes traffic, e.g. from the
+    gunicorn `post_worker_init` hook. Failures are logged, not raised, so an outage
+    elsewhere doesn't stop the worker from starting."""
+    started = time.perf_counter()
+    count = app.config.get("WARM_UP_CONNECTIONS", 1)
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    for engine in [db.get_engine(app), *replicas.engines]:
+        try:
+            _open_connections(engine.connect, lambda c: c.close(), count)
+        except Exception:
+            # %r masks the password in the url.
+            logger.warning("Warming up %r failed", engine.url, exc_info=True)
+
+    spaces = list(security.REDIS_KEY_SPACES)
+    if app.config.get("USER_CACHE_REDIS"):
+        spaces.append("user")
+    # Key spaces on the same backend share their pools.
+    for space in {connections.redis_url(space): space for space in spaces}.values():
+        try:
+            for pool in connections.get_pools(space):
+                _open_connections(
+                    lambda: pool.get_connection("PING"), pool.release, count
+                )
+        except Exception:
+            logger.warning("Warming up the redis pool failed", exc_info=True)
+
+    cpu_offload.warm_up()
+    logger.info("Warmed up in %.3fs", time.perf_counter() - started)
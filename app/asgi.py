@@ -0,0 +1,184 @@
+"""ASGI entry point, an alternative to serving `app:create_app` with waitress.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+The login ceremonies, which spend most of their time waiting on redis and postgres,
+are handled natively with async I/O (see `auth/aio.py`), so one process can keep
+thousands of them in flight. Every other route goes to the regular Flask app, which
+runs in a thread pool.
+
+The async handlers still use Flask for everything that doesn't wait on I/O (the
+session, Flask-Login, templates and response building) by pushing a request context
+around those parts, so the responses are exactly the ones the sync views produce.
+"""
+import functools
+
+from asgiref.wsgi import WsgiToAsgi
+from flask import make_response, request, session
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+from webauthn.helpers.structs import AuthenticationCredential
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+from app import create_app
+from auth import aio, metrics, security, views
+from auth.events import auth_events
+from auth.offload import OffloadBusy
+from auth.page_cache import page_cache
+from auth.rate_limit import rate_limits
+from auth.replicas import replicas
+
+
+def _environ(scope, body):
+    headers = [(k.decode("latin1"), v.decode("latin1")) for k, v in scope["headers"]]
+    host = dict(headers).get("host") or "localhost"
+    scheme = scope.get("scheme", "http")
+    builder = EnvironBuilder(
+        path=scope["path"],
+        base_url=f"{scheme}://{host}{scope.get('root_path', '')}",
+        method=scope["method"],
+        query_string=scope["query_string"].decode("latin1"),
+        headers=headers,
+        data=body,
+    )
+    environ = builder.get_environ()
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    return environ
+
+
+def _request_context(environ):
+    # Each context parses the body again, so start it from the beginning.
+    environ["wsgi.input"].seek(0)
+    return app.request_context(environ)
+
+
+def _read_request(environ, func):
+    """Call `func` inside a Flask request context to read from the request or the
+    session."""
+    with _request_context(environ):
+        return func()
+
+
+def _respond(environ, func, *args):
+    """Build a response by calling `func` inside a Flask request context. It goes
+    through the app's normal response processing, which also saves the session."""
+    with _request_context(environ):
+        try:
+            rv = func(*args)
+        except HTTPException as error:
+            rv = error.get_response()
+        return app.process_response(make_response(rv))
+
+
+async def prepare_login(environ, body):
+    username_or_email, hostname = _read_request(
+        environ,
+        lambda: (request.form.get("username_email", ""), security.current_hostname()),
+    )
+    user = await aio.load_login_user(username_or_email=username_or_email)
+    if not user:
+        return _respond(
+            environ,
+            lambda: page_cache.render_template(
+                "auth/_partials/username_form.html", error="No matching user found"
+            ),
+        )
+    auth_options = await aio.prepare_login_with_credential(user, hostname)
+    return _respond(environ, views.login_options_response, user, auth_options)
+
+
+async def verify_login_credential(environ, body):
+    user_uid, hostname = _read_request(
+        environ,
+        lambda: (session.get("login_user_uid"), security.current_hostname()),
+    )
+    user = await aio.load_user(user_uid)
+    event = dict(method="webauthn", remote_addr=environ.get("REMOTE_ADDR"))
+    if not user:
+        auth_events.record("login_failed", detail="No user", **event)
+    else:
+        credential = AuthenticationCredential.parse_raw(body)
+        event.update(user=user, credential_id=credential.raw_id)
+        try:
+            await aio.verify_authentication_credential(user, credential, hostname)
+            auth_events.record("login", **event)
+            return _respond(environ, views.verified_login_response, user)
+        except InvalidAuthenticationResponse as error:
+            auth_events.record("login_failed", detail=str(error), **event)
+        except OffloadBusy as error:
+            return _respond(environ, views.cpu_busy, error)
+    return _respond(environ, make_response, '{"verified": false}', 400)
+
+
+ASYNC_ROUTES = {
+    ("POST", "/auth/prepare-login"): prepare_login,
+    ("POST", "/auth/verify-login-credential"): verify_login_credential,
+}
+# Signed challenges travel in the session cookie, which only the Flask views write,
+# and there's no redis round trip to wait on.
+if aio.AUTHENTICATION_CHALLENGES is None:
+    ASYNC_ROUTES = {}
+
+
+class Application:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        handler = None
+        if scope["type"] == "http":
+            handler = ASYNC_ROUTES.get((scope["method"], scope["path"]))
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        environ = _environ(scope, body)
+        # These stand in for the app's before_request hooks, which don't run for the
+        # async handlers. The timings are reported when `_respond` runs the
+        # after_request ones.
+        metrics.begin_request()
+        if replicas.urls:
+            _read_request(environ, replicas.begin_request)
+        limited = await rate_limits.check_async(
+            functools.partial(_read_request, environ)
+        )
+        if limited is not None:
+            response = _respond(environ, lambda: limited)
+        else:
+            response = await handler(environ, body)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (k.encode("latin1"), v.encode("latin1"))
+                    for k, v in response.get_wsgi_headers(environ).to_wsgi_list()
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": response.get_data()})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await aio.dispose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = create_app()
+application = Application(app)
@@ -0,0 +1,188 @@
+"""Fingerprinted, precompressed static files.
+
+    python -m assets
+
+copies everything in static/ to static/dist/ under a name containing a hash of its
+content (style.css becomes style.5d41402abc4b.css), writes gzip and brotli versions of
+the text files next to them, and writes a manifest.json mapping the original names to
+the new ones. `url(/static/...)` references in CSS files are rewritten to the hashed
+names as well.
+
+When the app finds a manifest, `url_for('static', filename='style.css')` returns the
+hashed URL, and those files are served from memory by a WSGI middleware in front of
+Flask's routing, in the best encoding the client accepts and with a year long
+immutable Cache-Control. A changed file gets a new name, so browsers never have to
+check whether their copy is still fresh. Without a manifest (in development) the
+static files are served by Flask as usual.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import sys
+
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = "dist"
+MANIFEST = "manifest.json"
+COMPRESSIBLE = {".css", ".js", ".json", ".map", ".svg", ".txt", ".ico"}
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+_CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")?#]+)([^'")]*)\1\)""")
+
+
+def _rewrite_css(content, manifest):
+    def hashed_url(match):
+        quote, name, suffix = match.groups()
+        if name not in manifest:
+            return match.group(0)
+        return f"url({quote}/static/{manifest[name]}{suffix}{quote})"
+
+    return _CSS_URL.sub(hashed_url, content.decode()).encode()
+
+
+def _precompress(path, content):
+    encoded = {".gz": gzip.compress(content, 9, mtime=0)}
+    if brotli is not None:
+        encoded[".br"] = brotli.compress(content, quality=11)
+    for extension, data in encoded.items():
+        # Small files can come out bigger.
+        if len(data) < len(content):
+            with open(path + extension, "wb") as f:
+                f.write(data)
+
+
+def build(static_folder):
+    """Build static/dist from `static_folder` and return the manifest."""
+    dist = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    sources = []
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST in dirs:
+            dirs.remove(DIST)
+        for filename in files:
+            path = os.path.relpath(os.path.join(root, filename), static_folder)
+            sources.append(path.replace(os.sep, "/"))
+    # CSS last, so that it can refer to the hashed fonts and images.
+    sources.sort(key=lambda name: (name.endswith(".css"), name))
+
+    manifest = {}
+    for name in sources:
+        with open(os.path.join(static_folder, name), "rb") as f:
+            content = f.read()
+        if name.endswith(".css"):
+            content = _rewrite_css(content, manifest)
+        stem, extension = os.path.splitext(name)
+        hashed = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{extension}"
+        path = os.path.join(dist, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        if extension in COMPRESSIBLE:
+            _precompress(path, content)
+        manifest[name] = f"{DIST}/{hashed}"
+
+    with open(os.path.join(dist, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class _Asset:
+    def __init__(self, path):
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        # encoding -> (headers, body), None for the uncompressed file
+        self.variants = {}
+        for encoding, extension in (("br", ".br"), ("gzip", ".gz"), (None, "")):
+            if not os.path.exists(path + extension):
+                continue
+            with open(path + extension, "rb") as f:
+                body = f.read()
+            headers = [
+                ("Content-Type", content_type),
+                ("Content-Length", str(len(body))),
+                ("Cache-Control", CACHE_CONTROL),
+                ("Vary", "Accept-Encoding"),
+            ]
+            if encoding:
+                headers.append(("Content-Encoding", encoding))
+            self.variants[encoding] = (headers, body)
+
+    def variant(self, accept_encoding):
+        if len(self.variants) > 1 and accept_encoding:
+            accepted = parse_accept_header(accept_encoding)
+            for encoding in ("br", "gzip"):
+                if encoding in self.variants and accepted.quality(encoding) > 0:
+                    return self.variants[encoding]
+        return self.variants[None]
+
+
+class AssetMiddleware:
+    """Serves the hashed files before the request reaches Flask."""
+
+    def __init__(self, wsgi_app, assets):
+        self.wsgi_app = wsgi_app
+        self.assets = assets
+
+    def __call__(self, environ, start_response):
+        asset = self.assets.get(environ.get("PATH_INFO"))
+        if asset is None or environ["REQUEST_METHOD"] not in ("GET", "HEAD"):
+            return self.wsgi_app(environ, start_response)
+        headers, body = asset.variant(environ.get("HTTP_ACCEPT_ENCODING"))
+        start_response("200 OK", headers)
+        return [b""] if environ["REQUEST_METHOD"] == "HEAD" else [body]
+
+
+class StaticAssets:
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["static_assets"] = self
+
+        manifest_path = os.path.join(app.static_folder, DIST, MANIFEST)
+        if not app.config.get("STATIC_ASSETS", True) or not os.path.exists(
+            manifest_path
+        ):
+            return
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)
+        assets = {
+            f"{app.static_url_path}/{hashed}": _Asset(
+                os.path.join(app.static_folder, hashed)
+            )
+            for hashed in self.manifest.values()
+        }
+        app.url_defaults(self.hashed_filename)
+        app.wsgi_app = AssetMiddleware(app.wsgi_app, assets)
+
+    def hashed_filename(self, endpoint, values):
+        if endpoint == "static" and values.get("filename") in self.manifest:
+            values["filename"] = self.manifest[values["filename"]]
+
+
+static_assets = StaticAssets()
+
+
+if __name__ == "__main__":
+    folder = (
+        sys.argv[1]
+        if len(sys.argv) > 1
+        else os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+    )
+    built = build(folder)
+    print(f"Built {len(built)} assets in {os.path.join(folder, DIST)}")
+    if brotli is None:
+        print("brotli isn't installed, only gzip versions were written")
@@ -0,0 +1,175 @@
+"""Async versions of the login ceremonies, used by the ASGI entry point in `asgi.py`.
+
+Redis is reached through `redis.asyncio` and postgres through SQLAlchemy's asyncio
+extension (asyncpg), so a request waiting on either doesn't hold a thread. The only
+blocking work left, checking the assertion signature, is CPU bound and runs in a
+worker thread. The queries and caches are the same ones the sync views use, from
+`auth.security`.
+"""
+import asyncio
+import functools
+import os
+import random
+
+import webauthn
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+
+from auth import security, util
+from auth.challenges import (
+    AsyncMemoryChallengeStore,
+    AsyncRedisChallengeStore,
+    MemoryChallengeStore,
+    RedisChallengeStore,
+)
+from auth.connections import get_async_redis
+from auth.credential_usage import credential_usage, usage_update
+from auth.offload import OffloadBusy
+from auth.replicas import replicas
+from auth.user_cache import user_cache
+from models import WebAuthnCredential
+
+# Async drivers for the database urls the app is configured with, whichever driver
+# they name.
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+_engine = None
+_read_engines = None
+
+# Signed challenges live in the session, so asgi.py leaves those ceremonies to the
+# Flask views.
+if isinstance(security.AUTHENTICATION_CHALLENGES, MemoryChallengeStore):
+    AUTHENTICATION_CHALLENGES = AsyncMemoryChallengeStore(
+        security.AUTHENTICATION_CHALLENGES
+    )
+elif isinstance(security.AUTHENTICATION_CHALLENGES, RedisChallengeStore):
+    _namespace = security.AUTHENTICATION_CHALLENGES.namespace
+    AUTHENTICATION_CHALLENGES = AsyncRedisChallengeStore(
+        _namespace, functools.partial(get_async_redis, _namespace)
+    )
+else:
+    AUTHENTICATION_CHALLENGES = None
+
+
+def async_database_url(url):
+    scheme, rest = url.split("://", 1)
+    dialect = scheme.partition("+")[0]
+    return f"{_ASYNC_DRIVERS.get(dialect, scheme)}://{rest}"
+
+
+def _create_engine(url):
+    url = async_database_url(url)
+    options = {}
+    if not url.startswith("sqlite"):
+        options["pool_size"] = int(os.getenv("ASYNC_DB_POOL_SIZE", 10))
+    return create_async_engine(url, **options)
+
+
+def get_engine():
+    """The async engine, created on first use."""
+    global _engine
+    if _engine is None:
+        _engine = _create_engine(os.getenv("DATABASE_URL"))
+    return _engine
+
+
+def get_read_engine():
+    """An async engine for a replica if the current request may read from one (see
+    auth/replicas.py), otherwise the primary's."""
+    global _read_engines
+    if not replicas.use_replica():
+        return get_engine()
+    if _read_engines is None:
+        _read_engines = [_create_engine(url) for url in replicas.urls]
+    return random.choice(_read_engines)
+
+
+async def dispose():
+    global _engine, _read_engines
+    for engine in [_engine, *(_read_engines or ())]:
+        if engine is not None:
+            await engine.dispose()
+    _engine = None
+    _read_engines = None
+
+
+async def load_login_user(username_or_email=None, uid=None):
+    """Async `security.load_login_user`."""
+    if uid is not None and (user := security.cached_login_user(uid)):
+        return user
+    async with get_read_engine().connect() as connection:
+        result = await connection.execute(
+            security.login_user_query(username_or_email=username_or_email, uid=uid)
+        )
+        return security.remember_login_user(result.all())
+
+
+async def load_user(user_uid):
+    """Async `user_cache.load_user`."""
+    if not user_uid:
+        return None
+    if user := user_cache.load_cached(user_uid):
+        return user
+    return await load_login_user(uid=user_uid)
+
+
+async def prepare_login_with_credential(user, hostname):
+    """Async `security.prepare_login_with_credential`."""
+    descriptors = security.CREDENTIAL_DESCRIPTORS.get(user.uid)
+    if descriptors is None:
+        async with get_read_engine().connect() as connection:
+            result = await connection.execute(
+                security.credential_descriptors_query(user)
+            )
+            descriptors = security.cache_credential_descriptors(user, result.scalars())
+
+    authentication_options = security.generate_login_options(hostname, descriptors)
+    await AUTHENTICATION_CHALLENGES.put(
+        user.uid, authentication_options.challenge, security.CHALLENGE_TTL
+    )
+    return util.options_json(authentication_options)
+
+
+async def verify_authentication_credential(user, authentication_credential, hostname):
+    """Async `security.verify_authentication_credential`."""
+    expected_challenge = await AUTHENTICATION_CHALLENGES.consume(user.uid)
+    async with get_read_engine().connect() as connection:
+        result = await connection.execute(
+            select(
+                WebAuthnCredential.id, WebAuthnCredential.credential_public_key
+            ).where(
+                WebAuthnCredential.user_id == user.id,
+                WebAuthnCredential.credential_id
+                == webauthn.base64url_to_bytes(authentication_credential.id),
+            )
+        )
+        stored_credential = result.first()
+    if not stored_credential:
+        raise InvalidAuthenticationResponse("Unknown credential")
+
+    try:
+        await asyncio.to_thread(
+            security.verify_assertion,
+            authentication_credential,
+            expected_challenge,
+            hostname,
+            stored_credential.credential_public_key,
+        )
+    except OffloadBusy:
+        # As `security.restored_on_busy`, so the retry after the 503 can succeed.
+        if expected_challenge is not None:
+            await AUTHENTICATION_CHALLENGES.put(
+                user.uid, expected_challenge, security.CHALLENGE_TTL
+            )
+        raise
+
+    if credential_usage.write_behind:
+        credential_usage.buffer(stored_credential.id)
+        return
+    async with get_engine().begin() as connection:
+        await connection.execute(usage_update(stored_credential.id))
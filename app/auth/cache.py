@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+class TTLCache:
+    """A small thread safe LRU cache where entries also expire after `ttl` seconds.
+
+    Keeps hit and miss counts so the caches built on it can be monitored.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry and entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return dict(
+            size=len(self._entries),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+
+def _lookups_counter():
+    return CounterMetricFamily(
+        "cache_lookups",
+        "Cache lookups by result. redis_hit counts misses answered from redis.",
+        labels=["cache", "result"],
+    )
+
+
+def _entries_gauge():
+    return GaugeMetricFamily(
+        "cache_entries",
+        "Entries in each cache, and how many fit.",
+        labels=["cache", "state"],
+    )
+
+
+class CacheCollector:
+    """Prometheus collector for the caches added with `add`, served at /metrics."""
+
+    def __init__(self):
+        self._caches = {}
+
+    def add(self, name, stats):
+        """`stats` returns counts like `TTLCache.stats`, with `redis_hits` too for a
+        cache with a redis tier."""
+        self._caches[name] = stats
+
+    def describe(self):
+        return [_lookups_counter(), _entries_gauge()]
+
+    def collect(self):
+        lookups, entries = _lookups_counter(), _entries_gauge()
+        for name, stats in list(self._caches.items()):
+            stats = stats()
+            lookups.add_metric([name, "hit"], stats["hits"])
+            lookups.add_metric([name, "miss"], stats["misses"])
+            if "redis_hits" in stats:
+                lookups.add_metric([name, "redis_hit"], stats["redis_hits"])
+            entries.add_metric([name, "size"], stats["size"])
+            entries.add_metric([name, "maxsize"], stats["maxsize"])
+        yield lookups
+        yield entries
+
+
+cache_collector = CacheCollector()
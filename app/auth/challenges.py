@@ -0,0 +1,210 @@
+import base64
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from flask import current_app, session
+from itsdangerous import BadSignature, URLSafeSerializer
+from redis.exceptions import ResponseError
+
+
+class ChallengeStore(ABC):
+    """Short-lived, single-use storage for ceremony state (WebAuthn challenges and
+    magic link hashes).
+
+    Values are written once with a time to live and read back exactly once: `consume`
+    returns the value and removes it in the same operation, so a challenge can never
+    be replayed.
+    """
+
+    @abstractmethod
+    def put(self, key, value, ttl):
+        """Store `value` under `key`, replacing anything already there. `ttl` is a
+        timedelta."""
+
+    @abstractmethod
+    def consume(self, key):
+        """Atomically fetch and delete the value stored under `key`. Returns None if
+        there is no value or it has expired."""
+
+
+# Fallback for Redis servers older than 6.2 which don't have GETDEL. The script runs
+# atomically on the server, so it is still a single round trip.
+_GETDEL_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('DEL', KEYS[1])
+end
+return value
+"""
+
+
+class RedisChallengeStore(ChallengeStore):
+    """Challenge store backed by redis. Each operation is one round trip.
+
+    All keys are prefixed with `namespace`, so several stores can share one database
+    and one connection pool. The rest of the key is a hash tag, so the state of one
+    user in every store lands on the same node of a cluster. `get_client` is called
+    for every operation so the client can be created lazily (see `auth.connections`).
+    """
+
+    def __init__(self, namespace, get_client):
+        self.namespace = namespace
+        self.get_client = get_client
+        self._use_getdel = True
+        self._getdel_script = None
+
+    def _key(self, key):
+        return f"{self.namespace}:{{{key}}}"
+
+    def put(self, key, value, ttl):
+        self.get_client().set(self._key(key), value, ex=ttl)
+
+    def consume(self, key):
+        client = self.get_client()
+        if self._use_getdel:
+            try:
+                return client.getdel(self._key(key))
+            except ResponseError as error:
+                # Anything else, like READONLY during a failover or OOM, isn't about
+                # the server's version.
+                if "unknown command" not in str(error).lower():
+                    raise
+                # The server is too old. Remember that and use the script from now
+                # on.
+                self._use_getdel = False
+        if self._getdel_script is None:
+            self._getdel_script = client.register_script(_GETDEL_SCRIPT)
+        return self._getdel_script(keys=[self._key(key)], client=client)
+
+
+class MemoryChallengeStore(ChallengeStore):
+    """Challenge store that keeps everything in process memory. Only suitable for a
+    single process (local development, tests or a single node deployment)."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self._next_purge = 0
+
+    def put(self, key, value, ttl):
+        expires_at = time.monotonic() + ttl.total_seconds()
+        with self._lock:
+            self._purge_expired()
+            self._values[key] = (value, expires_at)
+
+    def consume(self, key):
+        with self._lock:
+            value, expires_at = self._values.pop(key, (None, 0))
+        if expires_at < time.monotonic():
+            return None
+        return value
+
+    def _purge_expired(self):
+        # Consumed values are removed right away, this only cleans up abandoned
+        # ceremonies, so there's no need to do it on every write.
+        now = time.monotonic()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + 60
+        for key in [k for k, (_, exp) in self._values.items() if exp < now]:
+            del self._values[key]
+
+
+class SignedChallengeStore(ChallengeStore):
+    """Challenge store without server side state. Each value goes into a token, signed
+    with the app's secret key together with its key and expiry time, that's kept in
+    the Flask session until it's consumed. The token is signed on its own, so it
+    can't be forged or moved to another key whatever the session is stored in.
+
+    The session keeps one token per namespace and key, so concurrent ceremonies on
+    different devices (with their own sessions) don't overwrite each other. An old
+    copy of the session could still bring a consumed token back, so `replay_cache`
+    (see auth/replay_cache.py) remembers which tokens have been used.
+
+    Like redis, `consume` returns bytes.
+    """
+
+    SESSION_KEY = "_challenges"
+    # Tokens kept in the session at once, the ones closest to expiring go first.
+    MAX_PENDING = 8
+
+    def __init__(self, namespace, replay_cache):
+        self.namespace = namespace
+        self.replay_cache = replay_cache
+
+    def _serializer(self):
+        return URLSafeSerializer(
+            current_app.config["SECRET_KEY"], salt=f"challenge:{self.namespace}"
+        )
+
+    def put(self, key, value, ttl):
+        if isinstance(value, str):
+            value = value.encode()
+        now = time.time()
+        expires_at = now + ttl.total_seconds()
+        token = self._serializer().dumps(
+            [key, base64.urlsafe_b64encode(value).decode(), expires_at]
+        )
+        pending = {
+            slot: entry
+            for slot, entry in session.get(self.SESSION_KEY, {}).items()
+            if entry[1] > now
+        }
+        pending[f"{self.namespace}:{key}"] = [token, expires_at]
+        if len(pending) > self.MAX_PENDING:
+            newest = sorted(pending.items(), key=lambda item: item[1][1])
+            pending = dict(newest[-self.MAX_PENDING :])
+        session[self.SESSION_KEY] = pending
+
+    def consume(self, key):
+        pending = dict(session.get(self.SESSION_KEY, {}))
+        entry = pending.pop(f"{self.namespace}:{key}", None)
+        if entry is None:
+            return None
+        session[self.SESSION_KEY] = pending
+
+        token = entry[0]
+        try:
+            token_key, value, expires_at = self._serializer().loads(token)
+        except BadSignature:
+            return None
+        if token_key != key or expires_at < time.time():
+            return None
+        if not self.replay_cache.add(token.encode()):
+            return None
+        return base64.urlsafe_b64decode(value)
+
+
+class AsyncRedisChallengeStore:
+    """The async version of `RedisChallengeStore`, for `redis.asyncio` clients. Uses
+    the same key names, so both can be used against the same data."""
+
+    def __init__(self, namespace, get_client):
+        self.namespace = namespace
+        self.get_client = get_client
+
+    def _key(self, key):
+        return f"{self.namespace}:{{{key}}}"
+
+    async def put(self, key, value, ttl):
+        await self.get_client().set(self._key(key), value, ex=ttl)
+
+    async def consume(self, key):
+        # Redis 6.2 is assumed here, the async views are new enough not to need the
+        # script fallback.
+        return await self.get_client().getdel(self._key(key))
+
+
+class AsyncMemoryChallengeStore:
+    """Async wrapper for a `MemoryChallengeStore`. Nothing in it blocks, so it's
+    safe to call straight from the event loop."""
+
+    def __init__(self, store):
+        self.store = store
+
+    async def put(self, key, value, ttl):
+        self.store.put(key, value, ttl)
+
+    async def consume(self, key):
+        return self.store.consume(key)
@@ -0,0 +1,394 @@
+"""Shared redis connections.
+
+Everything that talks to redis shares one client, with its connection pool, per
+backend and process. The clients are created the first time they're needed rather
+than at import, so a server that imports the app and then forks workers never
+shares sockets between processes. Different kinds of data are kept apart with key
+prefixes instead of separate logical databases.
+
+REDIS_URL, or REDIS_HOST, REDIS_PORT, REDIS_PASSWORD and REDIS_DB, is the redis
+used by default. Any of the `KEY_SPACES` can be moved to a backend of its own with
+REDIS_URL_<SPACE>, e.g. REDIS_URL_EMAIL_AUTH for the magic link secrets. Key spaces
+with the same url share a client. Besides redis://, rediss:// and unix:// urls:
+
+    redis+sentinel://[:password@]host:26379,host2:26379/service-name[/db]
+        The master of a Sentinel managed group. It's looked up through the
+        sentinels, and looked up again when it stops answering as the master.
+        REDIS_SENTINEL_PASSWORD is the password of the sentinels themselves.
+    redis+cluster://[:password@]host:6379,host2:6379
+        A Redis Cluster, given some of its nodes to discover the rest from.
+
+Keys that have to be in one place for a command or script share a hash tag, e.g.
+the ceremony state of a user is kept under `registration:{uid}`, so on a cluster
+each user's state stays on one shard.
+
+A command that fails because redis can't be reached is retried up to REDIS_RETRIES
+(3) times on a new connection, waiting REDIS_RETRY_BACKOFF_BASE seconds (0.1) before
+the first retry and twice as long before each next one, up to
+REDIS_RETRY_BACKOFF_CAP (2). That carries commands over a restart or a Sentinel
+failover. Timeouts aren't retried, the command may have run already.
+Cluster clients retry with the cluster's own topology refresh instead. Commands sent
+inside `without_retries` get one attempt, for callers that would rather go on
+without redis than wait for it.
+`benchmarks/redis_failover.py` tries all of this against local redis processes.
+
+`pool_stats` has the connection counts of each backend's pools, and they're exported
+as the `redis_pool_connections` gauge at /metrics, for the process that answers.
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+from urllib.parse import unquote, urlparse
+
+from prometheus_client.core import GaugeMetricFamily
+from redis import BlockingConnectionPool, Redis
+from redis.backoff import ExponentialBackoff
+from redis.cluster import ClusterNode, RedisCluster
+from redis.exceptions import ConnectionError
+from redis.sentinel import Sentinel
+
+from auth.metrics import timed
+
+KEY_SPACES = (
+    "registration",
+    "authentication",
+    "email-auth",
+    "used-challenges",
+    "ratelimit",
+    "user",
+)
+
+_lock = threading.Lock()
+# url -> client, for the process in _clients_pid
+_clients = {}
+_clients_pid = None
+_async_clients = {}
+_async_clients_pid = None
+# False inside `without_retries`. A context variable, so it holds for the thread or
+# the asyncio task that set it.
+_retrying = contextvars.ContextVar("redis_retrying", default=True)
+
+
+def _float_env(name, default):
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _retries():
+    return int(os.getenv("REDIS_RETRIES", 3))
+
+
+def _backoff():
+    return ExponentialBackoff(
+        cap=_float_env("REDIS_RETRY_BACKOFF_CAP", 2),
+        base=_float_env("REDIS_RETRY_BACKOFF_BASE", 0.1),
+    )
+
+
+@contextmanager
+def without_retries():
+    """Send the commands in the block once, a connection error is raised straight
+    away instead of being retried."""
+    token = _retrying.set(False)
+    try:
+        yield
+    finally:
+        _retrying.reset(token)
+
+
+def _retried(call):
+    # redis-py 4.3 only retries commands on connections that were already open, and
+    # its async clients not even those, so this covers reconnecting too.
+    backoff = _backoff()
+    failures = 0
+    while True:
+        try:
+            return call()
+        except ConnectionError:
+            if failures >= _retries() or not _retrying.get():
+                raise
+            time.sleep(backoff.compute(failures))
+            failures += 1
+
+
+async def _async_retried(call):
+    backoff = _backoff()
+    failures = 0
+    while True:
+        try:
+            return await call()
+        except ConnectionError:
+            if failures >= _retries() or not _retrying.get():
+                raise
+            await asyncio.sleep(backoff.compute(failures))
+            failures += 1
+
+
+def _connection_options():
+    return dict(
+        socket_timeout=_float_env("REDIS_SOCKET_TIMEOUT", 5),
+        socket_connect_timeout=_float_env("REDIS_SOCKET_CONNECT_TIMEOUT", 5),
+        health_check_interval=int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+        max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 10)),
+    )
+
+
+def _pool_options():
+    return dict(
+        _connection_options(),
+        # How long to wait for a free connection when all of them are in use.
+        timeout=_float_env("REDIS_POOL_TIMEOUT", 5),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def redis_url(space=None):
+    """The url of the redis that holds `space`, None for the REDIS_HOST settings."""
+    if space is not None:
+        if url := os.getenv(f"REDIS_URL_{space.upper().replace('-', '_')}"):
+            return url
+    return os.getenv("REDIS_URL")
+
+
+def _parse_nodes(url, default_port):
+    """Split a sentinel or cluster url into its credentials, nodes and path."""
+    parsed = urlparse(url)
+    nodes = []
+    for node in parsed.netloc.rpartition("@")[2].split(","):
+        host, _, port = node.partition(":")
+        nodes.append((host, int(port or default_port)))
+    return dict(
+        username=unquote(parsed.username) if parsed.username else None,
+        password=unquote(parsed.password) if parsed.password else None,
+        nodes=nodes,
+        path=[part for part in parsed.path.split("/") if part],
+    )
+
+
+def _create_client(url, lib):
+    scheme = urlparse(url).scheme if url else "redis"
+    if scheme == "redis+sentinel":
+        parts = _parse_nodes(url, 26379)
+        options = _connection_options()
+        sentinel = lib.Sentinel(
+            parts["nodes"],
+            sentinel_kwargs=dict(
+                socket_timeout=options["socket_timeout"],
+                socket_connect_timeout=options["socket_connect_timeout"],
+                password=os.getenv("REDIS_SENTINEL_PASSWORD"),
+            ),
+        )
+        return sentinel.master_for(
+            parts["path"][0],
+            redis_class=lib.Redis,
+            db=int(parts["path"][1]) if len(parts["path"]) > 1 else 0,
+            username=parts["username"],
+            password=parts["password"],
+            **options,
+        )
+    if scheme == "redis+cluster":
+        parts = _parse_nodes(url, 6379)
+        return lib.RedisCluster(
+            startup_nodes=[lib.ClusterNode(*node) for node in parts["nodes"]],
+            username=parts["username"],
+            password=parts["password"],
+            cluster_error_retry_attempts=_retries(),
+            **_connection_options(),
+        )
+    options = _pool_options()
+    if url:
+        pool = lib.BlockingConnectionPool.from_url(url, **options)
+        return lib.Redis(connection_pool=pool)
+    return lib.Redis(
+        connection_pool=lib.BlockingConnectionPool(
+            host=os.getenv("REDIS_HOST", "localhost"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            password=os.getenv("REDIS_PASSWORD"),
+            db=int(os.getenv("REDIS_DB", 0)),
+            **options,
+        )
+    )
+
+
+class TimedRedis(Redis):
+    """A client that times each command for auth.metrics."""
+
+    def execute_command(self, *args, **options):
+        with timed("redis"):
+            call = functools.partial(super().execute_command, *args, **options)
+            return _retried(call)
+
+
+class TimedRedisCluster(RedisCluster):
+    def execute_command(self, *args, **options):
+        with timed("redis"):
+            return super().execute_command(*args, **options)
+
+
+_SYNC = SimpleNamespace(
+    Redis=TimedRedis,
+    BlockingConnectionPool=BlockingConnectionPool,
+    Sentinel=Sentinel,
+    RedisCluster=TimedRedisCluster,
+    ClusterNode=ClusterNode,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _async_redis():
+    # Only the ASGI app uses redis.asyncio, so it isn't imported until then.
+    import redis.asyncio
+    import redis.asyncio.cluster
+    import redis.asyncio.sentinel
+
+    class TimedAsyncRedis(redis.asyncio.Redis):
+        async def execute_command(self, *args, **options):
+            with timed("redis"):
+                call = functools.partial(super().execute_command, *args, **options)
+                return await _async_retried(call)
+
+    class TimedAsyncRedisCluster(redis.asyncio.cluster.RedisCluster):
+        async def execute_command(self, *args, **options):
+            with timed("redis"):
+                return await super().execute_command(*args, **options)
+
+    return SimpleNamespace(
+        Redis=TimedAsyncRedis,
+        BlockingConnectionPool=redis.asyncio.BlockingConnectionPool,
+        Sentinel=redis.asyncio.sentinel.Sentinel,
+        RedisCluster=TimedAsyncRedisCluster,
+        ClusterNode=redis.asyncio.cluster.ClusterNode,
+    )
+
+
+def get_redis(space=None):
+    """Get the redis client for `space`, one of `KEY_SPACES`, creating it if
+    needed. Clients are thread safe and shared, the connections belong to their
+    pool."""
+    global _clients, _clients_pid
+    url = redis_url(space)
+    pid = os.getpid()
+    if _clients_pid != pid or url not in _clients:
+        with _lock:
+            if _clients_pid != pid:
+                _clients = {}
+                _clients_pid = pid
+            if url not in _clients:
+                _clients[url] = _create_client(url, _SYNC)
+    return _clients[url]
+
+
+def get_async_redis(space=None):
+    """Get a `redis.asyncio` client for `space`, for the async views. They have their
+    own pools with the same settings, since async connections can't be shared with
+    threads. They must only be used from one event loop."""
+    global _async_clients, _async_clients_pid
+    url = redis_url(space)
+    pid = os.getpid()
+    if _async_clients_pid != pid:
+        _async_clients = {}
+        _async_clients_pid = pid
+    if url not in _async_clients:
+        _async_clients[url] = _create_client(url, _async_redis())
+    return _async_clients[url]
+
+
+def client_for(space):
+    """A function returning the client for `space`, for the stores that call one
+    for every operation."""
+    return functools.partial(get_redis, space)
+
+
+def _client_pools(client):
+    if isinstance(client, RedisCluster):
+        return [
+            node.redis_connection.connection_pool
+            for node in client.get_nodes()
+            if node.redis_connection is not None
+        ]
+    return [client.connection_pool]
+
+
+def get_pools(space=None):
+    """The connection pools of the client for `space`, one for each node of a
+    cluster."""
+    return _client_pools(get_redis(space))
+
+
+def reset():
+    """Throw away the clients. Meant to be called in a freshly forked worker, the
+    next call to `get_redis` will create new ones."""
+    global _clients, _clients_pid, _async_clients, _async_clients_pid
+    with _lock:
+        _clients = {}
+        _clients_pid = None
+        _async_clients = {}
+        _async_clients_pid = None
+
+
+def _pool_stats(pool):
+    if isinstance(pool, BlockingConnectionPool):
+        # The blocking pool keeps idle connections in a queue padded with None for
+        # connections that haven't been created yet.
+        available = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        created = len(pool._connections)
+    else:
+        available = len(pool._available_connections)
+        created = pool._created_connections
+    return dict(
+        max_connections=pool.max_connections,
+        created=created,
+        in_use=created - available,
+        available=available,
+    )
+
+
+def _client_stats(client):
+    # Added up over the nodes of a cluster.
+    stats = dict(max_connections=0, created=0, in_use=0, available=0)
+    for pool in _client_pools(client):
+        for name, value in _pool_stats(pool).items():
+            stats[name] += value
+    return stats
+
+
+def pool_stats(space=None):
+    """Connection counts for the pool of `space`, useful for sizing redis
+    `maxclients` against the number of workers."""
+    client = _clients.get(redis_url(space)) if _clients_pid == os.getpid() else None
+    if client is None:
+        return dict(max_connections=0, created=0, in_use=0, available=0)
+    return _client_stats(client)
+
+
+def _connections_gauge():
+    return GaugeMetricFamily(
+        "redis_pool_connections",
+        "Redis pool sizes and connections by state.",
+        labels=["backend", "state"],
+    )
+
+
+class PoolCollector:
+    """Prometheus collector for the pools of the clients this process has created.
+    Each backend is labelled with the key spaces it holds."""
+
+    def describe(self):
+        return [_connections_gauge()]
+
+    def collect(self):
+        connections = _connections_gauge()
+        clients = dict(_clients) if _clients_pid == os.getpid() else {}
+        for url, client in clients.items():
+            backend = ",".join(space for space in KEY_SPACES if redis_url(space) == url)
+            for state, value in _client_stats(client).items():
+                connections.add_metric([backend or "default", state], value)
+        yield connections
+
+
+pool_collector = PoolCollector()
@@ -0,0 +1,218 @@
+"""Recording that a credential was used to log in.
+
+Each login bumps the credential's sign count and sets its last used time. By default
+that is one atomic `UPDATE ... RETURNING`, so concurrent logins with the same
+credential can't lose an increment the way loading, adding one and saving back could.
+
+With CREDENTIAL_WRITE_BEHIND set, logins don't write at all. Uses are added up in
+memory per credential and a background thread writes them to `web_authn_credential`
+in one batched statement every CREDENTIAL_FLUSH_INTERVAL seconds, or sooner once
+CREDENTIAL_FLUSH_BATCH credentials are waiting. Login latency then doesn't depend on
+the database commit. The cost is that a process that dies without flushing loses up
+to one interval of usage data, which is only kept for reference anyway. The
+buffered uses are exported at /metrics as `credential_uses_total` by state,
+`credential_usage_flushes_total` by result and `credential_uses_pending`.
+"""
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import bindparam, func, update
+
+from auth.metrics import metrics, observe, timed
+from models import WebAuthnCredential, db
+
+logger = logging.getLogger(__name__)
+
+
+def usage_update(credential_pk, uses=1, used_at=None):
+    """The statement adding `uses` to a credential's sign count."""
+    return (
+        update(WebAuthnCredential)
+        .where(WebAuthnCredential.id == credential_pk)
+        .values(
+            current_sign_count=func.coalesce(WebAuthnCredential.current_sign_count, 0)
+            + uses,
+            last_used_at=used_at or datetime.datetime.utcnow(),
+        )
+    )
+
+
+def _batch_update():
+    return (
+        update(WebAuthnCredential)
+        .where(WebAuthnCredential.id == bindparam("pk"))
+        .values(
+            current_sign_count=func.coalesce(WebAuthnCredential.current_sign_count, 0)
+            + bindparam("uses"),
+            last_used_at=bindparam("used_at"),
+        )
+    )
+
+
+def _uses_counter():
+    return CounterMetricFamily(
+        "credential_uses",
+        "Credential uses buffered for writing and written.",
+        labels=["state"],
+    )
+
+
+def _flushes_counter():
+    return CounterMetricFamily(
+        "credential_usage_flushes",
+        "Batches of buffered uses written and failed.",
+        labels=["result"],
+    )
+
+
+def _pending_gauge():
+    return GaugeMetricFamily(
+        "credential_uses_pending", "Credentials with buffered uses to write."
+    )
+
+
+class CredentialUsage:
+    def __init__(self, app=None):
+        self.app = None
+        self.write_behind = False
+        self.flush_interval = 1.0
+        self.flush_batch = 500
+        # credential primary key -> [uses, last used at]
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker_pid = None
+        self._stats_lock = threading.Lock()
+        self._stats = dict(recorded=0, flushed=0, batches=0, failures=0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.write_behind = app.config.get("CREDENTIAL_WRITE_BEHIND", False)
+        self.flush_interval = app.config.get("CREDENTIAL_FLUSH_INTERVAL", 1.0)
+        self.flush_batch = app.config.get("CREDENTIAL_FLUSH_BATCH", 500)
+        metrics.add_collector(self)
+        app.extensions["credential_usage"] = self
+
+    def record(self, credential_pk):
+        """Record a login with the credential. Returns the new sign count, or None
+        when it's buffered or the database can't return it."""
+        if self.write_behind:
+            self.buffer(credential_pk)
+            return None
+
+        statement = usage_update(credential_pk)
+        returning = db.engine.dialect.full_returning
+        if returning:
+            statement = statement.returning(WebAuthnCredential.current_sign_count)
+        result = db.session.execute(statement)
+        sign_count = result.scalar() if returning else None
+        with timed("commit"):
+            db.session.commit()
+        return sign_count
+
+    def buffer(self, credential_pk, uses=1, used_at=None):
+        """Add a use to the write-behind buffer. Safe to call from async code, it
+        never waits on the database."""
+        self._ensure_worker()
+        used_at = used_at or datetime.datetime.utcnow()
+        with self._lock:
+            entry = self._pending.setdefault(credential_pk, [0, used_at])
+            entry[0] += uses
+            entry[1] = max(entry[1], used_at)
+            pending = len(self._pending)
+        with self._stats_lock:
+            self._stats["recorded"] += uses
+        if pending >= self.flush_batch:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything buffered so far to the database."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        started = time.monotonic()
+        try:
+            with db.get_engine(self.app).begin() as connection:
+                connection.execute(
+                    _batch_update(),
+                    [
+                        dict(pk=pk, uses=uses, used_at=used_at)
+                        for pk, (uses, used_at) in pending.items()
+                    ],
+                )
+        except Exception:
+            logger.warning("Writing credential usage failed", exc_info=True)
+            with self._stats_lock:
+                self._stats["failures"] += 1
+            # Put it back to go out with the next batch.
+            with self._lock:
+                for pk, (uses, used_at) in pending.items():
+                    entry = self._pending.setdefault(pk, [0, used_at])
+                    entry[0] += uses
+                    entry[1] = max(entry[1], used_at)
+            return
+        observe("usage_flush", time.monotonic() - started)
+        with self._stats_lock:
+            self._stats["flushed"] += sum(uses for uses, _ in pending.values())
+            self._stats["batches"] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        return stats
+
+    def describe(self):
+        return [_uses_counter(), _flushes_counter(), _pending_gauge()]
+
+    def collect(self):
+        """Prometheus collector for the counts in `stats`."""
+        stats = self.stats()
+        uses = _uses_counter()
+        uses.add_metric(["recorded"], stats["recorded"])
+        uses.add_metric(["flushed"], stats["flushed"])
+        yield uses
+        flushes = _flushes_counter()
+        flushes.add_metric(["written"], stats["batches"])
+        flushes.add_metric(["failed"], stats["failures"])
+        yield flushes
+        pending = _pending_gauge()
+        pending.add_metric([], stats["pending"])
+        yield pending
+
+    def _ensure_worker(self):
+        # Like the mailer, the thread is started by whichever process records uses.
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._pending = {}
+            threading.Thread(
+                target=self._run, name="credential-usage", daemon=True
+            ).start()
+            self._worker_pid = pid
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+credential_usage = CredentialUsage()
+
+
+@atexit.register
+def _flush_on_exit():
+    if credential_usage._worker_pid == os.getpid():
+        credential_usage.flush()
@@ -0,0 +1,371 @@
+"""The authentication event log.
+
+Registrations, added credentials, logins by WebAuthn, passkey or magic link and
+failed attempts are kept in the append only `auth_event` table as an audit trail.
+Writing a row from the views would add a commit to every login, so `record` only adds
+the event to an in-process buffer. A background thread writes what's buffered every
+AUTH_EVENTS_FLUSH_INTERVAL seconds, or sooner once AUTH_EVENTS_FLUSH_BATCH events are
+waiting, in one transaction: a COPY on postgres with psycopg2, an executemany INSERT
+(which psycopg2 sends as multi-row INSERTs) elsewhere. Whatever is still buffered is
+written when the process exits. waitress leaves SIGTERM, and so `docker stop`, to
+kill the process without running exit handlers, so `create_warm_app` installs
+`exit_on_sigterm` to write the buffer first. gunicorn workers exit cleanly on their
+own.
+
+The buffer holds at most AUTH_EVENTS_MAX_PENDING events. If the database falls behind
+or is down, events that don't fit are dropped and counted rather than letting memory
+grow. Nothing else is dropped while the database can't be reached: the batch is kept
+whole and retried, backing off up to a minute between attempts. When the database
+rejects the rows themselves (a data, integrity or programming error) the batch is
+retried too, and once it has been rejected AUTH_EVENTS_MAX_ATTEMPTS times in a row
+it's split in half and the halves are written on their own, so one bad row only
+holds up the rest for a while. An event rejected that many times by itself is logged
+and dropped. `stats()` has the counts, and they're exported at /metrics as
+`auth_events_total` by state, for the process that answers.
+
+On postgres the table is partitioned by month. The partition for a month is created
+when its first events are written, and old months can be dropped whole instead of
+deleting rows:
+
+    flask events prune --keep-months 12
+"""
+import atexit
+import datetime
+import logging
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import uuid
+
+import click
+from flask import has_request_context, request
+from flask.cli import AppGroup
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import exc, insert, text
+
+from auth.metrics import metrics, observe
+from auth.pg_copy import copy_rows
+from models import AuthEvent, db
+
+logger = logging.getLogger(__name__)
+
+cli = AppGroup("events", help="The authentication event log.")
+
+COLUMNS = [column.name for column in AuthEvent.__table__.columns]
+
+_PARTITION_NAME = re.compile(rf"{AuthEvent.__tablename__}_(\d{{4}})_(\d{{2}})$")
+
+# Longest wait between attempts while the database can't be reached, in seconds.
+_MAX_BACKOFF = 60
+
+
+def _rejects_rows(error, dbapi):
+    """Whether `error` is the database refusing the rows, rather than it being
+    unreachable or going away."""
+    if isinstance(error, exc.DBAPIError):
+        return not error.connection_invalidated and isinstance(
+            error, (exc.DataError, exc.IntegrityError, exc.ProgrammingError)
+        )
+    # COPY goes through the DBAPI cursor, so its errors aren't wrapped. psycopg2
+    # raises ValueError for a string with a NUL in it before sending anything.
+    return isinstance(
+        error,
+        (dbapi.DataError, dbapi.IntegrityError, dbapi.ProgrammingError, ValueError),
+    )
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def _create_partition(connection, month):
+    table = AuthEvent.__tablename__
+    connection.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {table}_{month:%Y_%m} PARTITION OF {table}"
+            f" FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')"
+        )
+    )
+
+
+def _events_counter():
+    return CounterMetricFamily(
+        "auth_events",
+        "Authentication events recorded, written and dropped.",
+        labels=["state"],
+    )
+
+
+def _pending_gauge():
+    return GaugeMetricFamily(
+        "auth_events_pending", "Authentication events waiting to be written."
+    )
+
+
+class AuthEvents:
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = True
+        self.flush_interval = 1.0
+        self.flush_batch = 500
+        self.max_pending = 10000
+        self.max_attempts = 3
+        self._pending = []
+        # The events at the front of `_pending` from a batch that failed, the most
+        # to write at once while there are any, and the rejections of that batch.
+        self._suspect = 0
+        self._batch_limit = None
+        self._attempts = 0
+        # Seconds to wait after the database couldn't be reached, and until when.
+        self._backoff = 0
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        # Held while writing, the worker and the exit handlers can both flush.
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker_pid = None
+        # First days of the months with a partition, on postgres.
+        self._partitions = set()
+        self._stats_lock = threading.Lock()
+        self._stats = dict(recorded=0, written=0, dropped=0, batches=0, failures=0)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("AUTH_EVENTS", True)
+        self.flush_interval = app.config.get("AUTH_EVENTS_FLUSH_INTERVAL", 1.0)
+        self.flush_batch = app.config.get("AUTH_EVENTS_FLUSH_BATCH", 500)
+        self.max_pending = app.config.get("AUTH_EVENTS_MAX_PENDING", 10000)
+        self.max_attempts = app.config.get("AUTH_EVENTS_MAX_ATTEMPTS", 3)
+        metrics.add_collector(self)
+        app.extensions["auth_events"] = self
+
+    def record(
+        self,
+        event,
+        user=None,
+        method=None,
+        credential_id=None,
+        detail=None,
+        remote_addr=None,
+    ):
+        """Add an event to the buffer. `user` is a user or their uid. The client
+        address is taken from the current request unless `remote_addr` is given.
+        Never waits on the database, so it's safe to call from async code."""
+        if not self.enabled:
+            return
+        self._ensure_worker()
+        if remote_addr is None and has_request_context():
+            remote_addr = request.remote_addr
+        row = dict(
+            id=str(uuid.uuid4()),
+            created_at=datetime.datetime.utcnow(),
+            event=event,
+            method=method,
+            user_uid=getattr(user, "uid", user),
+            credential_id=credential_id,
+            remote_addr=remote_addr,
+            detail=detail and detail[:255],
+        )
+        with self._lock:
+            dropped = len(self._pending) >= self.max_pending
+            if not dropped:
+                self._pending.append(row)
+                pending = len(self._pending)
+        with self._stats_lock:
+            self._stats["dropped" if dropped else "recorded"] += 1
+        if not dropped and pending >= self.flush_batch:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything buffered so far to the database, or the next part of a
+        batch that failed. Returns True if there's more of that batch to write."""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            size = self._batch_limit or len(self._pending)
+            pending, self._pending = self._pending[:size], self._pending[size:]
+            suspect = max(self._suspect - len(pending), 0)
+        if not pending:
+            return False
+        started = time.monotonic()
+        engine = db.get_engine(self.app)
+        try:
+            with engine.begin() as connection:
+                created = self._write(connection, pending)
+        except Exception as error:
+            logger.warning("Writing auth events failed", exc_info=True)
+            self._failed(pending, suspect, _rejects_rows(error, engine.dialect.dbapi))
+            return False
+        # Only once committed, DDL is rolled back with the rest on postgres.
+        self._partitions.update(created)
+        with self._lock:
+            self._attempts = 0
+            self._backoff = 0
+            self._suspect = suspect
+            if not suspect:
+                self._batch_limit = None
+            elif self._batch_limit:
+                # Grow back once past the row that failed.
+                self._batch_limit *= 2
+        observe("events_flush", time.monotonic() - started)
+        with self._stats_lock:
+            self._stats["written"] += len(pending)
+            self._stats["batches"] += 1
+        return bool(suspect)
+
+    def _failed(self, pending, suspect, rows_rejected):
+        rejected = []
+        with self._lock:
+            if not rows_rejected:
+                # Keep the batch whole and give the database time to come back.
+                self._backoff = min(
+                    max(self._backoff * 2, self.flush_interval), _MAX_BACKOFF
+                )
+                self._retry_at = time.monotonic() + self._backoff
+            else:
+                self._attempts += 1
+            if self._attempts >= self.max_attempts:
+                self._attempts = 0
+                if len(pending) == 1:
+                    rejected, pending = pending, []
+                else:
+                    self._batch_limit = len(pending) // 2
+            # Put them back ahead of the newer ones, as many as there's room for.
+            room = max(self.max_pending - len(self._pending), 0)
+            self._pending[:0] = pending[:room]
+            self._suspect = min(len(pending), room) + suspect
+        for row in rejected:
+            logger.error("Dropping auth event that can't be written: %r", row)
+        with self._stats_lock:
+            self._stats["failures"] += 1
+            self._stats["dropped"] += len(rejected) + max(len(pending) - room, 0)
+
+    def _write(self, connection, rows):
+        """Insert `rows` and return the months partitions were created for."""
+        if connection.dialect.name != "postgresql":
+            connection.execute(insert(AuthEvent.__table__), rows)
+            return set()
+        months = {row["created_at"].date().replace(day=1) for row in rows}
+        created = months - self._partitions
+        for month in sorted(created):
+            _create_partition(connection, month)
+        if connection.dialect.driver == "psycopg2":
+            copy_rows(
+                connection,
+                AuthEvent.__tablename__,
+                COLUMNS,
+                ([row[column] for column in COLUMNS] for row in rows),
+            )
+        else:
+            connection.execute(insert(AuthEvent.__table__), rows)
+        return created
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        return stats
+
+    def describe(self):
+        return [_events_counter(), _pending_gauge()]
+
+    def collect(self):
+        """Prometheus collector for the counts in `stats`."""
+        stats = self.stats()
+        events = _events_counter()
+        for state in ("recorded", "written", "dropped"):
+            events.add_metric([state], stats[state])
+        yield events
+        pending = _pending_gauge()
+        pending.add_metric([], stats["pending"])
+        yield pending
+
+    def _ensure_worker(self):
+        # Like the mailer, the thread is started by whichever process records events.
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._pending = []
+            self._suspect, self._batch_limit, self._attempts = 0, None, 0
+            self._backoff = self._retry_at = 0
+            threading.Thread(target=self._run, name="auth-events", daemon=True).start()
+            self._worker_pid = pid
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            # Wait out a backoff even when a full buffer wakes the thread early.
+            if (delay := self._retry_at - time.monotonic()) > 0:
+                time.sleep(delay)
+            self._wake.clear()
+            if self.flush():
+                # Go on with the rest of the failed batch without waiting.
+                self._wake.set()
+
+
+auth_events = AuthEvents()
+
+
+@atexit.register
+def _flush_on_exit():
+    if auth_events._worker_pid == os.getpid():
+        while auth_events.flush():
+            pass
+
+
+def _sigterm(signum, frame):
+    _flush_on_exit()
+    # Runs the other exit handlers as well, like the mailer's.
+    sys.exit(128 + signum)
+
+
+def exit_on_sigterm():
+    """Write buffered events and exit on SIGTERM, for servers that don't handle it.
+    Call from the main thread."""
+    signal.signal(signal.SIGTERM, _sigterm)
+
+
+@cli.command("prune")
+@click.option(
+    "--keep-months",
+    default=12,
+    show_default=True,
+    help="Whole months to keep before the current one.",
+)
+def prune(keep_months):
+    """Delete the events from before the last --keep-months months."""
+    cutoff = _add_months(datetime.date.today().replace(day=1), -keep_months)
+    table = AuthEvent.__tablename__
+    with db.engine.begin() as connection:
+        if connection.dialect.name != "postgresql":
+            result = connection.execute(
+                AuthEvent.__table__.delete().where(AuthEvent.created_at < cutoff)
+            )
+            click.echo(f"Deleted {result.rowcount} events from before {cutoff}.")
+            return
+        partitions = connection.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i"
+                " JOIN pg_class c ON c.oid = i.inhrelid"
+                f" WHERE i.inhparent = '{table}'::regclass"
+            )
+        ).scalars()
+        dropped = []
+        for name in partitions:
+            if match := _PARTITION_NAME.match(name):
+                year, month = map(int, match.groups())
+                if datetime.date(year, month, 1) < cutoff:
+                    connection.execute(text(f"DROP TABLE {name}"))
+                    dropped.append(name)
+    click.echo(f"Dropped {len(dropped)} partitions from before {cutoff}.")
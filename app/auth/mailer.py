@@ -0,0 +1,277 @@
+"""Background email delivery.
+
+Views put messages on a queue and return straight away. A small pool of worker
+threads delivers them, each keeping its own authenticated SMTP connection open
+between messages instead of connecting, negotiating TLS and logging in every time.
+
+For local testing, point MAIL_SERVER/MAIL_PORT at an SMTP stand-in such as
+`python -m aiosmtpd -n -l localhost:2525` and set MAIL_USE_TLS=false with an empty
+MAIL_USERNAME.
+
+The queue depth, delivery counts and time spent sending are exported at /metrics as
+`mail_pending`, `mail_messages_total` and `mail_seconds_total`.
+"""
+import atexit
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from dataclasses import dataclass, field
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from auth.metrics import metrics, observe
+
+logger = logging.getLogger(__name__)
+
+
+def _messages_counter():
+    return CounterMetricFamily(
+        "mail_messages", "Email sent, failed and retried.", labels=["state"]
+    )
+
+
+def _seconds_counter():
+    return CounterMetricFamily(
+        "mail_seconds",
+        "Time spent sending email, and from queueing to delivery.",
+        labels=["phase"],
+    )
+
+
+def _pending_gauge():
+    return GaugeMetricFamily(
+        "mail_pending", "Email queued or waiting to be retried.", labels=["state"]
+    )
+
+
+@dataclass
+class OutgoingMessage:
+    mail_from: str
+    to: str
+    body: str
+    attempts: int = 0
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class Mailer:
+    """Queue and worker pool for outgoing email. Settings come from the app config
+    in `init_app` so the workers never need an app context."""
+
+    def __init__(self, app=None):
+        self.settings = {}
+        self._queue = queue.Queue()
+        self._workers = []
+        self._workers_pid = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = dict(
+            sent=0,
+            failed=0,
+            retried=0,
+            batches=0,
+            send_seconds=0.0,
+            delivery_seconds=0.0,
+        )
+        self._waiting_retries = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        self.settings = dict(
+            server=config.get("MAIL_SERVER"),
+            port=config.get("MAIL_PORT"),
+            username=config.get("MAIL_USERNAME"),
+            password=config.get("MAIL_PASSWORD"),
+            use_tls=config.get("MAIL_USE_TLS", True),
+            workers=config.get("MAIL_WORKERS", 2),
+            batch_size=config.get("MAIL_BATCH_SIZE", 20),
+            max_attempts=config.get("MAIL_MAX_ATTEMPTS", 5),
+            # Seconds to keep an unused connection open before closing it.
+            idle_timeout=config.get("MAIL_IDLE_TIMEOUT", 60),
+        )
+        metrics.add_collector(self)
+        app.extensions["mailer"] = self
+
+    def enqueue(self, mail_from, to, body):
+        """Queue an already rendered message for delivery."""
+        self._ensure_workers()
+        self._queue.put(OutgoingMessage(mail_from=mail_from, to=to, body=body))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far has been sent or given up on. Returns
+        False if the timeout ran out first."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks or self._waiting_retries:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self):
+        """Current queue depth and delivery counters."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["waiting_retries"] = self._waiting_retries
+        stats["avg_send_seconds"] = (
+            stats["send_seconds"] / stats["sent"] if stats["sent"] else 0.0
+        )
+        return stats
+
+    def describe(self):
+        return [_messages_counter(), _seconds_counter(), _pending_gauge()]
+
+    def collect(self):
+        """Prometheus collector for the numbers in `stats`."""
+        stats = self.stats()
+        messages = _messages_counter()
+        for state in ("sent", "failed", "retried"):
+            messages.add_metric([state], stats[state])
+        yield messages
+        seconds = _seconds_counter()
+        seconds.add_metric(["send"], stats["send_seconds"])
+        seconds.add_metric(["delivery"], stats["delivery_seconds"])
+        yield seconds
+        pending = _pending_gauge()
+        pending.add_metric(["queued"], stats["queue_depth"])
+        pending.add_metric(["retrying"], stats["waiting_retries"])
+        yield pending
+
+    def _ensure_workers(self):
+        # Threads don't survive a fork, so start them in whichever process is
+        # actually sending mail.
+        pid = os.getpid()
+        if self._workers_pid == pid:
+            return
+        with self._lock:
+            if self._workers_pid == pid:
+                return
+            self._queue = queue.Queue()
+            self._workers = [
+                threading.Thread(target=self._run, name=f"mailer-{i}", daemon=True)
+                for i in range(self.settings["workers"])
+            ]
+            for worker in self._workers:
+                worker.start()
+            self._workers_pid = pid
+
+    def _connect(self):
+        server = smtplib.SMTP(self.settings["server"], self.settings["port"])
+        if self.settings["use_tls"]:
+            server.starttls()
+        if self.settings["username"]:
+            server.login(self.settings["username"], self.settings["password"])
+        return server
+
+    def _run(self):
+        connection = None
+        last_used = 0.0
+        while True:
+            try:
+                message = self._queue.get(timeout=self.settings["idle_timeout"])
+            except queue.Empty:
+                # Nothing to do for a while, don't hold the connection open forever.
+                connection = _close(connection)
+                continue
+
+            idle_for = time.monotonic() - last_used
+            if connection and idle_for > self.settings["idle_timeout"]:
+                connection = _close(connection)
+
+            # Take whatever else is already waiting so it goes out over the same
+            # connection without going back to the queue in between.
+            batch = [message]
+            while len(batch) < self.settings["batch_size"]:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            with self._stats_lock:
+                self._stats["batches"] += 1
+            for message in batch:
+                try:
+                    connection = self._deliver(connection, message)
+                except Exception:
+                    # Not a delivery failure but a bug or bad message, retrying won't
+                    # help. Drop the message and keep the worker running.
+                    logger.exception("Sending email to %s failed", message.to)
+                    with self._stats_lock:
+                        self._stats["failed"] += 1
+                    connection = _close(connection)
+                finally:
+                    self._queue.task_done()
+            last_used = time.monotonic()
+
+    def _deliver(self, connection, message):
+        started = time.monotonic()
+        try:
+            if connection is None:
+                connection = self._connect()
+            try:
+                connection.sendmail(message.mail_from, message.to, message.body)
+            except smtplib.SMTPServerDisconnected:
+                # The server closed an idle connection. Reconnect once right away.
+                connection = self._connect()
+                connection.sendmail(message.mail_from, message.to, message.body)
+        except (smtplib.SMTPException, OSError):
+            logger.warning("Sending email to %s failed", message.to, exc_info=True)
+            self._retry(message)
+            return _close(connection)
+
+        finished = time.monotonic()
+        observe("smtp", finished - started)
+        with self._stats_lock:
+            self._stats["sent"] += 1
+            self._stats["send_seconds"] += finished - started
+            # Includes time spent waiting in the queue and on retries.
+            self._stats["delivery_seconds"] += finished - message.enqueued_at
+        return connection
+
+    def _retry(self, message):
+        message.attempts += 1
+        if message.attempts >= self.settings["max_attempts"]:
+            logger.error(
+                "Giving up on email to %s after %d attempts",
+                message.to,
+                message.attempts,
+            )
+            with self._stats_lock:
+                self._stats["failed"] += 1
+            return
+        with self._stats_lock:
+            self._stats["retried"] += 1
+            self._waiting_retries += 1
+        # Exponential backoff, capped at a minute. The timer puts it back on the
+        # queue so the worker can carry on with other messages meanwhile.
+        delay = min(2**message.attempts, 60)
+        timer = threading.Timer(delay, self._requeue, args=(message,))
+        timer.daemon = True
+        timer.start()
+
+    def _requeue(self, message):
+        self._queue.put(message)
+        with self._stats_lock:
+            self._waiting_retries -= 1
+
+
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.quit()
+        except Exception:
+            pass
+    return None
+
+
+mailer = Mailer()
+
+
+@atexit.register
+def _flush_on_exit():
+    if mailer._workers_pid == os.getpid():
+        mailer.flush(timeout=10)
@@ -0,0 +1,166 @@
+"""Timings for the phases of a request, as Server-Timing headers and Prometheus metrics.
+
+Redis commands, database queries, WebAuthn verification, secret hashing, SMTP and
+template rendering are all timed with `timed(phase)` (or `observe`). Within a request
+the time is added up per phase and sent back in a `Server-Timing` header, so a slow
+response can be picked apart in the browser's dev tools:
+
+    Server-Timing: redis;dur=0.42, db;dur=1.87, webauthn;dur=3.05, total;dur=6.71
+
+Every measurement also goes into a histogram, served in the Prometheus text format at
+`/metrics` together with per endpoint request latency. Both cost a few microseconds
+per measurement, so they can stay on under load.
+
+Under gunicorn each worker process keeps its own numbers. Set PROMETHEUS_MULTIPROC_DIR
+to an empty directory to have `/metrics` report all of them together.
+"""
+import contextlib
+import os
+import time
+from contextvars import ContextVar
+
+from flask import Response, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PHASE_SECONDS = Histogram(
+    "auth_phase_seconds",
+    "Time spent in each phase of handling a request.",
+    ["phase"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request, by endpoint.",
+    ["method", "endpoint"],
+)
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests handled, by endpoint and status code.",
+    ["method", "endpoint", "status"],
+)
+
+# (start time, {phase: seconds}) for the current request. A context variable rather
+# than `flask.g` so that the async views (see asgi.py), which only push a request
+# context around parts of their work, are covered too.
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def observe(phase, seconds):
+    """Record `seconds` spent in `phase`."""
+    PHASE_SECONDS.labels(phase).observe(seconds)
+    current = _request_timings.get()
+    if current is not None:
+        phases = current[1]
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+@contextlib.contextmanager
+def timed(phase):
+    """Time the body of the `with` block as `phase`."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - started)
+
+
+def begin_request():
+    _request_timings.set((time.perf_counter(), {}))
+
+
+def server_timing_header(phases, total):
+    entries = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in phases.items()]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    observe("db", time.perf_counter() - conn.info["query_started"].pop())
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get("query_started")
+    if started:
+        observe("db", time.perf_counter() - started.pop())
+
+
+class TimedTemplateMixin:
+    def render(self, *args, **kwargs):
+        with timed("render"):
+            return super().render(*args, **kwargs)
+
+
+class Metrics:
+    def __init__(self, app=None):
+        self.server_timing = True
+        self.collectors = []
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.server_timing = app.config.get("SERVER_TIMING", True)
+        app.before_request(begin_request)
+        app.after_request(self.finish_request)
+        if app.config.get("METRICS_ENDPOINT", True):
+            app.add_url_rule("/metrics", "metrics", self.metrics_view)
+
+        # Every engine, including the one behind the async engine in auth/aio.py.
+        if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+
+        # Templates compiled from now on render through the timed class.
+        template_class = app.jinja_env.template_class
+        app.jinja_env.template_class = type(
+            "TimedTemplate", (TimedTemplateMixin, template_class), {}
+        )
+        app.extensions["metrics"] = self
+
+    def add_collector(self, collector):
+        """Serve the metrics from a custom Prometheus collector at /metrics too."""
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+            REGISTRY.register(collector)
+
+    def finish_request(self, response):
+        current = _request_timings.get()
+        if current is None:
+            return response
+        _request_timings.set(None)
+        started, phases = current
+        total = time.perf_counter() - started
+        endpoint = request.endpoint or "unmatched"
+        REQUEST_SECONDS.labels(request.method, endpoint).observe(total)
+        REQUESTS.labels(request.method, endpoint, str(response.status_code)).inc()
+        if self.server_timing:
+            response.headers["Server-Timing"] = server_timing_header(phases, total)
+        return response
+
+    def metrics_view(self):
+        if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            # Custom collectors only know about this process.
+            for collector in self.collectors:
+                registry.register(collector)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = Metrics()
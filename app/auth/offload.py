@@ -0,0 +1,223 @@
+"""Run CPU heavy work (WebAuthn signature checks, argon2) in a pool of processes.
+
+Inline, that work holds the GIL and stalls every other request handled by the same
+process. With CPU_OFFLOAD_WORKERS set, it goes to a warm process pool instead. The
+number of calls waiting for the pool is capped: past CPU_OFFLOAD_MAX_PENDING, `run`
+raises `OffloadBusy` right away so the view can answer with a quick 503 instead of
+queueing indefinitely. With no workers configured everything runs inline as before.
+
+Calls by result (including `OffloadBusy` rejections), time spent waiting for and
+running in the pool, and calls in flight are exported at /metrics as
+`cpu_offload_calls_total`, `cpu_offload_seconds_total` and `cpu_offload_in_flight`,
+next to the configured limits in `cpu_offload_limit`.
+"""
+import functools
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from auth.metrics import metrics
+
+
+class OffloadBusy(Exception):
+    """Too many calls are already waiting for the process pool."""
+
+
+class OffloadTimeout(OffloadBusy):
+    """The call didn't finish within CPU_OFFLOAD_TIMEOUT seconds."""
+
+
+def _warm_up():
+    # Import the heavy modules once when a worker starts rather than on its first
+    # task.
+    import argon2  # noqa: F401
+    import webauthn  # noqa: F401
+
+    import auth.public_keys  # noqa: F401
+
+
+def _timed_call(func, args, kwargs):
+    started = time.time()
+    result = func(*args, **kwargs)
+    return result, started, time.time()
+
+
+def _calls_counter():
+    return CounterMetricFamily(
+        "cpu_offload_calls",
+        "Offloaded calls that finished, were rejected as busy or timed out.",
+        labels=["result"],
+    )
+
+
+def _seconds_counter():
+    return CounterMetricFamily(
+        "cpu_offload_seconds",
+        "Time offloaded calls spent waiting for a worker and running.",
+        labels=["phase"],
+    )
+
+
+def _in_flight_gauge():
+    return GaugeMetricFamily(
+        "cpu_offload_in_flight", "Offloaded calls queued or running in the pool."
+    )
+
+
+def _limit_gauge():
+    return GaugeMetricFamily(
+        "cpu_offload_limit",
+        "CPU_OFFLOAD_WORKERS and CPU_OFFLOAD_MAX_PENDING.",
+        labels=["limit"],
+    )
+
+
+class CpuOffload:
+    def __init__(self, app=None):
+        self.workers = 0
+        self.max_pending = 0
+        self.timeout = None
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = dict(
+            calls=0,
+            in_flight=0,
+            rejected=0,
+            timeouts=0,
+            queue_wait_seconds=0.0,
+            run_seconds=0.0,
+        )
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config.get("CPU_OFFLOAD_WORKERS", 0)
+        self.max_pending = app.config.get("CPU_OFFLOAD_MAX_PENDING", self.workers * 4)
+        self.timeout = app.config.get("CPU_OFFLOAD_TIMEOUT", 5)
+        metrics.add_collector(self)
+        app.extensions["cpu_offload"] = self
+
+    def run(self, func, *args, **kwargs):
+        """Call `func(*args, **kwargs)` in the process pool and return the result.
+        `func` and its arguments must be picklable. Exceptions are re-raised here."""
+        if not self.workers:
+            result, started, finished = _timed_call(func, args, kwargs)
+            self._record(0.0, finished - started)
+            return result
+
+        executor, slots = self._get_executor()
+        if not slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._stats["rejected"] += 1
+            raise OffloadBusy()
+
+        submitted = time.time()
+        try:
+            future = executor.submit(_timed_call, func, args, kwargs)
+        except BaseException:
+            slots.release()
+            raise
+        with self._stats_lock:
+            self._stats["in_flight"] += 1
+        # The slot is only freed once the work is really done, even if we stop
+        # waiting for it, so a pile of timed out calls can't overload the pool.
+        future.add_done_callback(functools.partial(self._release, slots))
+        try:
+            result, started, finished = future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._stats_lock:
+                self._stats["timeouts"] += 1
+            raise OffloadTimeout()
+        self._record(started - submitted, finished - started)
+        return result
+
+    def warm_up(self):
+        """Start the worker processes now rather than on the first calls."""
+        if not self.workers:
+            return
+        executor, _ = self._get_executor()
+        # The pool only starts a new process when none is idle, so submit one
+        # task for each.
+        wait([executor.submit(_warm_up) for _ in range(self.workers)])
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["workers"] = self.workers
+        return stats
+
+    def describe(self):
+        return [
+            _calls_counter(),
+            _seconds_counter(),
+            _in_flight_gauge(),
+            _limit_gauge(),
+        ]
+
+    def collect(self):
+        """Prometheus collector for the numbers in `stats`."""
+        stats = self.stats()
+        calls = _calls_counter()
+        calls.add_metric(["done"], stats["calls"])
+        calls.add_metric(["busy"], stats["rejected"])
+        calls.add_metric(["timeout"], stats["timeouts"])
+        yield calls
+        seconds = _seconds_counter()
+        seconds.add_metric(["queue_wait"], stats["queue_wait_seconds"])
+        seconds.add_metric(["run"], stats["run_seconds"])
+        yield seconds
+        in_flight = _in_flight_gauge()
+        in_flight.add_metric([], stats["in_flight"])
+        yield in_flight
+        limit = _limit_gauge()
+        limit.add_metric(["workers"], self.workers)
+        limit.add_metric(["max_pending"], self.max_pending)
+        yield limit
+
+    def reset(self):
+        """Forget the pool without shutting it down, for use in a forked child. The
+        pool belongs to the parent."""
+        with self._lock:
+            self._executor = None
+            self._executor_pid = None
+
+    def _release(self, slots, future):
+        slots.release()
+        with self._stats_lock:
+            self._stats["in_flight"] -= 1
+
+    def _record(self, queue_wait, run_time):
+        with self._stats_lock:
+            self._stats["calls"] += 1
+            self._stats["queue_wait_seconds"] += queue_wait
+            self._stats["run_seconds"] += run_time
+
+    def _get_executor(self):
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    # Forking a process with running threads isn't safe, so the
+                    # workers come from a clean fork server instead.
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("forkserver"),
+                        initializer=_warm_up,
+                    )
+                    self._slots = threading.BoundedSemaphore(
+                        self.workers + self.max_pending
+                    )
+                    self._executor_pid = pid
+        return self._executor, self._slots
+
+
+cpu_offload = CpuOffload()
@@ -0,0 +1,79 @@
+"""Cheaper rendering for pages that are the same for every anonymous visitor.
+
+Three parts:
+
+* Compiled templates are kept in a Jinja bytecode cache on disk (a per-user temporary
+  directory unless JINJA_BYTECODE_CACHE_DIR is set), shared by all the workers and
+  kept across restarts, so a fresh worker doesn't compile every template again.
+* `page_cache.render_template` remembers the rendered HTML for anonymous requests
+  without pending flash messages, when the output only depends on the template and
+  its (hashable) arguments. Used for the public pages and the static HTMX partials.
+* Every HTML response to a GET gets an ETag and is answered with 304 Not Modified
+  when the browser already has it.
+
+The rendered page cache's hits and misses are exported at /metrics as
+`cache_lookups_total{cache="page"}`.
+"""
+import flask
+from flask import request, session
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache
+
+from auth.cache import TTLCache, cache_collector
+
+
+class PageCache:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.rendered = TTLCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config.get("JINJA_BYTECODE_CACHE", True):
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+                app.config.get("JINJA_BYTECODE_CACHE_DIR")
+            )
+        self.enabled = app.config.get("PAGE_CACHE", True)
+        self.rendered = TTLCache(
+            maxsize=app.config.get("PAGE_CACHE_SIZE", 256),
+            ttl=app.config.get("PAGE_CACHE_TTL", 300),
+        )
+        app.after_request(self.conditional_response)
+        cache_collector.add("page", self.stats)
+        app.extensions["page_cache"] = self
+
+    def render_template(self, template_name, **context):
+        """`flask.render_template`, cached for anonymous requests. Only use it for
+        templates whose output depends on nothing but `context` and whether a user
+        is logged in."""
+        if not self.enabled or current_user.is_authenticated or session.get("_flashes"):
+            return flask.render_template(template_name, **context)
+
+        key = (request.script_root, template_name, tuple(sorted(context.items())))
+        if (html := self.rendered.get(key)) is None:
+            html = flask.render_template(template_name, **context)
+            self.rendered.set(key, html)
+        return html
+
+    def conditional_response(self, response):
+        if (
+            request.method in ("GET", "HEAD")
+            and response.status_code == 200
+            and response.mimetype == "text/html"
+            and not response.is_streamed
+        ):
+            response.add_etag()
+            # Pages depend on the session, so browsers may keep them but must check
+            # back each time, and shared caches must not keep them at all.
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            response.make_conditional(request)
+        return response
+
+    def stats(self):
+        return self.rendered.stats()
+
+
+page_cache = PageCache()
@@ -0,0 +1,153 @@
+"""Credential public keys, decoded once and kept ready to check signatures with.
+
+`webauthn.verify_authentication_response` takes the COSE encoded public key stored at
+registration, and on every call CBOR decodes it and builds a `cryptography` key
+object from it, about 70µs of a login. `verify_authentication_response` here makes
+the same checks, but takes the key object from an LRU cache keyed by credential id,
+holding up to PUBLIC_KEY_CACHE_SIZE keys.
+
+The cache is per process, with CPU_OFFLOAD_WORKERS each worker fills its own. A
+cached key is only used while the stored key it was decoded from is the one passed
+in, so a credential that's deleted and registered again can't be checked against
+its old key even in a process that missed the `invalidate`.
+
+Hits and misses are exported at /metrics as `cache_lookups_total{cache="public_keys"}`
+by the web processes. Offload workers don't serve /metrics, so with
+CPU_OFFLOAD_WORKERS set those numbers stay at zero and the benchmark in
+benchmarks/public_keys.py is the way to size the cache.
+"""
+import hashlib
+import os
+
+from cryptography.exceptions import InvalidSignature
+from webauthn.authentication.verify_authentication_response import (
+    VerifiedAuthentication,
+    expected_token_binding_statuses,
+)
+from webauthn.helpers import (
+    bytes_to_base64url,
+    decode_credential_public_key,
+    decoded_public_key_to_cryptography,
+    parse_authenticator_data,
+    parse_client_data_json,
+    verify_signature,
+)
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+from webauthn.helpers.structs import ClientDataType, PublicKeyCredentialType
+
+from auth.cache import TTLCache, cache_collector
+
+# credential id -> (COSE key, alg, cryptography public key). Keys don't change, the
+# ttl only lets entries for credentials nobody uses any more go.
+PUBLIC_KEYS = TTLCache(
+    maxsize=int(os.getenv("PUBLIC_KEY_CACHE_SIZE", 10000)), ttl=24 * 3600
+)
+
+
+def load_public_key(credential_id, credential_public_key):
+    """The signature algorithm and `cryptography` key for `credential_public_key`,
+    from the cache if it's there."""
+    entry = PUBLIC_KEYS.get(credential_id)
+    if entry is None or entry[0] != credential_public_key:
+        decoded = decode_credential_public_key(credential_public_key)
+        entry = (
+            credential_public_key,
+            decoded.alg,
+            decoded_public_key_to_cryptography(decoded),
+        )
+        PUBLIC_KEYS.set(credential_id, entry)
+    return entry[1], entry[2]
+
+
+def invalidate(credential_id):
+    PUBLIC_KEYS.pop(credential_id)
+
+
+def stats():
+    return PUBLIC_KEYS.stats()
+
+
+cache_collector.add("public_keys", stats)
+
+
+def verify_authentication_response(
+    *,
+    credential,
+    expected_challenge,
+    expected_rp_id,
+    expected_origin,
+    credential_public_key,
+    credential_current_sign_count,
+    require_user_verification=False,
+):
+    """`webauthn.verify_authentication_response`, checking the signature with the
+    cached key for the credential."""
+    # A copy of webauthn 1.5.2's checks, in the same order, with only the key lookup
+    # changed. pyproject.toml pins webauthn to that version, diff this against
+    # webauthn/authentication/verify_authentication_response.py before upgrading.
+    if bytes_to_base64url(credential.raw_id) != credential.id:
+        raise InvalidAuthenticationResponse("id and raw_id were not equivalent")
+    if credential.type != PublicKeyCredentialType.PUBLIC_KEY:
+        raise InvalidAuthenticationResponse(
+            f'Unexpected credential type "{credential.type}", expected "public-key"'
+        )
+
+    response = credential.response
+    client_data = parse_client_data_json(response.client_data_json)
+    if client_data.type != ClientDataType.WEBAUTHN_GET:
+        raise InvalidAuthenticationResponse(
+            f'Unexpected client data type "{client_data.type}",'
+            f' expected "{ClientDataType.WEBAUTHN_GET}"'
+        )
+    if expected_challenge != client_data.challenge:
+        raise InvalidAuthenticationResponse(
+            "Client data challenge was not expected challenge"
+        )
+    origins = [expected_origin] if isinstance(expected_origin, str) else expected_origin
+    if client_data.origin not in origins:
+        raise InvalidAuthenticationResponse(
+            f'Unexpected client data origin "{client_data.origin}",'
+            f" expected one of {origins}"
+        )
+    if client_data.token_binding:
+        status = client_data.token_binding.status
+        if status not in expected_token_binding_statuses:
+            raise InvalidAuthenticationResponse(
+                f'Unexpected token_binding status of "{status}"'
+            )
+
+    auth_data = parse_authenticator_data(response.authenticator_data)
+    if auth_data.rp_id_hash != hashlib.sha256(expected_rp_id.encode()).digest():
+        raise InvalidAuthenticationResponse("Unexpected RP ID hash")
+    if not auth_data.flags.up:
+        raise InvalidAuthenticationResponse(
+            "User was not present during authentication"
+        )
+    if require_user_verification and not auth_data.flags.uv:
+        raise InvalidAuthenticationResponse(
+            "User verification is required but user was not verified during"
+            " authentication"
+        )
+    if (
+        auth_data.sign_count > 0 or credential_current_sign_count > 0
+    ) and auth_data.sign_count <= credential_current_sign_count:
+        raise InvalidAuthenticationResponse(
+            f"Response sign count of {auth_data.sign_count} was not greater than"
+            f" current count of {credential_current_sign_count}"
+        )
+
+    alg, public_key = load_public_key(credential.raw_id, credential_public_key)
+    try:
+        verify_signature(
+            public_key=public_key,
+            signature_alg=alg,
+            signature=response.signature,
+            data=response.authenticator_data
+            + hashlib.sha256(response.client_data_json).digest(),
+        )
+    except InvalidSignature:
+        raise InvalidAuthenticationResponse("Could not verify authentication signature")
+
+    return VerifiedAuthentication(
+        credential_id=credential.raw_id, new_sign_count=auth_data.sign_count
+    )
@@ -0,0 +1,322 @@
+"""Rate limits for the auth endpoints that cost the most to answer.
+
+Every endpoint in `POLICIES` has one or more token buckets, keyed by client IP,
+the username being looked up or the user uid from the session. Each bucket holds
+`limit` tokens and refills at `limit` per `period` seconds. A request takes one
+token from each of its buckets, or is turned away with a 429 if any of them is
+empty. The check runs in a `before_request` hook, so rejected requests never reach
+the database, the WebAuthn verification or the mailer.
+
+The buckets live in redis and are checked and updated together by one script, in a
+single round trip. Once a key has been turned away, this process remembers it until
+the bucket would have refilled and rejects it without asking redis again, so a
+client hammering an endpoint costs a dictionary lookup per request. The async
+views in asgi.py take their tokens through `redis.asyncio` with `check_async`.
+
+If redis can't be reached the request is let through rather than locking everyone
+out. The script is sent once, without the retries of auth/connections.py, and after
+a failure redis isn't asked again for RATE_LIMIT_REDIS_COOLDOWN seconds (5), so an
+outage costs one failed call per process every few seconds instead of every request
+waiting on it.
+
+With RATE_LIMIT_STORE=memory the buckets are kept in process memory instead, each
+process with its own. That's the default when CHALLENGE_STORE is memory or signed,
+which otherwise run without redis.
+
+The client IP is `request.remote_addr`. Behind a reverse proxy that has to be fixed
+up with werkzeug's ProxyFix for per IP limits to mean anything.
+"""
+import logging
+import math
+import threading
+import time
+from dataclasses import dataclass
+
+from flask import request, session
+from redis.exceptions import RedisError
+
+from auth import util
+from auth.cache import TTLCache
+from auth.connections import client_for, get_async_redis, without_retries
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Limit:
+    """`limit` requests per `period` seconds for each distinct value of `key`."""
+
+    key: str
+    limit: int
+    period: float
+
+    @property
+    def rate(self):
+        return self.limit / self.period
+
+
+def _client_ip():
+    return request.remote_addr
+
+
+def _username():
+    # Capped so a huge form value can't make a huge key.
+    return request.form.get("username_email", "").strip().lower()[:255] or None
+
+
+def _user_uid():
+    return session.get("login_user_uid") or request.cookies.get("user_uid")
+
+
+KEY_FUNCTIONS = {"ip": _client_ip, "username": _username, "uid": _user_uid}
+
+# Limits by endpoint. The values are deliberately generous for people and tight for
+# scripts.
+POLICIES = {
+    "auth.login": [Limit("ip", 60, 60), Limit("uid", 30, 60)],
+    "auth.prepare_login": [Limit("ip", 30, 60), Limit("username", 10, 60)],
+    "auth.verify_login_credential": [Limit("ip", 30, 60), Limit("uid", 10, 60)],
+    "auth.prepare_passkey_login": [Limit("ip", 30, 60)],
+    "auth.verify_passkey_login": [Limit("ip", 30, 60)],
+    "auth.create_user": [Limit("ip", 10, 3600)],
+    "auth.email_login": [Limit("ip", 10, 600), Limit("uid", 3, 600)],
+    "auth.magic_link": [Limit("ip", 20, 60)],
+}
+
+# KEYS are the buckets, ARGV holds capacity and refill rate (tokens per second) for
+# each of them in turn. Nothing is taken unless every bucket has a token. Returns the
+# seconds until each bucket has a token again, all 0 when the request is allowed.
+# They're returned as strings, redis would truncate numbers to integers.
+_TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+local waits = {}
+local allowed = true
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = capacity
+    if state[1] then
+        available = math.min(
+            capacity, tonumber(state[1]) + (now - tonumber(state[2])) * rate
+        )
+    end
+    tokens[i] = available
+    waits[i] = '0'
+    if available < 1 then
+        waits[i] = tostring((1 - available) / rate)
+        allowed = false
+    end
+end
+if allowed then
+    for i, key in ipairs(KEYS) do
+        local capacity = tonumber(ARGV[2 * i - 1])
+        local rate = tonumber(ARGV[2 * i])
+        redis.call('HSET', key, 'tokens', tokens[i] - 1, 'ts', now)
+        redis.call('EXPIRE', key, math.ceil(capacity / rate))
+    end
+end
+return waits
+"""
+
+
+class RedisRateLimiter:
+    """Token buckets in redis, shared by every process."""
+
+    def __init__(self, namespace, get_client):
+        self.namespace = namespace
+        self.get_client = get_client
+        self._script = None
+
+    def _call_script(self, buckets):
+        client = self.get_client()
+        if self._script is None:
+            self._script = client.register_script(_TOKEN_BUCKET_SCRIPT)
+        args = []
+        for _, limit in buckets:
+            args += [limit.limit, limit.rate]
+        return self._script(
+            keys=[f"{self.namespace}:{key}" for key, _ in buckets],
+            args=args,
+            client=client,
+        )
+
+    def take(self, buckets):
+        """Take a token from each of `buckets`, a list of (key, Limit) pairs. Returns
+        the number of seconds to wait for each of them, all 0 if that worked."""
+        with without_retries():
+            return [float(wait) for wait in self._call_script(buckets)]
+
+
+class AsyncRedisRateLimiter(RedisRateLimiter):
+    """The async version of `RedisRateLimiter`, for `redis.asyncio` clients. Uses the
+    same keys, so both share the buckets."""
+
+    async def take(self, buckets):
+        with without_retries():
+            return [float(wait) for wait in await self._call_script(buckets)]
+
+
+class MemoryRateLimiter:
+    """Token buckets in process memory, for a single process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._next_purge = 0
+
+    def take(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            self._purge_full(now)
+            available = []
+            waits = []
+            for key, limit in buckets:
+                tokens, updated = self._buckets.get(key, (limit.limit, now))
+                tokens = min(limit.limit, tokens + (now - updated) * limit.rate)
+                available.append(tokens)
+                waits.append(max(0, (1 - tokens) / limit.rate))
+            if not any(waits):
+                for (key, _), tokens in zip(buckets, available):
+                    self._buckets[key] = (tokens - 1, now)
+            return waits
+
+    def _purge_full(self, now):
+        # A bucket that has been idle long enough is full again, which is the same
+        # as not having one.
+        if now < self._next_purge:
+            return
+        self._next_purge = now + 60
+        self._buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self._buckets.items()
+            if now - updated < 3600
+        }
+
+
+class RateLimits:
+    def __init__(self, app=None, limiter=None):
+        self.enabled = True
+        self.limiter = limiter
+        self.async_limiter = None
+        # bucket key -> monotonic time it's rejected until, the fast reject tier
+        self.rejected = TTLCache(maxsize=10000, ttl=60)
+        self.rejections = 0
+        self.redis_cooldown = 5
+        # monotonic time redis is skipped until, after it failed
+        self.skip_redis_until = 0
+        self.skipped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config.get("RATE_LIMIT", True)
+        self.redis_cooldown = app.config.get("RATE_LIMIT_REDIS_COOLDOWN", 5)
+        if self.limiter is None:
+            if app.config.get("RATE_LIMIT_STORE") == "memory":
+                self.limiter = MemoryRateLimiter()
+            else:
+                self.limiter = RedisRateLimiter("ratelimit", client_for("ratelimit"))
+        if isinstance(self.limiter, RedisRateLimiter):
+            self.async_limiter = AsyncRedisRateLimiter(
+                self.limiter.namespace, lambda: get_async_redis("ratelimit")
+            )
+        app.before_request(self.check)
+        app.extensions["rate_limits"] = self
+
+    def buckets(self, endpoint):
+        buckets = []
+        for limit in POLICIES[endpoint]:
+            value = KEY_FUNCTIONS[limit.key]()
+            if value:
+                # The hash tag keeps an endpoint's buckets together on a cluster,
+                # the script takes all of them at once.
+                buckets.append((f"{{{endpoint}}}:{limit.key}:{value}", limit))
+        return buckets
+
+    def check(self):
+        """Return a 429 response if the current request is over a limit, otherwise
+        None so the request carries on."""
+        buckets, response = self._start_check()
+        if not buckets or self._skipping_redis():
+            return response
+        try:
+            waits = self.limiter.take(buckets)
+        except RedisError:
+            self._redis_failed()
+            return None
+        return self._finish_check(buckets, waits)
+
+    async def check_async(self, in_request):
+        """`check` for the async views, which only push a request context for the
+        parts that need one. `in_request(func)` calls `func` inside one."""
+        buckets, response = in_request(self._start_check)
+        if not buckets or self._skipping_redis():
+            return response
+        try:
+            if self.async_limiter is None:
+                # In memory, nothing to wait for.
+                waits = self.limiter.take(buckets)
+            else:
+                waits = await self.async_limiter.take(buckets)
+        except RedisError:
+            self._redis_failed()
+            return None
+        return in_request(lambda: self._finish_check(buckets, waits))
+
+    def _skipping_redis(self):
+        if time.monotonic() < self.skip_redis_until:
+            self.skipped += 1
+            return True
+        return False
+
+    def _redis_failed(self):
+        # Better to let requests through than to lock everyone out while redis is
+        # unavailable, and without each of them waiting for it to time out first.
+        self.skip_redis_until = time.monotonic() + self.redis_cooldown
+        logger.warning(
+            "Rate limit check failed, requests allowed for the next %ss",
+            self.redis_cooldown,
+            exc_info=True,
+        )
+
+    def _start_check(self):
+        # The buckets to take tokens from, or a response if the request is already
+        # known to be over a limit.
+        if not self.enabled or request.endpoint not in POLICIES:
+            return [], None
+        buckets = self.buckets(request.endpoint)
+        now = time.monotonic()
+        for key, _ in buckets:
+            rejected_until = self.rejected.get(key)
+            if rejected_until and rejected_until > now:
+                return [], self._too_many(rejected_until - now)
+        return buckets, None
+
+    def _finish_check(self, buckets, waits):
+        if not any(waits):
+            return None
+        # Only the empty buckets, a user over their limit shouldn't block the IP.
+        now = time.monotonic()
+        for (key, _), wait in zip(buckets, waits):
+            if wait:
+                self.rejected.set(key, now + wait)
+        return self._too_many(max(waits))
+
+    def _too_many(self, wait):
+        self.rejections += 1
+        res = util.make_json_response({"verified": False, "rate_limited": True}, 429)
+        res.headers["Retry-After"] = str(math.ceil(wait))
+        return res
+
+    def stats(self):
+        return dict(
+            rejections=self.rejections,
+            fast_rejects=self.rejected.stats(),
+            skipped=self.skipped,
+        )
+
+
+rate_limits = RateLimits()
@@ -0,0 +1,103 @@
+"""Remember which single-use tokens have been used, in a fixed amount of memory.
+
+A `RotatingBloomFilter` keeps one Bloom filter per `period` of wall clock time. A token
+is looked for in the filters of the current period and the one before, and added to
+the current one. Tokens are valid for at most `period`, so a token used a second time
+while it's still valid is always found. Older filters are dropped, which is what keeps
+the memory fixed without remembering expiry times per token.
+
+A Bloom filter can give a false positive, a token that was never used looking used.
+With the default 2**23 bits (1 MiB) per period and 7 hashes that happens to less than
+one in ten million tokens while fewer than 100,000 are used per period, and the user
+just has to start the ceremony again.
+
+`RotatingBloomFilter` lives in process memory. `RedisRotatingBloomFilter` keeps the
+filters as redis bitmaps, checked and updated by one script, for deployments with
+several processes.
+"""
+import hashlib
+import threading
+import time
+
+_ADD_SCRIPT = """
+local seen_before = 1
+for i = 1, #ARGV - 1 do
+    if redis.call('GETBIT', KEYS[2], ARGV[i]) == 0 then
+        seen_before = 0
+        break
+    end
+end
+local seen_now = 1
+for i = 1, #ARGV - 1 do
+    if redis.call('SETBIT', KEYS[1], ARGV[i], 1) == 0 then
+        seen_now = 0
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[#ARGV])
+if seen_before == 1 or seen_now == 1 then
+    return 0
+end
+return 1
+"""
+
+
+def _contains(bits, positions):
+    return all(bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+
+class RotatingBloomFilter:
+    def __init__(self, period, bits=2**23, hashes=7):
+        self.period = period.total_seconds()
+        self.bits = bits
+        self.hashes = hashes
+        # period number -> filter
+        self._filters = {}
+        self._lock = threading.Lock()
+
+    def positions(self, item):
+        digest = hashlib.blake2b(item, digest_size=4 * self.hashes).digest()
+        return [
+            int.from_bytes(digest[i : i + 4], "little") % self.bits
+            for i in range(0, len(digest), 4)
+        ]
+
+    def add(self, item):
+        """Add `item` (bytes). Returns False if it was there already."""
+        positions = self.positions(item)
+        current = int(time.time() // self.period)
+        with self._lock:
+            for old in [number for number in self._filters if number < current - 1]:
+                del self._filters[old]
+            previous = self._filters.get(current - 1)
+            bits = self._filters.setdefault(current, bytearray(self.bits // 8))
+            seen = _contains(bits, positions) or (
+                previous is not None and _contains(previous, positions)
+            )
+            for position in positions:
+                bits[position >> 3] |= 1 << (position & 7)
+        return not seen
+
+
+class RedisRotatingBloomFilter(RotatingBloomFilter):
+    def __init__(self, namespace, get_client, period, bits=2**23, hashes=7):
+        super().__init__(period, bits, hashes)
+        self.namespace = namespace
+        self.get_client = get_client
+        self._script = None
+
+    def add(self, item):
+        client = self.get_client()
+        if self._script is None:
+            self._script = client.register_script(_ADD_SCRIPT)
+        current = int(time.time() // self.period)
+        return bool(
+            self._script(
+                # One hash tag for both, so a cluster keeps them on one node.
+                keys=[
+                    f"{{{self.namespace}}}:{current}",
+                    f"{{{self.namespace}}}:{current - 1}",
+                ],
+                args=[*self.positions(item), int(self.period * 2) + 1],
+                client=client,
+            )
+        )
@@ -0,0 +1,168 @@
+"""Read replicas for the queries that only read.
+
+DATABASE_REPLICA_URLS is a comma separated list of urls of read only replicas of the
+primary database at DATABASE_URL. Code that only reads, and can live with data that
+is a moment old, runs its queries inside `replica_reads()`, a context manager that
+also works as a decorator:
+
+    with replica_reads():
+        user = User.query.filter_by(uid=user_uid).first()
+
+Inside it the session sends SELECTs to a replica, picked at random once per session
+(so once per request). Flushes, INSERT/UPDATE/DELETE statements and any query outside
+`replica_reads` go to the primary, as without replicas. The async views in auth/aio.py
+read from replicas through `aio.get_read_engine`.
+
+Replicas lag behind the primary, so a client that has just written something reads
+from the primary for a while. Once the session flushes, the rest of the request reads
+from the primary, and so do the client's requests for the next REPLICA_STICKY_SECONDS
+(a timestamp in their Flask session). The credential usage counters in
+auth/credential_usage.py are written without a flush and don't count.
+
+Each replica has its own connection pool, sized with DATABASE_REPLICA_POOL_SIZE and
+DATABASE_REPLICA_MAX_OVERFLOW (DATABASE_POOL_SIZE and DATABASE_MAX_OVERFLOW for the
+primary). `pool_stats` has the connection counts of every pool, and they're exported
+as the `db_pool_connections` gauge at /metrics, for the process that answers.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import has_request_context, session
+from flask_sqlalchemy import SignallingSession
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+from auth.metrics import metrics
+
+STICKY_KEY = "_primary_until"
+
+_replica_reads = ContextVar("replica_reads", default=False)
+# Whether the current request has to read from the primary, see `begin_request`.
+_primary_only = ContextVar("primary_only", default=False)
+
+
+@contextmanager
+def replica_reads():
+    """Let the SELECTs in the block go to a replica."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class RoutingSession(SignallingSession):
+    """The session for `db`, it sends SELECTs made inside `replica_reads` to a
+    replica."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (
+            _replica_reads.get()
+            and not _primary_only.get()
+            and not self._flushing
+            and getattr(clause, "is_select", False)
+            and replicas.engines
+        ):
+            if (engine := self.info.get("replica")) is None:
+                engine = self.info["replica"] = random.choice(replicas.engines)
+            return engine
+        return super().get_bind(mapper, clause, **kwargs)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _read_own_writes(session, flush_context):
+    if replicas.engines:
+        replicas.pin_to_primary()
+
+
+def _pool_stats(engine):
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        # SQLite's pools don't keep count.
+        return dict(size=0, checked_out=0, checked_in=0, overflow=0)
+    return dict(
+        size=pool.size(),
+        checked_out=pool.checkedout(),
+        checked_in=pool.checkedin(),
+        overflow=max(pool.overflow(), 0),
+    )
+
+
+def _connections_gauge():
+    return GaugeMetricFamily(
+        "db_pool_connections",
+        "Database pool sizes and connections by state.",
+        labels=["bind", "state"],
+    )
+
+
+class Replicas:
+    def __init__(self, app=None):
+        self.urls = []
+        self.engines = []
+        self.engine_options = {}
+        self.sticky_seconds = 5
+        self._primary = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.urls = app.config.get("DATABASE_REPLICA_URLS", [])
+        self.engine_options = app.config.get("REPLICA_ENGINE_OPTIONS", {})
+        self.engines = [create_engine(url, **self.engine_options) for url in self.urls]
+        self.sticky_seconds = app.config.get("REPLICA_STICKY_SECONDS", 5)
+        self._primary = lambda: app.extensions["sqlalchemy"].db.get_engine(app)
+        app.before_request(self.begin_request)
+        metrics.add_collector(self)
+        app.extensions["replicas"] = self
+
+    def begin_request(self):
+        """Check whether the client wrote something recently enough that it has to
+        read from the primary. Runs before each request."""
+        primary_until = session.get(STICKY_KEY)
+        if primary_until is not None and primary_until < time.time():
+            session.pop(STICKY_KEY)
+            primary_until = None
+        _primary_only.set(primary_until is not None)
+
+    def pin_to_primary(self):
+        """Read from the primary for the rest of this request and, for
+        `sticky_seconds`, the client's next ones."""
+        _primary_only.set(True)
+        if has_request_context():
+            session[STICKY_KEY] = time.time() + self.sticky_seconds
+
+    def use_replica(self):
+        """Whether reads in the current request may go to a replica."""
+        return bool(self.urls) and not _primary_only.get()
+
+    def reset(self):
+        """Drop connections inherited from a parent process."""
+        for engine in self.engines:
+            engine.dispose(close=False)
+
+    def pool_stats(self):
+        """Connection counts for each pool, by bind."""
+        stats = {}
+        if self._primary is not None:
+            stats["primary"] = _pool_stats(self._primary())
+        for number, engine in enumerate(self.engines):
+            stats[f"replica{number}"] = _pool_stats(engine)
+        return stats
+
+    def describe(self):
+        return [_connections_gauge()]
+
+    def collect(self):
+        """Prometheus collector for the pool stats."""
+        connections = _connections_gauge()
+        for bind, stats in self.pool_stats().items():
+            for state, value in stats.items():
+                connections.add_metric([bind, state], value)
+        yield connections
+
+
+replicas = Replicas()
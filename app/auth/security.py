@@ -1,33 +1,111 @@
 import datetime
-import json
 import os
 import secrets
+from contextlib import contextmanager
 from urllib.parse import urlparse
 
-import argon2.exceptions
 import webauthn
-from argon2 import PasswordHasher
-from flask import request, url_for
-from redis import Redis
-from webauthn.helpers.structs import PublicKeyCredentialDescriptor
+from flask import current_app, request, url_for
+from sqlalchemy import event, select
+from webauthn.helpers.exceptions import InvalidAuthenticationResponse
+from webauthn.helpers.structs import (
+    AuthenticatorSelectionCriteria,
+    PublicKeyCredentialDescriptor,
+    ResidentKeyRequirement,
+)
 
-from models import WebAuthnCredential, db
+from auth import public_keys, util
+from auth.cache import TTLCache
+from auth.challenges import (
+    MemoryChallengeStore,
+    RedisChallengeStore,
+    SignedChallengeStore,
+)
+from auth.connections import client_for
+from auth.credential_usage import credential_usage
+from auth.metrics import timed
+from auth.offload import OffloadBusy, cpu_offload
+from auth.replay_cache import RedisRotatingBloomFilter, RotatingBloomFilter
+from auth.replicas import replica_reads
+from auth.secret_hashing import Argon2SecretHasher, HmacSecretHasher, find_hasher
+from auth.user_cache import UserSnapshot, user_cache
+from models import User, WebAuthnCredential, db
 
+CHALLENGE_TTL = datetime.timedelta(minutes=10)
 
-if redis_url := os.getenv("REDIS_URL"):
-    REGISTRATION_CHALLENGES = Redis.from_url(f"{redis_url}/0")
-    AUTHENTICATION_CHALLENGES = Redis.from_url(f"{redis_url}/1")
-    EMAIL_AUTH_SECRETS = Redis.from_url(f"{redis_url}/2")
+# Setting CHALLENGE_STORE=memory keeps ceremony state in process memory instead of
+# redis. That only works when there is a single app process. CHALLENGE_STORE=signed
+# keeps WebAuthn challenges in signed tokens in the session, with the used ones
+# remembered in process memory, or in redis with CHALLENGE_REPLAY_CACHE=redis when
+# there are several processes. Magic links are often opened on another device than
+# the one that asked for them, so their secrets stay on the server either way.
+# `check_workers` refuses to run several processes on process memory.
+if os.getenv("CHALLENGE_STORE") == "memory":
+    REGISTRATION_CHALLENGES = MemoryChallengeStore()
+    AUTHENTICATION_CHALLENGES = MemoryChallengeStore()
+    EMAIL_AUTH_SECRETS = MemoryChallengeStore()
+    # The redis key spaces in use, see auth/connections.py.
+    REDIS_KEY_SPACES = []
+    SINGLE_PROCESS_ONLY = "CHALLENGE_STORE=memory"
+elif os.getenv("CHALLENGE_STORE") == "signed":
+    if os.getenv("CHALLENGE_REPLAY_CACHE") == "redis":
+        REDIS_KEY_SPACES = ["used-challenges", "email-auth"]
+        REPLAY_CACHE = RedisRotatingBloomFilter(
+            "used-challenges", client_for("used-challenges"), CHALLENGE_TTL
+        )
+        EMAIL_AUTH_SECRETS = RedisChallengeStore("email-auth", client_for("email-auth"))
+        SINGLE_PROCESS_ONLY = None
+    else:
+        REDIS_KEY_SPACES = []
+        REPLAY_CACHE = RotatingBloomFilter(CHALLENGE_TTL)
+        EMAIL_AUTH_SECRETS = MemoryChallengeStore()
+        SINGLE_PROCESS_ONLY = (
+            "CHALLENGE_STORE=signed without CHALLENGE_REPLAY_CACHE=redis"
+        )
+    REGISTRATION_CHALLENGES = SignedChallengeStore("registration", REPLAY_CACHE)
+    AUTHENTICATION_CHALLENGES = SignedChallengeStore("authentication", REPLAY_CACHE)
 else:
-    rh = os.getenv("REDIS_HOST")
-    rpass = os.getenv("REDIS_PASSWORD")
-    rport = int(os.getenv("REDIS_PORT"))
-    REGISTRATION_CHALLENGES = Redis(host=rh, port=rport, password=rpass, db=0)
-    AUTHENTICATION_CHALLENGES = Redis(host=rh, port=rport, password=rpass, db=1)
-    EMAIL_AUTH_SECRETS = Redis(host=rh, port=rport, password=rpass, db=2)
+    # No connections are made here, the clients are created on first use.
+    REGISTRATION_CHALLENGES = RedisChallengeStore(
+        "registration", client_for("registration")
+    )
+    AUTHENTICATION_CHALLENGES = RedisChallengeStore(
+        "authentication", client_for("authentication")
+    )
+    EMAIL_AUTH_SECRETS = RedisChallengeStore("email-auth", client_for("email-auth"))
+    REDIS_KEY_SPACES = ["registration", "authentication", "email-auth"]
+    SINGLE_PROCESS_ONLY = None
+
 
+def check_workers(workers):
+    """Raise if ceremony state is kept in process memory but `workers` processes are
+    going to serve requests, as each would only know its own."""
+    if workers > 1 and SINGLE_PROCESS_ONLY:
+        raise RuntimeError(
+            f"{SINGLE_PROCESS_ONLY} only works with a single worker, not {workers}"
+        )
+
+
+# Credential descriptors offered at login, by user uid. Only ever holds credential
+# ids, never public keys. Adding a credential clears the entry in this process, other
+# processes pick it up when their entry expires.
+CREDENTIAL_DESCRIPTORS = TTLCache(maxsize=4096, ttl=60)
+
+
+@contextmanager
+def restored_on_busy(store, key, value):
+    """Put a consumed challenge or magic link hash back if `cpu_offload` turns the
+    check away, so the retry the 503 asks for can still succeed. The check never
+    ran, or its result is thrown away, so nothing has been accepted with it."""
+    try:
+        yield
+    except OffloadBusy:
+        if value is not None:
+            store.put(key, value, CHALLENGE_TTL)
+        raise
 
-def _hostname():
+
+def current_hostname():
     return str(urlparse(request.base_url).hostname)
 
 
@@ -35,62 +113,210 @@ def prepare_credential_creation(user):
     """Generate the configuration needed by the client to start registering a new
     WebAuthn credential."""
     public_credential_creation_options = webauthn.generate_registration_options(
-        rp_id=_hostname(),
+        rp_id=current_hostname(),
         rp_name="Flask WebAuthn Demo",
         user_id=user.uid,
         user_name=user.username,
+        # Ask for a discoverable credential (passkey) where the authenticator supports
+        # it, so the user can log in later without entering a username first.
+        authenticator_selection=AuthenticatorSelectionCriteria(
+            resident_key=ResidentKeyRequirement.PREFERRED
+        ),
     )
 
     # Redis is perfectly happy to store the binary challenge value.
-    REGISTRATION_CHALLENGES.set(user.uid, public_credential_creation_options.challenge)
-    REGISTRATION_CHALLENGES.expire(user.uid, datetime.timedelta(minutes=10))
+    REGISTRATION_CHALLENGES.put(
+        user.uid, public_credential_creation_options.challenge, CHALLENGE_TTL
+    )
 
-    return json.loads(webauthn.options_to_json(public_credential_creation_options))
+    return util.options_json(public_credential_creation_options)
 
 
 def verify_and_save_credential(user, registration_credential):
     """Verify that a new credential is valid for the"""
-    expected_challenge = REGISTRATION_CHALLENGES.get(user.uid)
+    # The challenge is removed as it is read, so each one can only be used once.
+    expected_challenge = REGISTRATION_CHALLENGES.consume(user.uid)
 
     # If the credential is somehow invalid (i.e. the challenge is wrong),
     # this will raise an exception. It's easier to handle that in the view
     # since we can send back an error message directly.
-    auth_verification = webauthn.verify_registration_response(
-        credential=registration_credential,
-        expected_challenge=expected_challenge,
-        expected_origin=f"https://{_hostname()}",
-        expected_rp_id=_hostname(),
-    )
+    with restored_on_busy(REGISTRATION_CHALLENGES, user.uid, expected_challenge):
+        with timed("webauthn"):
+            auth_verification = cpu_offload.run(
+                webauthn.verify_registration_response,
+                credential=registration_credential,
+                expected_challenge=expected_challenge,
+                expected_origin=f"https://{current_hostname()}",
+                expected_rp_id=current_hostname(),
+            )
 
     # At this point verification has succeeded and we can save the credential
+    # Only the id is used, so `user` can also be a cached user snapshot.
     credential = WebAuthnCredential(
-        user=user,
+        user_id=user.id,
         credential_public_key=auth_verification.credential_public_key,
         credential_id=auth_verification.credential_id,
     )
 
     db.session.add(credential)
-    db.session.commit()
+    # Includes the flush, so the INSERT is counted under both "db" and "commit".
+    with timed("commit"):
+        db.session.commit()
+    CREDENTIAL_DESCRIPTORS.pop(user.uid)
+
+
+def login_user_query(username_or_email=None, uid=None):
+    """
+    Query for a user who is about to log in, by either username/email or uid, along
+    with the ids (and only the ids) of their credentials. There is one row per
+    credential, or a single row with a null credential id.
+    """
+    if uid is not None:
+        condition = User.uid == uid
+    else:
+        condition = User.username_or_email_matches(username_or_email)
+    return (
+        select(
+            User.id,
+            User.uid,
+            User.username,
+            User.name,
+            User.email,
+            WebAuthnCredential.credential_id,
+        )
+        .outerjoin(WebAuthnCredential, WebAuthnCredential.user_id == User.id)
+        .where(condition)
+    )
+
+
+def cached_login_user(uid):
+    """A remembered user, if both they and their credential descriptors are
+    cached."""
+    user = user_cache.load_cached(uid)
+    if user and CREDENTIAL_DESCRIPTORS.get(uid) is not None:
+        return user
+    return None
+
+
+def remember_login_user(rows):
+    """Turn the rows from `login_user_query` into a `UserSnapshot`, caching it and
+    the user's credential descriptors on the way."""
+    if not rows:
+        return None
+
+    first = rows[0]
+    user = UserSnapshot(
+        id=first.id,
+        uid=first.uid,
+        username=first.username,
+        name=first.name,
+        email=first.email,
+    )
+    user_cache.remember(user)
+    CREDENTIAL_DESCRIPTORS.set(
+        user.uid,
+        [
+            PublicKeyCredentialDescriptor(id=row.credential_id)
+            for row in rows
+            if row.uid == user.uid and row.credential_id is not None
+        ],
+    )
+    return user
+
+
+def load_login_user(username_or_email=None, uid=None):
+    """
+    Find a user who is about to log in, by either username/email or uid, and return
+    a `UserSnapshot` (or None).
+
+    The user's credential ids come back in the same query and are put in the
+    descriptor cache, so preparing the login options afterwards needs no more
+    queries. A remembered user whose descriptors are already cached needs none at
+    all.
+    """
+    if uid is not None and (user := cached_login_user(uid)):
+        return user
+    with replica_reads():
+        rows = db.session.execute(
+            login_user_query(username_or_email=username_or_email, uid=uid)
+        ).all()
+    return remember_login_user(rows)
+
+
+def credential_descriptors_query(user):
+    return select(WebAuthnCredential.credential_id).where(
+        WebAuthnCredential.user_id == user.id
+    )
+
+
+def cache_credential_descriptors(user, credential_ids):
+    descriptors = [
+        PublicKeyCredentialDescriptor(id=credential_id)
+        for credential_id in credential_ids
+    ]
+    CREDENTIAL_DESCRIPTORS.set(user.uid, descriptors)
+    return descriptors
+
+
+def _credential_descriptors(user):
+    descriptors = CREDENTIAL_DESCRIPTORS.get(user.uid)
+    if descriptors is None:
+        with replica_reads():
+            credential_ids = db.session.execute(
+                credential_descriptors_query(user)
+            ).scalars()
+            descriptors = cache_credential_descriptors(user, credential_ids)
+    return descriptors
+
+
+def generate_login_options(hostname, allow_credentials):
+    return webauthn.generate_authentication_options(
+        rp_id=hostname,
+        allow_credentials=allow_credentials,
+    )
 
 
 def prepare_login_with_credential(user):
     """
     Prepare the authentication options for a user trying to log in.
     """
-    allowed_credentials = [
-        PublicKeyCredentialDescriptor(id=credential.credential_id)
-        for credential in user.credentials
-    ]
+    authentication_options = generate_login_options(
+        current_hostname(), _credential_descriptors(user)
+    )
 
-    authentication_options = webauthn.generate_authentication_options(
-        rp_id=_hostname(),
-        allow_credentials=allowed_credentials,
+    AUTHENTICATION_CHALLENGES.put(
+        user.uid, authentication_options.challenge, CHALLENGE_TTL
     )
 
-    AUTHENTICATION_CHALLENGES.set(user.uid, authentication_options.challenge)
-    AUTHENTICATION_CHALLENGES.expire(user.uid, datetime.timedelta(minutes=10))
+    return util.options_json(authentication_options)
+
+
+def verify_assertion(
+    authentication_credential, expected_challenge, hostname, credential_public_key
+):
+    """
+    Check an assertion's signature and client data. Raises
+    `InvalidAuthenticationResponse` if the credential does not authenticate.
+    Doesn't touch the database or the request, only CPU, so it runs through
+    `cpu_offload`. The decoded public key is cached, see auth/public_keys.py.
+    """
+    # It seems that safari doesn't track credential sign count correctly, so we just
+    # have to leave it on zero so that it will authenticate
+    with timed("webauthn"):
+        return cpu_offload.run(
+            public_keys.verify_authentication_response,
+            credential=authentication_credential,
+            expected_challenge=expected_challenge,
+            expected_origin=f"https://{hostname}",
+            expected_rp_id=hostname,
+            credential_public_key=credential_public_key,
+            credential_current_sign_count=0,
+        )
+
 
-    return json.loads(webauthn.options_to_json(authentication_options))
+@event.listens_for(WebAuthnCredential, "after_delete")
+def _forget_public_key(mapper, connection, target):
+    public_keys.invalidate(target.credential_id)
 
 
 def verify_authentication_credential(user, authentication_credential):
@@ -98,44 +324,105 @@ def verify_authentication_credential(user, authentication_credential):
     Verify a submitted credential against a credential in the database and the
     challenge stored in redis.
     """
-    expected_challenge = AUTHENTICATION_CHALLENGES.get(user.uid)
-    stored_credential = (
-        WebAuthnCredential.query.with_parent(user)
-        .filter_by(
-            credential_id=webauthn.base64url_to_bytes(authentication_credential.id)
-        )
-        .first()
-    )
+    expected_challenge = AUTHENTICATION_CHALLENGES.consume(user.uid)
+    with replica_reads():
+        stored_credential = WebAuthnCredential.query.filter_by(
+            user_id=user.id,
+            credential_id=webauthn.base64url_to_bytes(authentication_credential.id),
+        ).first()
+    if not stored_credential:
+        raise InvalidAuthenticationResponse("Unknown credential")
 
     # This will raise if the credential does not authenticate
-    # It seems that safari doesn't track credential sign count correctly, so we just
-    # have to leave it on zero so that it will authenticate
-    webauthn.verify_authentication_response(
-        credential=authentication_credential,
-        expected_challenge=expected_challenge,
-        expected_origin=f"https://{_hostname()}",
-        expected_rp_id=_hostname(),
-        credential_public_key=stored_credential.credential_public_key,
-        credential_current_sign_count=0,
+    with restored_on_busy(AUTHENTICATION_CHALLENGES, user.uid, expected_challenge):
+        verify_assertion(
+            authentication_credential,
+            expected_challenge,
+            current_hostname(),
+            stored_credential.credential_public_key,
+        )
+
+    # Count the use of the credential. This is mainly for reference since we can't
+    # check the sign count because of Safari's weirdness.
+    credential_usage.record(stored_credential.id)
+
+
+def prepare_discoverable_login():
+    """
+    Prepare authentication options for a login without a known user. The
+    authenticator offers whichever discoverable credentials it has for this site.
+
+    Returns an id for this login attempt along with the options. The challenge is
+    stored under that id rather than a user, so it has to be passed back to
+    `verify_discoverable_credential`.
+    """
+    ceremony_id = secrets.token_urlsafe(16)
+    authentication_options = webauthn.generate_authentication_options(
+        rp_id=current_hostname()
+    )
+    AUTHENTICATION_CHALLENGES.put(
+        f"discoverable:{ceremony_id}", authentication_options.challenge, CHALLENGE_TTL
     )
-    AUTHENTICATION_CHALLENGES.expire(user.uid, datetime.timedelta(seconds=1))
 
-    # Update the credential sign count after using, then save it back to the database.
-    # This is mainly for reference since we can't use it because of Safari's weirdness.
-    stored_credential.current_sign_count += 1
-    db.session.add(stored_credential)
-    db.session.commit()
+    return ceremony_id, util.options_json(authentication_options)
+
+
+def verify_discoverable_credential(ceremony_id, authentication_credential):
+    """
+    Verify a credential submitted for a discoverable login and return the user it
+    belongs to. The user is found from the credential id alone.
+    """
+    challenge_key = f"discoverable:{ceremony_id}"
+    expected_challenge = AUTHENTICATION_CHALLENGES.consume(challenge_key)
+    with replica_reads():
+        stored_credential = WebAuthnCredential.query.filter_by(
+            credential_id=webauthn.base64url_to_bytes(authentication_credential.id)
+        ).first()
+        if not stored_credential:
+            raise InvalidAuthenticationResponse("Unknown credential")
+        user = stored_credential.user
+    # The user handle is the user id we gave the authenticator during registration.
+    user_handle = authentication_credential.response.user_handle
+    if user_handle is not None and user_handle != user.uid.encode():
+        raise InvalidAuthenticationResponse("User handle does not match credential")
+
+    with restored_on_busy(AUTHENTICATION_CHALLENGES, challenge_key, expected_challenge):
+        verify_assertion(
+            authentication_credential,
+            expected_challenge,
+            current_hostname(),
+            stored_credential.credential_public_key,
+        )
+
+    credential_usage.record(stored_credential.id)
+    return user
 
 
-ph = PasswordHasher()
+ARGON2_HASHER = Argon2SecretHasher()
+
+
+def _magic_link_hashers():
+    """The hasher for new magic links first, followed by the other one so that links
+    sent before a change of MAGIC_LINK_HASHER still work."""
+    hmac_hasher = HmacSecretHasher(
+        current_app.config.get("MAGIC_LINK_HMAC_KEY")
+        or current_app.config["SECRET_KEY"]
+    )
+    if current_app.config.get("MAGIC_LINK_HASHER") == "argon2":
+        return [ARGON2_HASHER, hmac_hasher]
+    return [hmac_hasher, ARGON2_HASHER]
 
 
 def generate_magic_link(user_uid):
     """Generate a special secret link to log in a user and save a hash of the secret."""
     url_secret = secrets.token_urlsafe()
-    secret_hash = ph.hash(url_secret)
-    EMAIL_AUTH_SECRETS.set(user_uid, secret_hash)
-    EMAIL_AUTH_SECRETS.expire(user_uid, datetime.timedelta(minutes=10))
+    hasher = _magic_link_hashers()[0]
+    with timed(hasher.name):
+        if hasher.expensive:
+            secret_hash = cpu_offload.run(hasher.hash, url_secret)
+        else:
+            secret_hash = hasher.hash(url_secret)
+    EMAIL_AUTH_SECRETS.put(user_uid, secret_hash, CHALLENGE_TTL)
     return url_for(
         "auth.magic_link", secret=url_secret, _external=True, _scheme="https"
     )
@@ -143,12 +430,18 @@ def generate_magic_link(user_uid):
 
 def verify_magic_link(user_uid, secret):
     """Verify the secret from a magic login link against the saved hash for that
-    user."""
-    secret_hash = EMAIL_AUTH_SECRETS.get(user_uid)
-    try:
-        if ph.verify(secret_hash, secret):
-            EMAIL_AUTH_SECRETS.expire(user_uid, datetime.timedelta(seconds=1))
-            return True
-    except argon2.exceptions.VerifyMismatchError:
+    user. A link can only be tried once, after that the user has to request a new
+    one."""
+    secret_hash = EMAIL_AUTH_SECRETS.consume(user_uid)
+    if not secret_hash or not secret:
+        return False
+    if isinstance(secret_hash, bytes):
+        secret_hash = secret_hash.decode()
+    hasher = find_hasher(secret_hash, _magic_link_hashers())
+    if hasher is None:
         return False
-    return False
+    with timed(hasher.name):
+        if hasher.expensive:
+            with restored_on_busy(EMAIL_AUTH_SECRETS, user_uid, secret_hash):
+                return cpu_offload.run(hasher.verify, secret_hash, secret)
+        return hasher.verify(secret_hash, secret)
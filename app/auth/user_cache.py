@@ -0,0 +1,155 @@
+"""Cache for the user loaded by Flask-Login on every request.
+
+`current_user` is checked on every page, so looking the user up in postgres each time
+adds up. Users are cached as small immutable snapshots, first in process memory and
+optionally in redis so that workers share them. Snapshots are dropped whenever a
+transaction that inserted, updated or deleted a user row through the ORM commits.
+Not before, or a concurrent request could read the old row and cache it again. Other
+processes only see that in the redis tier, their in-process copy lasts until it
+expires, so keep USER_CACHE_TTL short.
+
+Hits and misses are exported at /metrics as `cache_lookups_total{cache="user"}`.
+"""
+import json
+from dataclasses import asdict, dataclass
+
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from auth.cache import TTLCache, cache_collector
+from auth.connections import get_redis
+from auth.replicas import RoutingSession, replica_reads
+from models import User, db
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """The parts of a user needed to serve a request, usable as `current_user`."""
+
+    id: int
+    uid: str
+    username: str
+    name: str
+    email: str
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def get_id(self):
+        return self.uid
+
+
+class UserCache:
+    def __init__(self, app=None):
+        self.local = TTLCache()
+        self.use_redis = False
+        self.redis_hits = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.local = TTLCache(
+            maxsize=app.config.get("USER_CACHE_SIZE", 1024),
+            ttl=app.config.get("USER_CACHE_TTL", 60),
+        )
+        self.use_redis = app.config.get("USER_CACHE_REDIS", False)
+        cache_collector.add("user", self.stats)
+        app.extensions["user_cache"] = self
+
+    def load_cached(self, user_uid):
+        """Get a snapshot of the user with this uid if it's cached, without going to
+        the database."""
+        if snapshot := self.local.get(user_uid):
+            return snapshot
+        if self.use_redis and (snapshot := self._get_shared(user_uid)):
+            self.redis_hits += 1
+            self.local.set(user_uid, snapshot)
+            return snapshot
+        return None
+
+    def load_user(self, user_uid):
+        """Get a snapshot of the user with this uid, or None if there isn't one."""
+        if not user_uid:
+            return None
+        if snapshot := self.load_cached(user_uid):
+            return snapshot
+
+        with replica_reads():
+            row = (
+                db.session.query(
+                    User.id, User.uid, User.username, User.name, User.email
+                )
+                .filter_by(uid=user_uid)
+                .first()
+            )
+        if row is None:
+            return None
+        snapshot = UserSnapshot(**row._asdict())
+        self.local.set(user_uid, snapshot)
+        if self.use_redis:
+            self._set_shared(snapshot)
+        return snapshot
+
+    def remember(self, snapshot):
+        """Cache a snapshot that was loaded some other way."""
+        self.local.set(snapshot.uid, snapshot)
+
+    def invalidate(self, user_uid):
+        self.invalidate_many([user_uid])
+
+    def invalidate_many(self, user_uids):
+        """Drop the users from both tiers, with one redis command."""
+        keys = []
+        for user_uid in user_uids:
+            self.local.pop(user_uid)
+            keys.append(f"user:{user_uid}")
+        if self.use_redis and keys:
+            try:
+                get_redis("user").delete(*keys)
+            except RedisError:
+                pass
+
+    def stats(self):
+        stats = self.local.stats()
+        stats["redis_hits"] = self.redis_hits
+        return stats
+
+    def _get_shared(self, user_uid):
+        try:
+            data = get_redis("user").get(f"user:{user_uid}")
+        except RedisError:
+            # The cache is only an optimization, fall back to the database.
+            return None
+        return data and UserSnapshot(**json.loads(data))
+
+    def _set_shared(self, snapshot):
+        try:
+            get_redis("user").set(
+                f"user:{snapshot.uid}", json.dumps(asdict(snapshot)), ex=self.local.ttl
+            )
+        except RedisError:
+            pass
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _remember_changed_user(mapper, connection, target):
+    session = object_session(target)
+    session.info.setdefault("changed_user_uids", set()).add(target.uid)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _invalidate_changed_users(session):
+    for user_uid in session.info.pop("changed_user_uids", ()):
+        user_cache.invalidate(user_uid)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _forget_changed_users(session):
+    session.info.pop("changed_user_uids", None)
@@ -1,15 +1,42 @@
 import json
-import smtplib
-import ssl
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from urllib.parse import urlparse, urljoin
 
+import webauthn
 from flask import make_response, request, current_app
+from markupsafe import Markup
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# What Jinja's `tojson` escapes, so the JSON can't close a <script> tag.
+_HTML_UNSAFE = str.maketrans(
+    {"<": "\\u003c", ">": "\\u003e", "&": "\\u0026", "'": "\\u0027"}
+)
+
+
+class EncodedJSON(Markup):
+    """A JSON document that's already encoded. It goes into templates as it is and
+    `make_json_response` sends it as it is."""
+
+
+def options_json(options):
+    """Encode WebAuthn `options` for the browser, once for every place they go."""
+    return EncodedJSON(webauthn.options_to_json(options).translate(_HTML_UNSAFE))
+
+
+def dumps(body):
+    """JSON encode `body`, with orjson when it's installed."""
+    if orjson is not None:
+        return orjson.dumps(body)
+    return json.dumps(body, separators=(",", ":"))
 
 
 def make_json_response(body, status=200):
-    res = make_response(json.dumps(body), status)
+    res = make_response(body if isinstance(body, EncodedJSON) else dumps(body), status)
     res.headers["Content-Type"] = "application/json"
     return res
 
@@ -21,7 +48,8 @@ def is_safe_url(target):
 
 
 def send_email(to, subject, body_text, body_html=None):
-    """Utility function for sending email with smtplib."""
+    """Utility function for sending email. The message is handed to the background
+    mailer and this returns as soon as it's queued."""
     mail_from = current_app.config["MAIL_FROM"]
     message = MIMEMultipart("alternative")
     message["Subject"] = subject
@@ -32,11 +60,4 @@ def send_email(to, subject, body_text, body_html=None):
     if body_html:
         part2 = MIMEText(body_html, "html")
         message.attach(part2)
-    with smtplib.SMTP(
-        current_app.config["MAIL_SERVER"], current_app.config["MAIL_PORT"]
-    ) as server:
-        server.starttls()
-        server.login(
-            current_app.config["MAIL_USERNAME"], current_app.config["MAIL_PASSWORD"]
-        )
-        server.sendmail(mail_from, to, message.as_string())
+    current_app.extensions["mailer"].enqueue(mail_from, to, message.as_string())
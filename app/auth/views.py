@@ -12,7 +12,6 @@ from flask import (
     flash,
 )
 from flask_login import login_user, login_required, current_user, logout_user
-from sqlalchemy import or_, func
 from sqlalchemy.exc import IntegrityError
 from webauthn.helpers.exceptions import (
     InvalidRegistrationResponse,
@@ -21,15 +20,29 @@ from webauthn.helpers.exceptions import (
 from webauthn.helpers.structs import RegistrationCredential, AuthenticationCredential
 
 from auth import security, util
-from models import User, db
+from auth.events import auth_events
+from auth.offload import OffloadBusy
+from auth.page_cache import page_cache
+from auth.replicas import replica_reads
+from auth.user_cache import user_cache
+from models import User, WebAuthnCredential, db
 
 auth = Blueprint("auth", __name__, template_folder="templates")
 
 
+@auth.errorhandler(OffloadBusy)
+def cpu_busy(error):
+    """The process pool for signature checks and hashing is saturated. Tell the
+    client to try again shortly rather than queueing the request."""
+    res = util.make_json_response({"verified": False, "busy": True}, 503)
+    res.headers["Retry-After"] = "1"
+    return res
+
+
 @auth.route("/register")
 def register():
     """Show the form for new users to register"""
-    return render_template("auth/register.html")
+    return page_cache.render_template("auth/register.html")
 
 
 @auth.route("/create-user", methods=["POST"])
@@ -50,6 +63,7 @@ def create_user():
             "Please enter a different one.",
         )
 
+    auth_events.record("user_created", user)
     login_user(user)
     session["used_webauthn"] = False
 
@@ -69,6 +83,11 @@ def add_credential():
     registration_credential = RegistrationCredential.parse_raw(request.get_data())
     try:
         security.verify_and_save_credential(current_user, registration_credential)
+        auth_events.record(
+            "credential_added",
+            current_user,
+            credential_id=registration_credential.raw_id,
+        )
         session["used_webauthn"] = True
         flash("Setup Complete!", "success")
 
@@ -84,7 +103,8 @@ def add_credential():
             max_age=datetime.timedelta(days=30),
         )
         return res
-    except InvalidRegistrationResponse:
+    except InvalidRegistrationResponse as error:
+        auth_events.record("credential_rejected", current_user, detail=str(error))
         abort(make_response('{"verified": false}', 400))
 
 
@@ -92,12 +112,14 @@ def add_credential():
 def login():
     """Prepare to log in the user with biometric authentication"""
     user_uid = request.cookies.get("user_uid")
-    user = User.query.filter_by(uid=user_uid).first()
+    user = security.load_login_user(uid=user_uid) if user_uid else None
 
     # If the user is not remembered from a previous session, we'll need to get
     # their username.
     if not user:
-        return render_template("auth/login.html", username=None, auth_options=None)
+        return page_cache.render_template(
+            "auth/login.html", username=None, auth_options=None
+        )
 
     # If they are remembered, we can skip directly to biometrics.
     auth_options = security.prepare_login_with_credential(user)
@@ -112,23 +134,22 @@ def login():
 @auth.route("/prepare-login", methods=["POST"])
 def prepare_login():
     """Prepare login options for a user based on their username or email"""
-    username_or_email = request.form.get("username_email", "").lower()
-    # The lower function just does case insensitivity for our.
-    user = User.query.filter(
-        or_(
-            func.lower(User.username) == username_or_email,
-            func.lower(User.email) == username_or_email,
-        )
-    ).first()
+    username_or_email = request.form.get("username_email", "")
+    user = security.load_login_user(username_or_email=username_or_email)
 
     # if no user matches, send back the form with an error message
     if not user:
-        return render_template(
+        return page_cache.render_template(
             "auth/_partials/username_form.html", error="No matching user found"
         )
 
     auth_options = security.prepare_login_with_credential(user)
+    return login_options_response(user, auth_options)
+
 
+def login_options_response(user, auth_options):
+    """Show the login options for a user who has been found by username or email.
+    Shared with the async version of this view in `asgi.py`."""
     res = make_response(
         render_template(
             "auth/_partials/select_login.html",
@@ -162,23 +183,90 @@ def login_switch_user():
 @auth.route("/verify-login-credential", methods=["POST"])
 def verify_login_credential():
     """Log in a user with a submitted credential"""
-    user_uid = session.get("login_user_uid")
-    user = User.query.filter_by(uid=user_uid).first()
+    user = user_cache.load_user(session.get("login_user_uid"))
     if not user:
+        auth_events.record("login_failed", method="webauthn", detail="No user")
         abort(make_response('{"verified": false}', 400))
 
     authentication_credential = AuthenticationCredential.parse_raw(request.get_data())
     try:
         security.verify_authentication_credential(user, authentication_credential)
-        login_user(user)
-        session["used_webauthn"] = True
-        flash("Login Complete", "success")
+        auth_events.record(
+            "login",
+            user,
+            method="webauthn",
+            credential_id=authentication_credential.raw_id,
+        )
+        return verified_login_response(user)
+    except InvalidAuthenticationResponse as error:
+        auth_events.record(
+            "login_failed",
+            user,
+            method="webauthn",
+            credential_id=authentication_credential.raw_id,
+            detail=str(error),
+        )
+        abort(make_response('{"verified": false}', 400))
+
+
+def verified_login_response(user):
+    """Log in a user whose credential has just been verified. Shared with the async
+    version of the view in `asgi.py`."""
+    login_user(user)
+    session["used_webauthn"] = True
+    flash("Login Complete", "success")
+
+    next_ = request.args.get("next")
+    if not next_ or not util.is_safe_url(next_):
+        next_ = url_for("auth.user_profile")
+    return util.make_json_response({"verified": True, "next": next_})
+
+
+@auth.route("/prepare-passkey-login")
+def prepare_passkey_login():
+    """Get authentication options for logging in with a discoverable credential
+    (passkey), skipping the username step."""
+    ceremony_id, auth_options = security.prepare_discoverable_login()
+    session["passkey_login_id"] = ceremony_id
+    return util.make_json_response(auth_options)
+
+
+@auth.route("/verify-passkey-login", methods=["POST"])
+def verify_passkey_login():
+    """Log in whichever user a submitted discoverable credential belongs to."""
+    ceremony_id = session.pop("passkey_login_id", None)
+    if not ceremony_id:
+        auth_events.record("login_failed", method="passkey", detail="No ceremony")
+        abort(make_response('{"verified": false}', 400))
 
-        next_ = request.args.get("next")
-        if not next_ or not util.is_safe_url(next_):
-            next_ = url_for("auth.user_profile")
-        return util.make_json_response({"verified": True, "next": next_})
-    except InvalidAuthenticationResponse:
+    authentication_credential = AuthenticationCredential.parse_raw(request.get_data())
+    try:
+        user = security.verify_discoverable_credential(
+            ceremony_id, authentication_credential
+        )
+        auth_events.record(
+            "login",
+            user,
+            method="passkey",
+            credential_id=authentication_credential.raw_id,
+        )
+        res = verified_login_response(user)
+        res.set_cookie(
+            "user_uid",
+            user.uid,
+            httponly=True,
+            secure=True,
+            samesite="strict",
+            max_age=datetime.timedelta(days=30),
+        )
+        return res
+    except InvalidAuthenticationResponse as error:
+        auth_events.record(
+            "login_failed",
+            method="passkey",
+            credential_id=authentication_credential.raw_id,
+            detail=str(error),
+        )
         abort(make_response('{"verified": false}', 400))
 
 
@@ -193,14 +281,19 @@ def logout():
 @auth.route("/user-profile")
 @login_required
 def user_profile():
-    return render_template("auth/user_profile.html")
+    with replica_reads():
+        credential_count = WebAuthnCredential.query.filter_by(
+            user_id=current_user.id
+        ).count()
+    return render_template("auth/user_profile.html", credential_count=credential_count)
 
 
 @auth.route("/email-login")
 def email_login():
     """Request login by emailed link."""
     user_uid = session.get("login_user_uid")
-    user = User.query.filter_by(uid=user_uid).first()
+    with replica_reads():
+        user = User.query.filter_by(uid=user_uid).first()
 
     # This is probably impossible, but seems like useful protection
     if not user:
@@ -239,18 +332,24 @@ def magic_link():
     """Handle incoming magic link authentications."""
     url_secret = request.args.get("secret")
     user_uid = request.cookies.get("magic_link_user_uid")
-    user = User.query.filter_by(uid=user_uid).first()
+    with replica_reads():
+        user = User.query.filter_by(uid=user_uid).first()
 
     if not user:
+        auth_events.record("login_failed", method="magic_link", detail="No user")
         flash("Could not log in. Please try again", "failure")
         return redirect(url_for("auth.login"))
 
     if security.verify_magic_link(user_uid, url_secret):
+        auth_events.record("login", user, method="magic_link")
         login_user(user)
         session["used_webauthn"] = False
         flash("Logged in", "success")
         return redirect(url_for("auth.user_profile"))
 
+    auth_events.record(
+        "login_failed", user, method="magic_link", detail="Invalid or expired link"
+    )
     return redirect(url_for("auth.login"))
 
 
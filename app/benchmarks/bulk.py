@@ -0,0 +1,95 @@
+"""Benchmark `flask users import` and `flask users export`.
+
+Generates a JSON lines file of users with one or two credentials each, imports it
+into an empty database, imports it again (everything is skipped as already there)
+and exports it back out.
+
+    python -m benchmarks.bulk --users 1000000
+    python -m benchmarks.bulk --users 1000000 --database-url postgresql://... --copy
+
+Against SQLite by default. The database at --database-url must not have these users
+already, use an empty one.
+"""
+import argparse
+import json
+import os
+import secrets
+import tempfile
+import time
+import uuid
+
+from webauthn.helpers import bytes_to_base64url
+
+
+def _generate(path, users):
+    with open(path, "w") as f:
+        for i in range(users):
+            credentials = [
+                dict(
+                    credential_id=bytes_to_base64url(secrets.token_bytes(32)),
+                    public_key=bytes_to_base64url(secrets.token_bytes(77)),
+                    sign_count=i % 100,
+                    last_used_at="2022-06-01T12:00:00" if i % 2 else None,
+                )
+                for _ in range(1 + i % 2)
+            ]
+            record = dict(
+                uid=str(uuid.uuid4()),
+                username=f"user{i}",
+                name=f"User {i}",
+                email=f"user{i}@example.com",
+                credentials=credentials,
+            )
+            f.write(json.dumps(record) + "\n")
+
+
+def _timed(runner, args):
+    started = time.perf_counter()
+    result = runner.invoke(args=args)
+    if result.exit_code:
+        raise SystemExit(result.output or repr(result.exception))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument("--copy", action="store_true", help="postgres only")
+    parser.add_argument(
+        "--database-url",
+        default=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bulk.db')}",
+    )
+    args = parser.parse_args()
+
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("SECRET_KEY", "bulk-benchmark")
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    runner = app.test_cli_runner()
+
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "users.jsonl")
+    started = time.perf_counter()
+    _generate(source, args.users)
+    print(f"generated {args.users} users in {time.perf_counter() - started:.1f}s")
+
+    import_args = ["users", "import", source, "--batch-size", str(args.batch_size)]
+    if args.copy:
+        import_args.append("--copy")
+    for label, command in (
+        ("import", import_args),
+        ("import again", import_args),
+        ("export jsonl", ["users", "export", os.path.join(directory, "out.jsonl")]),
+        ("export csv", ["users", "export", os.path.join(directory, "out.csv")]),
+    ):
+        elapsed = _timed(runner, command)
+        print(f"{label:<13} {elapsed:>7.1f}s {args.users / elapsed:>10.0f} users/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""End to end load test of the auth flows.
+
+Runs the app in process against local stand-ins: SQLite (or any DATABASE_URL), the
+in-memory challenge store or fakeredis, and an in-process SMTP sink. Each virtual user
+goes through
+
+    create-user -> add-credential -> prepare-login -> verify-login-credential
+    -> email-login -> magic-link
+
+using the software authenticator for real attestation and assertion payloads, then
+repeats the login part. Throughput and p50/p95/p99 latency are reported per endpoint.
+
+    python -m benchmarks.loadtest --users 50 --concurrency 8
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.smtp_sink import SmtpSink
+from benchmarks.soft_authenticator import SoftAuthenticator
+
+BASE_URL = "https://localhost"
+
+_OPTIONS_SCRIPT = re.compile(
+    r'<script id="(?:public-credential-creation-options|auth-options)"'
+    r' type="application/json">\s*(.*?)\s*</script>',
+    re.S,
+)
+_MAGIC_LINK = re.compile(r"https://\S+/auth/magic-link\?secret=[\w\-%]+")
+
+
+class Timings:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, ok):
+        with self._lock:
+            self.samples[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def report(self, elapsed):
+        print(
+            f"{'endpoint':<34} {'count':>6} {'errors':>6} {'req/s':>8}"
+            f" {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+        )
+        for endpoint, samples in self.samples.items():
+            samples = sorted(samples)
+
+            def pct(p):
+                return samples[max(0, int(len(samples) * p) - 1)] * 1000
+
+            print(
+                f"{endpoint:<34} {len(samples):>6} {self.errors[endpoint]:>6}"
+                f" {len(samples) / elapsed:>8.1f} {statistics.median(samples) * 1000:>8.2f}"
+                f" {pct(0.95):>8.2f} {pct(0.99):>8.2f}"
+            )
+
+
+class VirtualUser:
+    def __init__(self, app, sink, timings):
+        self.app = app
+        self.sink = sink
+        self.timings = timings
+        self.authenticator = SoftAuthenticator(origin=BASE_URL)
+        self.username = f"user-{uuid.uuid4().hex[:12]}"
+        self.email = f"{self.username}@example.com"
+
+    def _call(self, client, endpoint, method, path, expect=200, **kwargs):
+        started = time.perf_counter()
+        response = client.open(path, method=method, base_url=BASE_URL, **kwargs)
+        ok = response.status_code == expect
+        self.timings.record(endpoint, time.perf_counter() - started, ok)
+        if not ok:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+        return response
+
+    def _options(self, response):
+        return json.loads(_OPTIONS_SCRIPT.search(response.get_data(as_text=True))[1])
+
+    def register(self):
+        client = self.app.test_client()
+        res = self._call(
+            client,
+            "POST /auth/create-user",
+            "POST",
+            "/auth/create-user",
+            data=dict(name="Load Test", username=self.username, email=self.email),
+        )
+        registration = self.authenticator.create(self._options(res))
+        self._call(
+            client,
+            "POST /auth/add-credential",
+            "POST",
+            "/auth/add-credential",
+            json=registration,
+        )
+        return client
+
+    def login(self):
+        # A fresh client is a fresh browser session.
+        client = self.app.test_client()
+        res = self._call(
+            client,
+            "POST /auth/prepare-login",
+            "POST",
+            "/auth/prepare-login",
+            data=dict(username_email=self.username),
+        )
+        assertion = self.authenticator.get(self._options(res))
+        self._call(
+            client,
+            "POST /auth/verify-login-credential",
+            "POST",
+            "/auth/verify-login-credential",
+            json=assertion,
+        )
+        return client
+
+    def email_login(self, client):
+        self._call(client, "GET /auth/email-login", "GET", "/auth/email-login")
+        message = self.sink.wait_for(self.email)
+        text = next(
+            part.get_payload(decode=True).decode()
+            for part in message.walk()
+            if part.get_content_type() == "text/plain"
+        )
+        link = _MAGIC_LINK.search(text)[0]
+        self._call(
+            client,
+            "GET /auth/magic-link",
+            "GET",
+            link.replace(BASE_URL, ""),
+            expect=302,
+        )
+
+    def run(self, logins):
+        self.register()
+        for _ in range(logins):
+            client = self.login()
+            self.email_login(client)
+
+
+def _configure_environment(args, sink):
+    os.environ.setdefault(
+        "DATABASE_URL",
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'loadtest.db')}",
+    )
+    os.environ.setdefault("SECRET_KEY", "load-test")
+    os.environ["MAIL_SERVER"] = sink.host
+    os.environ["MAIL_PORT"] = str(sink.port)
+    os.environ["MAIL_USE_TLS"] = "false"
+    os.environ["MAIL_USERNAME"] = ""
+    os.environ["MAIL_FROM"] = "loadtest@example.com"
+    if args.challenge_store in ("memory", "signed"):
+        os.environ["CHALLENGE_STORE"] = args.challenge_store
+    os.environ["RATE_LIMIT"] = "true" if args.rate_limit else "false"
+
+
+def _use_fakeredis():
+    import fakeredis
+
+    from auth import security
+    from auth.rate_limit import rate_limits
+
+    server = fakeredis.FakeServer()
+    for store in (
+        security.REGISTRATION_CHALLENGES,
+        security.AUTHENTICATION_CHALLENGES,
+        security.EMAIL_AUTH_SECRETS,
+        rate_limits.limiter,
+    ):
+        store.get_client = lambda: fakeredis.FakeRedis(server=server)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=3, help="logins per user")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--challenge-store",
+        choices=["memory", "signed", "fakeredis", "redis"],
+        default="memory",
+        help="redis uses the REDIS_* settings from the environment",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        action="store_true",
+        help="keep the rate limits on, every virtual user shares one IP address",
+    )
+    args = parser.parse_args()
+
+    sink = SmtpSink().start()
+    _configure_environment(args, sink)
+
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    if args.challenge_store == "fakeredis":
+        _use_fakeredis()
+    with app.app_context():
+        db.create_all()
+
+    timings = Timings()
+    users = [VirtualUser(app, sink, timings) for _ in range(args.users)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for result in [pool.submit(user.run, args.logins) for user in users]:
+            result.result()
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{args.users} users, {args.logins} logins each, concurrency"
+        f" {args.concurrency}: {elapsed:.2f}s"
+    )
+    timings.report(elapsed)
+    sink.stop()
+
+
+if __name__ == "__main__":
+    main()
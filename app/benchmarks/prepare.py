@@ -0,0 +1,115 @@
+"""Micro-benchmark of the endpoints that prepare WebAuthn ceremonies.
+
+Registers --users users with the software authenticator, then times --requests
+requests to each endpoint that sends options to the browser, in process against
+SQLite and the in-memory challenge store:
+
+    python -m benchmarks.prepare --users 50 --requests 2000
+
+It also times encoding the options on their own, the old way (options_to_json,
+json.loads, then `tojson` in the template) against `util.options_json`, and says
+which JSON backend `util.make_json_response` is using.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import webauthn
+from flask.json import htmlsafe_dumps
+
+from benchmarks.loadtest import BASE_URL, Timings, VirtualUser
+
+
+def _configure_environment():
+    os.environ.setdefault(
+        "DATABASE_URL",
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'prepare.db')}",
+    )
+    os.environ.setdefault("SECRET_KEY", "prepare-benchmark")
+    os.environ.setdefault("CHALLENGE_STORE", "memory")
+    os.environ["RATE_LIMIT"] = "false"
+
+
+def _time_requests(clients, method, path, requests):
+    started = time.perf_counter()
+    for i in range(requests):
+        client, data = clients[i % len(clients)]
+        response = client.open(path, method=method, base_url=BASE_URL, **data)
+        assert response.status_code == 200, response.status_code
+    return (time.perf_counter() - started) / requests
+
+
+def _time_encoding(options, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        htmlsafe_dumps(json.loads(webauthn.options_to_json(options)))
+    twice = (time.perf_counter() - started) / rounds
+
+    from auth import util
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        util.options_json(options)
+    return twice, (time.perf_counter() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    _configure_environment()
+    from app import create_app
+    from auth import security, util
+    from models import User, db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+
+    virtual_users = [VirtualUser(app, None, Timings()) for _ in range(args.users)]
+    logged_in = [(user.register(), {}) for user in virtual_users]
+    with app.app_context():
+        users = User.query.all()
+
+    anonymous = [(app.test_client(), {})]
+    by_username = [
+        (app.test_client(), dict(data=dict(username_email=user.username)))
+        for user in users
+    ]
+    remembered = []
+    for user in users:
+        client = app.test_client()
+        client.set_cookie("localhost", "user_uid", user.uid)
+        remembered.append((client, {}))
+
+    print(f"JSON backend: {'orjson' if util.orjson else 'json'}")
+    print(f"{'endpoint':<34} {'µs/request':>10}")
+    for endpoint, clients, method, path in [
+        ("POST /auth/prepare-login", by_username, "POST", "/auth/prepare-login"),
+        ("GET /auth/login (remembered)", remembered, "GET", "/auth/login"),
+        (
+            "GET /auth/prepare-passkey-login",
+            anonymous,
+            "GET",
+            "/auth/prepare-passkey-login",
+        ),
+        ("GET /auth/create-credential", logged_in, "GET", "/auth/create-credential"),
+    ]:
+        seconds = _time_requests(clients, method, path, args.requests)
+        print(f"{endpoint:<34} {seconds * 1e6:>10.1f}")
+
+    with app.test_request_context(base_url=BASE_URL):
+        options = security.generate_login_options(
+            security.current_hostname(), security._credential_descriptors(users[0])
+        )
+        twice, once = _time_encoding(options, args.requests)
+    print(f"{'options, encoded twice':<34} {twice * 1e6:>10.1f}")
+    print(f"{'options, util.options_json':<34} {once * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
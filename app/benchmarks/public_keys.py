@@ -0,0 +1,95 @@
+"""Benchmark assertion verification with and without the decoded public key cache.
+
+Signs assertions for --credentials credentials with the software authenticator, then
+verifies each of them --rounds times with `webauthn.verify_authentication_response`
+and with `auth.public_keys.verify_authentication_response`, in the same process:
+
+    python -m benchmarks.public_keys --credentials 1000 --rounds 5
+
+Set PUBLIC_KEY_CACHE_SIZE below --credentials to see what misses cost.
+"""
+import argparse
+import json
+import os
+import time
+
+import webauthn
+from webauthn import base64url_to_bytes
+from webauthn.helpers import bytes_to_base64url
+from webauthn.helpers.structs import AuthenticationCredential
+
+from auth import public_keys
+from benchmarks.soft_authenticator import SoftAuthenticator, _cose_key
+
+RP_ID = "localhost"
+ORIGIN = "https://localhost"
+
+
+def _assertions(count):
+    authenticator = SoftAuthenticator(ORIGIN)
+    assertions = []
+    for _ in range(count):
+        registration = authenticator.create(
+            {
+                "rp": {"id": RP_ID},
+                "user": {"id": bytes_to_base64url(os.urandom(16))},
+                "challenge": bytes_to_base64url(os.urandom(32)),
+            }
+        )
+        credential_id = base64url_to_bytes(registration["id"])
+        private_key = authenticator.credentials[credential_id][0]
+        challenge = os.urandom(32)
+        response = authenticator.get(
+            {
+                "rpId": RP_ID,
+                "allowCredentials": [{"id": registration["id"]}],
+                "challenge": bytes_to_base64url(challenge),
+            }
+        )
+        assertions.append(
+            dict(
+                credential=AuthenticationCredential.parse_raw(json.dumps(response)),
+                expected_challenge=challenge,
+                credential_public_key=_cose_key(private_key.public_key()),
+            )
+        )
+    return assertions
+
+
+def _time(verify, assertions, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for assertion in assertions:
+            verify(
+                **assertion,
+                expected_rp_id=RP_ID,
+                expected_origin=ORIGIN,
+                credential_current_sign_count=0,
+            )
+    return (time.perf_counter() - started) / (rounds * len(assertions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--credentials", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    assertions = _assertions(args.credentials)
+    print(f"{'path':<8} {'µs/verify':>10}")
+    uncached = _time(webauthn.verify_authentication_response, assertions, args.rounds)
+    print(f"{'webauthn':<8} {uncached * 1e6:>10.1f}")
+    cached = _time(public_keys.verify_authentication_response, assertions, args.rounds)
+    print(f"{'cached':<8} {cached * 1e6:>10.1f}")
+
+    stats = public_keys.stats()
+    lookups = stats["hits"] + stats["misses"]
+    print(
+        f"cache: {stats['size']}/{stats['maxsize']} keys,"
+        f" {stats['hits']} hits, {stats['misses']} misses,"
+        f" hit rate {stats['hits'] / lookups:.1%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,377 @@
+"""Reconnect and failover behaviour of auth.connections against local redis processes.
+
+Starts throwaway redis-server processes on free ports (redis-server has to be on
+PATH, or given with --redis-server), points the authentication key space at them and
+keeps challenge stores busy, sync and async, while servers are stopped:
+
+    python -m benchmarks.redis_failover standalone sentinel cluster
+
+standalone  One server, killed and started again after --outage seconds. The
+            retries with backoff should carry every command over the gap.
+sentinel    A master, a replica and three sentinels. The master is killed and the
+            replica promoted, commands fail at most until the client finds it.
+cluster     Three masters with a replica each. One user's keys in every key space
+            hash to one slot, and the rate limit and replay cache scripts run. Then
+            a master is killed and its replica takes over its slots.
+
+Each scenario reports the commands that failed, the longest the clients went
+without an answer and the slowest command, and the script exits non-zero if a check
+failed. Challenges stored on a server that's killed are lost with it, those are
+counted but not failures, nothing here persists to disk.
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from auth import connections
+from auth.challenges import AsyncRedisChallengeStore, RedisChallengeStore
+from auth.rate_limit import Limit, RedisRateLimiter
+from auth.replay_cache import RedisRotatingBloomFilter
+
+SPACE = "authentication"
+TTL = datetime.timedelta(minutes=1)
+CLUSTER_SLOTS = 16384
+
+
+def _free_port():
+    # Cluster nodes also listen on port + 10000 for the cluster bus.
+    while True:
+        port = random.randrange(20000, 40000)
+        try:
+            for candidate in (port, port + 10000):
+                with socket.socket() as sock:
+                    sock.bind(("127.0.0.1", candidate))
+        except OSError:
+            continue
+        return port
+
+
+def _wait_for(check, timeout=10, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except RedisError:
+            pass
+        time.sleep(interval)
+    raise TimeoutError(f"Gave up waiting for {check.__name__}")
+
+
+class Server:
+    def __init__(self, binary, directory, *args, port=None):
+        self.binary = binary
+        self.port = port or _free_port()
+        self.directory = os.path.join(directory, str(self.port))
+        self.args = args
+        self.process = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def start(self, config=None):
+        command = [self.binary]
+        if config is not None:
+            path = os.path.join(self.directory, "redis.conf")
+            with open(path, "w") as f:
+                f.write(config)
+            command.append(path)
+        command += ["--port", str(self.port), "--bind", "127.0.0.1"]
+        command += ["--save", "", "--appendonly", "no", "--dir", self.directory]
+        self.process = subprocess.Popen(
+            [*command, *self.args],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        client = self.client()
+        _wait_for(client.ping)
+        return self
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+
+    def client(self):
+        return Redis("127.0.0.1", self.port, socket_timeout=1)
+
+
+class Workload:
+    """Challenges put and consumed in a loop, from a thread and an event loop."""
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.results = {"sync": [], "async": []}
+        self.failures = {"sync": [], "async": []}
+        self.lost = 0
+        self._threads = []
+
+    def start(self):
+        store = RedisChallengeStore(SPACE, connections.client_for(SPACE))
+        self._threads = [
+            threading.Thread(target=self._run_sync, args=(store,)),
+            threading.Thread(target=asyncio.run, args=(self._run_async(),)),
+        ]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def finish(self):
+        self.stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _check(self, kind, started, value, challenge):
+        finished = time.monotonic()
+        self.results[kind].append((started, finished))
+        if value != challenge:
+            self.lost += 1
+
+    def _run_sync(self, store):
+        while not self.stop.is_set():
+            user_uid, challenge = uuid.uuid4().hex, os.urandom(16)
+            started = time.monotonic()
+            try:
+                store.put(user_uid, challenge, TTL)
+                value = store.consume(user_uid)
+            except RedisError:
+                self.failures["sync"].append(time.monotonic())
+                continue
+            self._check("sync", started, value, challenge)
+
+    async def _run_async(self):
+        store = AsyncRedisChallengeStore(
+            SPACE, lambda: connections.get_async_redis(SPACE)
+        )
+        while not self.stop.is_set():
+            user_uid, challenge = uuid.uuid4().hex, os.urandom(16)
+            started = time.monotonic()
+            try:
+                await store.put(user_uid, challenge, TTL)
+                value = await store.consume(user_uid)
+            except RedisError:
+                self.failures["async"].append(time.monotonic())
+                await asyncio.sleep(0.01)
+                continue
+            self._check("async", started, value, challenge)
+        await connections.get_async_redis(SPACE).close()
+
+    def report(self):
+        """Print the results, return the longest any client went without a
+        successful command."""
+        worst_gap = 0
+        for kind, results in self.results.items():
+            finished = sorted(finished for _, finished in results)
+            gap = max((b - a for a, b in zip(finished, finished[1:])), default=0)
+            slowest = max((f - s for s, f in results), default=0)
+            print(
+                f"  {kind:<5} {len(results):>6} ok, {len(self.failures[kind]):>5}"
+                f" failed, longest without an answer {gap:.2f}s,"
+                f" slowest command {slowest:.2f}s"
+            )
+            worst_gap = max(worst_gap, gap)
+        print(f"  challenges lost with the killed server: {self.lost}")
+        return worst_gap
+
+
+def _use(url):
+    os.environ[f"REDIS_URL_{SPACE.upper()}"] = url
+    connections.redis_url.cache_clear()
+    connections.reset()
+
+
+def standalone(args, directory):
+    server = Server(args.redis_server, directory).start()
+    _use(f"redis://127.0.0.1:{server.port}/0")
+    workload = Workload().start()
+    time.sleep(args.duration / 2)
+    server.kill()
+    time.sleep(args.outage)
+    server.start()
+    time.sleep(args.duration / 2)
+    workload.finish()
+    server.kill()
+    workload.report()
+    failed = sum(len(failures) for failures in workload.failures.values())
+    return _expect(failed == 0, f"{failed} commands failed over a {args.outage}s gap")
+
+
+def sentinel(args, directory):
+    master = Server(args.redis_server, directory).start()
+    replica = Server(
+        args.redis_server, directory, "--replicaof", "127.0.0.1", str(master.port)
+    ).start()
+    _wait_for(
+        lambda: replica.client().info("replication")["master_link_status"] == "up"
+    )
+    sentinels = []
+    for _ in range(3):
+        sentinels.append(
+            Server(args.redis_server, directory, "--sentinel").start(
+                f"sentinel monitor app 127.0.0.1 {master.port} 2\n"
+                "sentinel down-after-milliseconds app 1000\n"
+                "sentinel failover-timeout app 5000\n"
+            )
+        )
+    hosts = ",".join(f"127.0.0.1:{server.port}" for server in sentinels)
+    _use(f"redis+sentinel://{hosts}/app/0")
+
+    workload = Workload().start()
+    time.sleep(args.duration / 2)
+    outage_started = time.monotonic()
+    master.kill()
+    _wait_for(lambda: replica.client().info("replication")["role"] == "master", 30)
+    promoted = time.monotonic() - outage_started
+    time.sleep(args.duration / 2)
+    workload.finish()
+    for server in [replica, *sentinels]:
+        server.kill()
+    print(f"  replica promoted after {promoted:.2f}s")
+    gap = workload.report()
+    return _expect(
+        gap < promoted + args.max_recovery,
+        f"clients took {gap - promoted:.2f}s to find the new master",
+    )
+
+
+def _create_cluster(args, directory):
+    options = ["--cluster-enabled", "yes", "--cluster-node-timeout", "1000"]
+    masters = [Server(args.redis_server, directory, *options) for _ in range(3)]
+    replicas = [Server(args.redis_server, directory, *options) for _ in range(3)]
+    for server in [*masters, *replicas]:
+        server.start()
+    for number, server in enumerate(masters):
+        start = number * CLUSTER_SLOTS // len(masters)
+        stop = (number + 1) * CLUSTER_SLOTS // len(masters)
+        server.client().execute_command("CLUSTER ADDSLOTS", *range(start, stop))
+    first = masters[0].client()
+    for server in [*masters[1:], *replicas]:
+        first.execute_command("CLUSTER MEET", "127.0.0.1", server.port)
+    for master, replica in zip(masters, replicas):
+        master_id = master.client().execute_command("CLUSTER MYID")
+        client = replica.client()
+
+        def replicating():
+            return client.execute_command("CLUSTER REPLICATE", master_id)
+
+        _wait_for(replicating)
+
+    def cluster_ok():
+        return all(
+            server.client().cluster("info")["cluster_state"] == "ok"
+            for server in [*masters, *replicas]
+        )
+
+    _wait_for(cluster_ok, 30)
+    return masters, replicas
+
+
+def cluster(args, directory):
+    masters, replicas = _create_cluster(args, directory)
+    _use(f"redis+cluster://127.0.0.1:{masters[0].port},127.0.0.1:{masters[1].port}")
+    client = connections.get_redis(SPACE)
+
+    user_uid = uuid.uuid4().hex
+    stores = [
+        RedisChallengeStore(space, lambda: client)
+        for space in ("registration", "authentication", "email-auth")
+    ]
+    slots = {client.keyslot(store._key(user_uid)) for store in stores}
+    ok = _expect(len(slots) == 1, f"one user's keys are in {len(slots)} slots")
+    for store in stores:
+        store.put(user_uid, b"challenge", TTL)
+        ok &= _expect(store.consume(user_uid) == b"challenge", "store round trip")
+    limiter = RedisRateLimiter("ratelimit", lambda: client)
+    waits = limiter.take(
+        [
+            ("{auth.prepare_login}:ip:127.0.0.1", Limit("ip", 30, 60)),
+            ("{auth.prepare_login}:username:someone", Limit("username", 10, 60)),
+        ]
+    )
+    ok &= _expect(waits == [0, 0], "token buckets in one script")
+    replay_cache = RedisRotatingBloomFilter("used-challenges", lambda: client, TTL)
+    token = os.urandom(16)
+    ok &= _expect(
+        replay_cache.add(token) and not replay_cache.add(token), "replay cache"
+    )
+
+    # The master holding the user's keys.
+    node = client.get_node_from_key(stores[0]._key(user_uid))
+    victim = next(server for server in masters if server.port == node.port)
+    workload = Workload().start()
+    time.sleep(args.duration / 2)
+    outage_started = time.monotonic()
+    victim.kill()
+    replica = replicas[masters.index(victim)]
+    _wait_for(lambda: replica.client().info("replication")["role"] == "master", 30)
+    promoted = time.monotonic() - outage_started
+    time.sleep(args.duration / 2)
+    workload.finish()
+    for server in [*masters, *replicas]:
+        if server is not victim:
+            server.kill()
+    print(f"  replica promoted after {promoted:.2f}s")
+    gap = workload.report()
+    return ok & _expect(
+        gap < promoted + args.max_recovery,
+        f"clients took {gap - promoted:.2f}s to find the new master",
+    )
+
+
+def _expect(condition, message):
+    if not condition:
+        print(f"  FAILED: {message}")
+    return condition
+
+
+SCENARIOS = {"standalone": standalone, "sentinel": sentinel, "cluster": cluster}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)}, all by default"
+    )
+    parser.add_argument("--redis-server", default=shutil.which("redis-server"))
+    parser.add_argument("--duration", type=float, default=4, help="seconds of load")
+    parser.add_argument(
+        "--outage",
+        type=float,
+        default=0.5,
+        help="seconds the standalone server is down",
+    )
+    parser.add_argument(
+        "--max-recovery",
+        type=float,
+        default=3,
+        help="seconds clients may take to find a promoted replica",
+    )
+    args = parser.parse_args()
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    if not args.redis_server:
+        parser.error("redis-server isn't on PATH, give it with --redis-server")
+
+    # The cluster client logs a traceback for every error it recovers from.
+    logging.getLogger("redis.cluster").setLevel(logging.CRITICAL)
+    ok = True
+    for name in args.scenarios or SCENARIOS:
+        print(name)
+        with tempfile.TemporaryDirectory() as directory:
+            ok &= SCENARIOS[name](args, directory)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compare the cost of the magic link secret hashers.
+
+Run from the app directory:
+
+    python -m benchmarks.secret_hashing
+"""
+import argparse
+import secrets
+import statistics
+import time
+import tracemalloc
+
+from auth.secret_hashing import Argon2SecretHasher, HmacSecretHasher
+
+
+def _time_calls(func, iterations):
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def _report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[int(len(timings) * 0.99) - 1]
+    print(
+        f"{name:<26} mean {statistics.mean(timings) * 1000:9.3f} ms"
+        f"   p99 {p99 * 1000:9.3f} ms   {len(timings) / sum(timings):10.0f} ops/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    secret = secrets.token_urlsafe()
+    for hasher in (HmacSecretHasher(secrets.token_bytes(32)), Argon2SecretHasher()):
+        name = type(hasher).__name__
+        secret_hash = hasher.hash(secret)
+        _report(
+            f"{name}.hash", _time_calls(lambda: hasher.hash(secret), args.iterations)
+        )
+        _report(
+            f"{name}.verify",
+            _time_calls(lambda: hasher.verify(secret_hash, secret), args.iterations),
+        )
+        # argon2 allocates its memory in C, so this only shows python side overhead.
+        tracemalloc.start()
+        hasher.hash(secret)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:<26} python peak memory {peak / 1024:.1f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""A minimal SMTP server that accepts every message and keeps it in memory, so the
+email login flow can be load tested without a real mail server."""
+import email
+import socketserver
+import threading
+from collections import defaultdict
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self._reply("220 smtp-sink ready")
+        recipients = []
+        while line := self.rfile.readline():
+            command = line.decode("latin1").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self._reply("250 smtp-sink")
+            elif verb == "MAIL":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip().strip("<>"))
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while (data_line := self.rfile.readline()) not in (b".\r\n", b""):
+                    # Undo dot stuffing
+                    data.append(
+                        data_line[1:] if data_line.startswith(b".") else data_line
+                    )
+                self.server.sink.deliver(recipients, b"".join(data))
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                # RSET, NOOP and anything else
+                self._reply("250 OK")
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SmtpSink:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = _Server((host, port), _Handler)
+        self.server.sink = self
+        self.host, self.port = self.server.server_address
+        self.messages = defaultdict(list)
+        self._condition = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def deliver(self, recipients, data):
+        message = email.message_from_bytes(data)
+        with self._condition:
+            for recipient in recipients:
+                self.messages[recipient].append(message)
+            self._condition.notify_all()
+
+    def wait_for(self, recipient, timeout=10):
+        """Wait for the next message to `recipient` and return it."""
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self.messages[recipient], timeout=timeout
+            ):
+                raise TimeoutError(f"No email for {recipient}")
+            return self.messages[recipient].pop(0)
@@ -0,0 +1,130 @@
+"""A software WebAuthn authenticator for driving the ceremonies without a browser.
+
+It answers the options produced by `security.prepare_credential_creation` and
+`security.prepare_login_with_credential` with registration and authentication
+responses that pass full verification: "none" attestation, an ES256 key pair per
+credential and a real signature over the authenticator data and client data.
+Responses are returned as the JSON documents the browser side of SimpleWebAuthn would
+post.
+"""
+import hashlib
+import json
+import os
+import struct
+
+import cbor2
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from webauthn import base64url_to_bytes
+from webauthn.helpers import bytes_to_base64url
+
+# Authenticator data flags
+USER_PRESENT = 0x01
+USER_VERIFIED = 0x04
+ATTESTED_CREDENTIAL_DATA = 0x40
+
+
+def _cose_key(public_key):
+    numbers = public_key.public_numbers()
+    return cbor2.dumps(
+        {
+            1: 2,  # kty: EC2
+            3: -7,  # alg: ES256
+            -1: 1,  # crv: P-256
+            -2: numbers.x.to_bytes(32, "big"),
+            -3: numbers.y.to_bytes(32, "big"),
+        }
+    )
+
+
+def _client_data(ceremony_type, challenge, origin):
+    return json.dumps(
+        {
+            "type": ceremony_type,
+            "challenge": challenge,
+            "origin": origin,
+            "crossOrigin": False,
+        }
+    ).encode()
+
+
+class SoftAuthenticator:
+    """Holds credentials for any number of relying parties, like a platform
+    authenticator would."""
+
+    def __init__(self, origin="https://localhost"):
+        self.origin = origin
+        # credential id -> (private key, rp id, user handle, sign count)
+        self.credentials = {}
+
+    def create(self, options):
+        """Make a new credential for registration `options` (the decoded JSON) and
+        return the registration response."""
+        rp_id = options["rp"]["id"]
+        credential_id = os.urandom(32)
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        user_handle = base64url_to_bytes(options["user"]["id"])
+        self.credentials[credential_id] = [private_key, rp_id, user_handle, 0]
+
+        auth_data = (
+            hashlib.sha256(rp_id.encode()).digest()
+            + bytes([USER_PRESENT | USER_VERIFIED | ATTESTED_CREDENTIAL_DATA])
+            + struct.pack(">I", 0)
+            + bytes(16)  # aaguid
+            + struct.pack(">H", len(credential_id))
+            + credential_id
+            + _cose_key(private_key.public_key())
+        )
+        attestation_object = cbor2.dumps(
+            {"fmt": "none", "attStmt": {}, "authData": auth_data}
+        )
+        client_data = _client_data("webauthn.create", options["challenge"], self.origin)
+        return {
+            "id": bytes_to_base64url(credential_id),
+            "rawId": bytes_to_base64url(credential_id),
+            "type": "public-key",
+            "response": {
+                "attestationObject": bytes_to_base64url(attestation_object),
+                "clientDataJSON": bytes_to_base64url(client_data),
+            },
+            "transports": ["internal"],
+        }
+
+    def get(self, options):
+        """Sign authentication `options` (the decoded JSON) with a matching
+        credential and return the authentication response."""
+        rp_id = options["rpId"]
+        allowed = [base64url_to_bytes(c["id"]) for c in options["allowCredentials"]]
+        candidates = [
+            credential_id
+            for credential_id, (_, credential_rp_id, _, _) in self.credentials.items()
+            if credential_rp_id == rp_id and (not allowed or credential_id in allowed)
+        ]
+        if not candidates:
+            raise LookupError(f"No credential for {rp_id}")
+        credential_id = candidates[0]
+        credential = self.credentials[credential_id]
+        private_key, _, user_handle, sign_count = credential
+        credential[3] = sign_count = sign_count + 1
+
+        auth_data = (
+            hashlib.sha256(rp_id.encode()).digest()
+            + bytes([USER_PRESENT | USER_VERIFIED])
+            + struct.pack(">I", sign_count)
+        )
+        client_data = _client_data("webauthn.get", options["challenge"], self.origin)
+        signature = private_key.sign(
+            auth_data + hashlib.sha256(client_data).digest(),
+            ec.ECDSA(hashes.SHA256()),
+        )
+        return {
+            "id": bytes_to_base64url(credential_id),
+            "rawId": bytes_to_base64url(credential_id),
+            "type": "public-key",
+            "response": {
+                "authenticatorData": bytes_to_base64url(auth_data),
+                "clientDataJSON": bytes_to_base64url(client_data),
+                "signature": bytes_to_base64url(signature),
+                "userHandle": bytes_to_base64url(user_handle),
+            },
+        }
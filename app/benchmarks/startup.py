@@ -0,0 +1,98 @@
+"""Benchmark how long a new process takes to get going.
+
+Each run starts a fresh interpreter that imports the app, calls `create_app`,
+optionally runs `warm_up`, then makes two requests to the login page. The first
+request pays for anything left to do lazily, the second one shows the steady state.
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --runs 5 --database-url postgresql://...
+
+Against SQLite by default. --fresh-bytecode-cache gives each run an empty Jinja
+bytecode cache, like the first worker after a deploy.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+_CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import app as app_module
+imported = time.perf_counter()
+app = app_module.create_app()
+created = time.perf_counter()
+if sys.argv[1] == "warm":
+    app_module.warm_up(app)
+warmed = time.perf_counter()
+client = app.test_client()
+client.get("/auth/login")
+first = time.perf_counter()
+client.get("/auth/login")
+second = time.perf_counter()
+print(json.dumps(dict(
+    import_=imported - started,
+    create_app=created - imported,
+    warm_up=warmed - created,
+    first_request=first - warmed,
+    second_request=second - first,
+    ready=first - started,
+)))
+"""
+
+
+def _run(mode, env):
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD, mode],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--database-url",
+        default=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'startup.db')}",
+    )
+    parser.add_argument("--fresh-bytecode-cache", action="store_true")
+    args = parser.parse_args()
+
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database_url,
+        SECRET_KEY=os.getenv("SECRET_KEY", "startup-benchmark"),
+        CHALLENGE_STORE=os.getenv("CHALLENGE_STORE", "memory"),
+    )
+    shared_cache = tempfile.mkdtemp()
+
+    print(
+        f"{'mode':<6} {'import':>8} {'create':>8} {'warm up':>8} {'1st req':>8}"
+        f" {'2nd req':>8} {'ready':>8}   (median ms of {args.runs} runs)"
+    )
+    for mode in ("cold", "warm"):
+        results = []
+        for _ in range(args.runs):
+            cache = tempfile.mkdtemp() if args.fresh_bytecode_cache else shared_cache
+            results.append(_run(mode, dict(env, JINJA_BYTECODE_CACHE_DIR=cache)))
+
+        def median_ms(key):
+            return statistics.median(result[key] for result in results) * 1000
+
+        print(
+            f"{mode:<6} {median_ms('import_'):>8.1f} {median_ms('create_app'):>8.1f}"
+            f" {median_ms('warm_up'):>8.1f} {median_ms('first_request'):>8.1f}"
+            f" {median_ms('second_request'):>8.1f} {median_ms('ready'):>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Seeded benchmark of the case insensitive username/email lookup used by
+/auth/prepare-login.
+
+This creates the user table in the database given by --database-url and fills it
+with generated users, so point it at a scratch database, never a real one:
+
+    createdb lookup_bench
+    python -m benchmarks.user_lookup --database-url postgresql:///lookup_bench
+
+For every size it times the original OR query without the lowercase indexes and the
+current union query with them.
+"""
+import argparse
+import statistics
+import time
+import uuid
+
+from sqlalchemy import create_engine, func, or_, select, union_all
+
+from models import User
+
+SIZES = (10_000, 100_000, 1_000_000)
+CHUNK = 10_000
+
+
+def _seed(connection, start, stop):
+    table = User.__table__
+    for chunk_start in range(start, stop, CHUNK):
+        rows = [
+            dict(
+                uid=str(uuid.uuid4()),
+                username=f"User{i}",
+                name=f"User {i}",
+                email=f"User{i}@Example.com",
+            )
+            for i in range(chunk_start, min(chunk_start + CHUNK, stop))
+        ]
+        connection.execute(table.insert(), rows)
+
+
+def _or_query(value):
+    return select(User.__table__).where(
+        or_(func.lower(User.username) == value, func.lower(User.email) == value)
+    )
+
+
+def _union_query(value):
+    matching_ids = union_all(
+        select(User.id).where(func.lower(User.username) == value),
+        select(User.id).where(func.lower(User.email) == value),
+    )
+    return select(User.__table__).where(User.id.in_(matching_ids))
+
+
+def _time_lookups(connection, build_query, size, iterations):
+    timings = []
+    for i in range(iterations):
+        # Alternate between usernames and emails spread over the whole table.
+        n = (i * 7919) % size
+        value = f"user{n}" if i % 2 else f"user{n}@example.com"
+        started = time.perf_counter()
+        assert connection.execute(build_query(value)).first() is not None
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def _print_row(size, name, p50, p95):
+    print(f"{size:>10} {name:<24} {p50 * 1000:9.3f} {p95 * 1000:9.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=SIZES, help="user counts to test"
+    )
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    indexes = [i for i in User.__table__.indexes if i.name.endswith("_lower")]
+    User.__table__.drop(engine, checkfirst=True)
+    User.__table__.create(engine)
+
+    seeded = 0
+    print(f"{'users':>10} {'query':<24} {'p50 ms':>9} {'p95 ms':>9}")
+    for size in sorted(args.sizes):
+        with engine.begin() as connection:
+            _seed(connection, seeded, size)
+        seeded = size
+
+        with engine.begin() as connection:
+            for index in indexes:
+                connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+            connection.exec_driver_sql('ANALYZE "user"')
+        with engine.connect() as connection:
+            p50, p95 = _time_lookups(connection, _or_query, size, args.iterations)
+        _print_row(size, "or, no lower() index", p50, p95)
+
+        with engine.begin() as connection:
+            for index in indexes:
+                index.create(connection)
+            connection.exec_driver_sql('ANALYZE "user"')
+        with engine.connect() as connection:
+            p50, p95 = _time_lookups(connection, _union_query, size, args.iterations)
+        _print_row(size, "union, lower() indexes", p50, p95)
+
+    User.__table__.drop(engine)
+
+
+if __name__ == "__main__":
+    main()
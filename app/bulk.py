@@ -0,0 +1,427 @@
+"""Bulk import and export of users and their credentials.
+
+    flask users import users.jsonl
+    flask users import users.csv --on-conflict fail
+    flask users import users.jsonl --copy
+    flask users export backup.jsonl
+    flask users export - --format csv | gzip > backup.csv.gz
+
+JSON lines files have one user per line with their credentials nested:
+
+    {"uid": "...", "username": "...", "name": "...", "email": "...",
+     "credentials": [{"credential_id": "...", "public_key": "...",
+                      "sign_count": 0, "last_used_at": "2022-06-01T12:00:00"}]}
+
+CSV files have one row per credential with the user columns (`CSV_COLUMNS`) repeated.
+The rows of a user must be next to each other, and a user without credentials has one
+row with the credential columns left empty. Credential ids and public keys are
+base64url encoded, as in WebAuthn. A missing uid gets generated.
+
+Imports are done in batches of users, each in its own transaction, with executemany
+INSERTs or, with --copy on postgres, COPY into temporary tables followed by
+INSERT ... SELECT. With --on-conflict skip (the default) users whose uid, username or
+email is taken and credentials whose id is already stored are left out, so an
+interrupted import can be run again from the start. Credentials go to the user with
+their uid, whether that user was just imported or already existed, and the totals
+count the skipped users and, separately, the credentials left out because no user has
+their uid, e.g. when their user was skipped for a username or email that's taken.
+
+Users that gained credentials are dropped from the user cache, including its redis
+tier, and from this process's cache of credential descriptors once their batch has
+committed. Other processes hold on to their descriptors for up to a minute.
+
+Exports page through the users by primary key, a chunk at a time, so memory use
+doesn't grow with the table and no transaction is held open for the whole export.
+"""
+import csv
+import itertools
+import json
+import time
+import uuid
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import exc, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from webauthn import base64url_to_bytes
+from webauthn.helpers import bytes_to_base64url
+
+from auth.pg_copy import copy_rows
+from auth.security import CREDENTIAL_DESCRIPTORS
+from auth.user_cache import user_cache
+from models import User, WebAuthnCredential, db
+
+cli = AppGroup("users", help="Bulk import and export of users and credentials.")
+
+USER_COLUMNS = ["uid", "username", "name", "email"]
+CREDENTIAL_COLUMNS = ["credential_id", "public_key", "sign_count", "last_used_at"]
+CSV_COLUMNS = USER_COLUMNS + CREDENTIAL_COLUMNS
+
+# Most bound parameters SQLite takes in one statement, for the uid lookups.
+_MAX_PARAMETERS = 32766
+
+_FORMAT_OPTION = click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["jsonl", "csv"]),
+    help="Defaults to csv for .csv files and jsonl otherwise.",
+)
+
+# The credential rows from `_parse`, as named in the table.
+_CREDENTIAL_FIELDS = [
+    "credential_id",
+    "credential_public_key",
+    "current_sign_count",
+    "last_used_at",
+]
+
+# Staging tables for --copy. Emptied at the end of each batch's transaction.
+_COPY_TABLES = """
+CREATE TEMPORARY TABLE IF NOT EXISTS import_user (
+    uid varchar(40),
+    username varchar(255),
+    name varchar(255),
+    email varchar(255)
+) ON COMMIT DELETE ROWS;
+CREATE TEMPORARY TABLE IF NOT EXISTS import_credential (
+    user_uid varchar(40),
+    credential_id bytea,
+    credential_public_key bytea,
+    current_sign_count integer,
+    last_used_at timestamp
+) ON COMMIT DELETE ROWS;
+"""
+
+
+def _file_format(file, file_format):
+    if file_format:
+        return file_format
+    return "csv" if file.name.endswith(".csv") else "jsonl"
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def read_jsonl(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(file):
+    rows = csv.DictReader(file)
+    header = rows.fieldnames or ()
+    if missing := [column for column in CSV_COLUMNS if column not in header]:
+        raise click.ClickException(
+            f"The CSV file is missing the columns {', '.join(missing)}, nothing was"
+            " imported"
+        )
+    for _, group in itertools.groupby(rows, lambda row: (row["uid"], row["username"])):
+        group = list(group)
+        record = {column: group[0][column] for column in USER_COLUMNS}
+        record["credentials"] = [
+            {column: row[column] for column in CREDENTIAL_COLUMNS}
+            for row in group
+            if row["credential_id"]
+        ]
+        yield record
+
+
+def _parse(record):
+    """A record from a file as a user row and its credential rows."""
+    if not record.get("username") or not record.get("email"):
+        raise ValueError("username and email are required")
+    user = dict(
+        uid=record.get("uid") or str(uuid.uuid4()),
+        username=record["username"],
+        name=record.get("name") or None,
+        email=record["email"],
+    )
+    credentials = []
+    for credential in record.get("credentials") or ():
+        last_used_at = credential.get("last_used_at") or None
+        credentials.append(
+            dict(
+                credential_id=base64url_to_bytes(credential["credential_id"]),
+                credential_public_key=base64url_to_bytes(credential["public_key"]),
+                current_sign_count=int(credential.get("sign_count") or 0),
+                last_used_at=last_used_at and datetime.fromisoformat(last_used_at),
+            )
+        )
+    return user, credentials
+
+
+def _parse_all(records):
+    for number, record in enumerate(records, 1):
+        try:
+            yield _parse(record)
+        except (KeyError, TypeError, ValueError) as error:
+            raise click.ClickException(
+                f"Record {number} is invalid ({error!r}), the batches before it were"
+                " imported"
+            )
+
+
+def _insert_statement(dialect, table, on_conflict):
+    if on_conflict == "fail":
+        return insert(table)
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    raise click.UsageError(f"--on-conflict skip isn't supported with {dialect}")
+
+
+def _insert(conn, statement, rows):
+    """Insert `rows` with one executemany. Returns the number inserted."""
+    # psycopg2 sends pages of rows as multi row INSERTs, which leaves the rowcount of
+    # the last page only, so count the rows returned instead.
+    if conn.dialect.insert_executemany_returning:
+        return len(conn.execute(statement.returning(statement.table.c.id), rows).all())
+    return conn.execute(statement, rows).rowcount
+
+
+def _insert_batch(conn, batch, statements):
+    """Returns the new users, new credentials and credentials without a user, and the
+    uids the credentials went to."""
+    new_users = _insert(conn, statements[0], [user for user, _ in batch])
+    uids = [user["uid"] for user, credentials in batch if credentials]
+    if not uids:
+        return new_users, 0, 0, set()
+
+    ids = {}
+    for chunk in _chunks(uids, _MAX_PARAMETERS):
+        query = select(User.uid, User.id).where(User.uid.in_(chunk))
+        ids.update(conn.execute(query).all())
+    rows = [
+        dict(credential, user_id=ids[user["uid"]])
+        for user, credentials in batch
+        if user["uid"] in ids
+        for credential in credentials
+    ]
+    orphaned = sum(len(credentials) for _, credentials in batch) - len(rows)
+    new_credentials = _insert(conn, statements[1], rows) if rows else 0
+    return new_users, new_credentials, orphaned, set(ids)
+
+
+def _copy_batch(conn, batch, on_conflict):
+    """Like `_insert_batch`, with COPY."""
+    preparer = conn.dialect.identifier_preparer
+    user_table = preparer.format_table(User.__table__)
+    credential_table = preparer.format_table(WebAuthnCredential.__table__)
+    on_conflict = "" if on_conflict == "fail" else " ON CONFLICT DO NOTHING"
+    # The DBAPI cursor shares the connection's transaction.
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(_COPY_TABLES)
+        copy_rows(
+            conn,
+            "import_user",
+            USER_COLUMNS,
+            ([user[column] for column in USER_COLUMNS] for user, _ in batch),
+        )
+        copy_rows(
+            conn,
+            "import_credential",
+            ["user_uid"] + _CREDENTIAL_FIELDS,
+            (
+                [user["uid"]] + [credential[field] for field in _CREDENTIAL_FIELDS]
+                for user, credentials in batch
+                for credential in credentials
+            ),
+        )
+        cursor.execute(
+            f"INSERT INTO {user_table} (uid, username, name, email)"
+            f" SELECT uid, username, name, email FROM import_user{on_conflict}"
+        )
+        new_users = cursor.rowcount
+        cursor.execute(
+            "SELECT DISTINCT c.user_uid FROM import_credential c"
+            f" JOIN {user_table} u ON u.uid = c.user_uid"
+        )
+        uids = {uid for uid, in cursor.fetchall()}
+        cursor.execute(
+            "SELECT count(*) FROM import_credential c WHERE NOT EXISTS"
+            f" (SELECT 1 FROM {user_table} u WHERE u.uid = c.user_uid)"
+        )
+        orphaned = cursor.fetchone()[0]
+        cursor.execute(
+            f"INSERT INTO {credential_table} (user_id, credential_id,"
+            " credential_public_key, current_sign_count, last_used_at)"
+            " SELECT u.id, c.credential_id, c.credential_public_key,"
+            " c.current_sign_count, c.last_used_at"
+            f" FROM import_credential c JOIN {user_table} u ON u.uid = c.user_uid"
+            f"{on_conflict}"
+        )
+        return new_users, cursor.rowcount, orphaned, uids
+    finally:
+        cursor.close()
+
+
+class _Progress:
+    """Running totals, printed to stderr at most once a second and at the end."""
+
+    def __init__(self, verb):
+        self.verb = verb
+        self.users = self.credentials = 0
+        self.new_users = self.new_credentials = None
+        self.orphaned_credentials = 0
+        self.started = self.reported = time.perf_counter()
+
+    def add(self, users, credentials, new_users=None, new_credentials=None, orphaned=0):
+        self.users += users
+        self.credentials += credentials
+        if new_users is not None:
+            self.new_users = (self.new_users or 0) + new_users
+            self.new_credentials = (self.new_credentials or 0) + new_credentials
+        self.orphaned_credentials += orphaned
+        if time.perf_counter() - self.reported >= 1:
+            self.report()
+
+    def report(self):
+        self.reported = time.perf_counter()
+        elapsed = self.reported - self.started
+        users, credentials = f"{self.users} users", f"{self.credentials} credentials"
+        if self.new_users is not None:
+            skipped = self.users - self.new_users
+            users += f" ({self.new_users} new, {skipped} skipped)"
+            credentials += f" ({self.new_credentials} new"
+            if self.orphaned_credentials:
+                credentials += f", {self.orphaned_credentials} without a user"
+            credentials += ")"
+        click.echo(
+            f"{self.verb} {users}, {credentials} in {elapsed:.1f}s,"
+            f" {self.users / max(elapsed, 1e-9):.0f} users/s",
+            err=True,
+        )
+
+
+@cli.command("import")
+@click.argument("file", type=click.File("r"))
+@_FORMAT_OPTION
+@click.option("--batch-size", default=5000, show_default=True, help="Users per batch.")
+@click.option(
+    "--on-conflict",
+    type=click.Choice(["skip", "fail"]),
+    default="skip",
+    show_default=True,
+    help="Skip users and credentials that are already there, or stop.",
+)
+@click.option("--copy", "use_copy", is_flag=True, help="Load with COPY (postgres).")
+def import_users(file, file_format, batch_size, on_conflict, use_copy):
+    """Import users and their credentials from FILE, `-` for stdin."""
+    engine = db.engine
+    dialect = engine.dialect.name
+    if use_copy and dialect != "postgresql":
+        raise click.UsageError("--copy only works with postgres")
+    statements = [
+        _insert_statement(dialect, model.__table__, on_conflict)
+        for model in (User, WebAuthnCredential)
+    ]
+
+    reader = read_csv if _file_format(file, file_format) == "csv" else read_jsonl
+    progress = _Progress("Imported")
+    for batch in _chunks(_parse_all(reader(file)), batch_size):
+        try:
+            with engine.begin() as conn:
+                if use_copy:
+                    counts = _copy_batch(conn, batch, on_conflict)
+                else:
+                    counts = _insert_batch(conn, batch, statements)
+        except (exc.IntegrityError, engine.dialect.dbapi.IntegrityError) as error:
+            raise click.ClickException(
+                f"The batch from record {progress.users + 1} has a user or credential"
+                f" that's already there, the batches before it were imported:"
+                f" {getattr(error, 'orig', error)}"
+            )
+        new_users, new_credentials, orphaned, uids = counts
+        # Only once committed, or a request could cache the old state again.
+        if new_credentials:
+            user_cache.invalidate_many(uids)
+            for uid in uids:
+                CREDENTIAL_DESCRIPTORS.pop(uid)
+        progress.add(
+            len(batch),
+            sum(len(credentials) for _, credentials in batch),
+            new_users,
+            new_credentials,
+            orphaned,
+        )
+    progress.report()
+
+
+def _export_records(conn, users):
+    credentials = {}
+    for credential in conn.execute(
+        select(
+            WebAuthnCredential.user_id,
+            WebAuthnCredential.credential_id,
+            WebAuthnCredential.credential_public_key,
+            WebAuthnCredential.current_sign_count,
+            WebAuthnCredential.last_used_at,
+        )
+        .where(WebAuthnCredential.user_id.between(users[0].id, users[-1].id))
+        .order_by(WebAuthnCredential.user_id, WebAuthnCredential.id)
+    ):
+        credentials.setdefault(credential.user_id, []).append(
+            dict(
+                credential_id=bytes_to_base64url(credential.credential_id),
+                public_key=bytes_to_base64url(credential.credential_public_key),
+                sign_count=credential.current_sign_count,
+                last_used_at=credential.last_used_at
+                and credential.last_used_at.isoformat(),
+            )
+        )
+    for user in users:
+        record = {column: user[column] for column in USER_COLUMNS}
+        record["credentials"] = credentials.get(user.id, [])
+        yield record
+
+
+@cli.command("export")
+@click.argument("file", type=click.File("w", lazy=False))
+@_FORMAT_OPTION
+@click.option(
+    "--chunk-size", default=5000, show_default=True, help="Users read at a time."
+)
+def export_users(file, file_format, chunk_size):
+    """Export all the users and their credentials to FILE, `-` for stdout."""
+    if _file_format(file, file_format) == "csv":
+        writer = csv.writer(file)
+        writer.writerow(CSV_COLUMNS)
+
+        def write(record):
+            user = [record[column] for column in USER_COLUMNS]
+            for credential in record["credentials"] or [{}]:
+                writer.writerow(
+                    user + [credential.get(column) for column in CREDENTIAL_COLUMNS]
+                )
+
+    else:
+
+        def write(record):
+            file.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    progress = _Progress("Exported")
+    last_id = 0
+    while True:
+        with db.engine.connect() as conn:
+            users = conn.execute(
+                select(User.id, *(getattr(User, c) for c in USER_COLUMNS))
+                .where(User.id > last_id)
+                .order_by(User.id)
+                .limit(chunk_size)
+            ).all()
+            if not users:
+                break
+            credentials = 0
+            for record in _export_records(conn, users):
+                write(record)
+                credentials += len(record["credentials"])
+        progress.add(len(users), credentials)
+        last_id = users[-1].id
+    progress.report()
@@ -1,2 +1,2 @@
 #!/usr/bin/env bash
-wait-for-it -t 10 db:5432 && flask db upgrade && waitress-serve --host 0.0.0.0 --port 5000 app:app
\ No newline at end of file
+wait-for-it -t 10 db:5432 && flask db upgrade && waitress-serve --host 0.0.0.0 --port 5000 --call app:create_app
\ No newline at end of file
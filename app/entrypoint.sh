@@ -1,2 +1,9 @@
 #!/usr/bin/env bash
-flask db upgrade && waitress-serve --host 0.0.0.0 --port 5000 app:app
\ No newline at end of file
+# SERVER=gunicorn runs the multi-process server configured in gunicorn.conf.py,
+# anything else keeps the single process waitress server. For the ASGI app add
+# GUNICORN_APP=asgi:application GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker.
+flask db upgrade || exit 1
+if [ "$SERVER" = "gunicorn" ]; then
+  exec gunicorn -c gunicorn.conf.py "${GUNICORN_APP:-app:create_app()}"
+fi
+exec waitress-serve --host 0.0.0.0 --port 5000 --call app:create_warm_app
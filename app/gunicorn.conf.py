@@ -0,0 +1,61 @@
+"""Gunicorn settings for the multi-process production server.
+
+    gunicorn -c gunicorn.conf.py "app:create_app()"
+
+The app is imported once in the master process and then forked, so workers start
+quickly and share memory for the code. Each worker drops anything it inherited and
+opens its own redis and database connections (see `create_app`), then warms up before
+taking traffic unless WARM_UP=false. Send the master SIGHUP to reload gracefully.
+For the async entry point use `asgi:application` with
+GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+
+# Signature checks and hashing are CPU bound and hold the GIL, so scale with cores
+# using processes and keep a few threads per worker for requests waiting on I/O.
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count()))
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+
+preload_app = True
+
+# Recycle workers now and then so slow leaks can't build up. The jitter stops them
+# all restarting at once.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 5000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 500))
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+
+def on_starting(server):
+    # Refuse to start rather than fail ceremonies that land on another worker.
+    from auth.security import check_workers
+
+    check_workers(server.cfg.workers)
+
+    # Metrics files left over from a previous run would be counted again.
+    if metrics_dir := os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def post_worker_init(worker):
+    # Runs in the worker once the app is loaded, before it accepts connections.
+    if os.getenv("WARM_UP", "true").lower() == "true":
+        from app import warm_up
+
+        # The ASGI application wraps the Flask one.
+        warm_up(getattr(worker.wsgi, "flask_app", worker.wsgi))
+
+
+def child_exit(server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,27 @@
+"""Add lowercase username and email indexes
+
+Revision ID: 3c1f4e2b7a90
+Revises: 8a473eb9e801
+Create Date: 2026-10-18 10:12:44.301517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f4e2b7a90'
+down_revision = '8a473eb9e801'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Expression indexes, so nothing needs to be backfilled.
+    op.create_index('ix_user_username_lower', 'user', [sa.text('lower(username)')])
+    op.create_index('ix_user_email_lower', 'user', [sa.text('lower(email)')])
+
+
+def downgrade():
+    op.drop_index('ix_user_email_lower', table_name='user')
+    op.drop_index('ix_user_username_lower', table_name='user')
@@ -1,8 +1,18 @@
 import uuid
 
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy
+from sqlalchemy import func, orm, select, union_all
 from sqlalchemy.orm import backref
 
+from auth.replicas import RoutingSession
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    def create_session(self, options):
+        # Reads in `replica_reads` blocks go to a replica, see auth/replicas.py
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
 db = SQLAlchemy()
 
 
@@ -24,9 +34,30 @@ class User(db.Model):
         lazy=True,
     )
 
+    # Logins look users up case insensitively, so index the lowercased values. The
+    # plain unique constraints can't be used for those lookups.
+    __table_args__ = (
+        db.Index("ix_user_username_lower", func.lower(username)),
+        db.Index("ix_user_email_lower", func.lower(email)),
+    )
+
     def __repr__(self):
         return f"<User {self.username}>"
 
+    @classmethod
+    def username_or_email_matches(cls, username_or_email):
+        """A condition matching users by username or email, ignoring case.
+
+        The two comparisons are separate branches of a union rather than an OR so
+        that each one is answered from its own index.
+        """
+        value = username_or_email.lower()
+        matching_ids = union_all(
+            select(cls.id).where(func.lower(cls.username) == value),
+            select(cls.id).where(func.lower(cls.email) == value),
+        )
+        return cls.id.in_(matching_ids)
+
     @property
     def is_authenticated(self):
         """If we can access this user model from current user, they are authenticated,
@@ -54,10 +85,41 @@ class WebAuthnCredential(db.Model):
     """Stored WebAuthn Credentials as a replacement for passwords."""
 
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    credential_id = db.Column(db.LargeBinary, nullable=False)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("user.id"), nullable=False, index=True
+    )
+    # Unique and indexed so a login can find the credential (and its user) directly.
+    credential_id = db.Column(db.LargeBinary, nullable=False, unique=True, index=True)
     credential_public_key = db.Column(db.LargeBinary, nullable=False)
     current_sign_count = db.Column(db.Integer, default=0)
+    last_used_at = db.Column(db.DateTime, nullable=True)
 
     def __repr__(self):
         return f"<Credential {self.credential_id}>"
+
+
+class AuthEvent(db.Model):
+    """An entry in the append only log of registrations, logins and failures, see
+    auth/events.py. Rows refer to users by uid, without foreign keys, so they outlive
+    the users and credentials they're about.
+
+    On postgres the table is partitioned by month of `created_at`, and the primary key
+    has to include it."""
+
+    id = db.Column(db.String(40), primary_key=True, default=_str_uuid)
+    created_at = db.Column(db.DateTime, primary_key=True)
+    event = db.Column(db.String(40), nullable=False)
+    # "webauthn", "passkey" or "magic_link" for logins.
+    method = db.Column(db.String(20), nullable=True)
+    user_uid = db.Column(db.String(40), nullable=True)
+    credential_id = db.Column(db.LargeBinary, nullable=True)
+    remote_addr = db.Column(db.String(45), nullable=True)
+    detail = db.Column(db.String(255), nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_auth_event_user_uid_created_at", user_uid, created_at),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+    def __repr__(self):
+        return f"<AuthEvent {self.event} {self.created_at}>"